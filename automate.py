@@ -7,31 +7,35 @@
 # Default region name [None]: eu-central-1
 # Default output format [None]:
 
-import boto3
-import paramiko
-import io
-import yaml
+import time
+# Startup time is reported from here, as schedulers run this many times an hour
+STARTED = time.monotonic()
+
 import argparse
+import json
 import os
 import signal
 import sys
-from ec2_launchtemplate_helper import create_launch_template, delete_launch_template
-from ec2_fleet_helper import create_ec2_fleet, delete_ec2_fleet
-from ec2_enable_serial_helper import enable_serial_console
-from ec2_instance_worker import instance_worker
-from ec2_get_instance_ip_helper import get_instance_ip
-from ec2_send_serial_console_public_key import send_serial_console_ssh_public_key
-from ec2_send_serial_commands import connect_serial_console
-import threading
-
-# Placeholder variables for launch template and fleet IDs
-fleet_id = None
-launch_template_id = None
-
-def load_config(filename):
-    with open(filename, 'r') as config_file:
-        config = yaml.safe_load(config_file)
-    return config
+from functools import partial
+# Only light modules here - boto3, paramiko and numpy are imported by the subcommands that use them, so that
+# status, cleanup --dry-run and fleet --check start in milliseconds
+from ec2_config_helper import load_config, ConfigError
+from ec2_sweep_helper import expand_jobs
+from ec2_trace_helper import tracer
+from ec2_rate_limiter import rate_limiter
+from ec2_boot_mode_helper import BOOT_MODES, load_boot_mode, uses_serial_console, userdata_for_boot_mode, jobs_with_long_arguments
+from ec2_run_journal import journal, load_journal, DEFAULT_JOURNAL_FILE, JOB_STAGES
+from ec2_results_collector import load_results_settings
+from ec2_userdata_helper import load_userdata_settings, render_userdata, userdata_with_job_channel, compress_userdata
+
+# Fleets and launch templates created by this run, as (EC2 client, region, ID) - region is None for the profile's
+# own region
+fleet_ids = []
+launch_templates = []
+# The launch template cache of each region of this run, to forget the templates cleanup deletes
+launch_template_cache_files = {}
+# Launch templates are content addressed and reused across runs unless launch_template_cache is disabled
+keep_launch_template = True
 
 def load_userdata(filename):
     with open(filename, 'r') as userdata_file:
@@ -39,19 +43,32 @@ def load_userdata(filename):
     return userdata
 
 def signal_handler(sig, frame):
-    """Handle Ctrl+C (SIGINT) to ensure cleanup."""
-    print("\nCtrl+C pressed. Cleaning up...")
+    """Handle Ctrl+C (SIGINT) and SIGTERM to ensure cleanup - straight away, rather than once the event loop and
+    its worker threads have wound down."""
+    # A second Ctrl+C while cleaning up interrupts as usual
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    print("\nInterrupted. Cleaning up...")
     cleanup_resources()
-    sys.exit(0)
+    sys.exit(128 + sig)
 
-def cleanup_resources(ec2_client):
-    """Cleanup EC2 Fleet and Launch Template if they were created."""
-    if fleet_id:
+def cleanup_resources():
+    """Cleanup the EC2 Fleets and Launch Templates created by this run, in whichever regions they were created."""
+    from ec2_fleet_helper import delete_ec2_fleet
+    from ec2_launchtemplate_helper import delete_launch_template, DEFAULT_CACHE_FILE
+    for ec2_client, region, fleet_id in list(fleet_ids):
         print(f"Cleaning up Fleet {fleet_id}...")
-        delete_ec2_fleet(ec2_client, fleet_id)
-    if launch_template_id:
-        print(f"Cleaning up Laucnh Template {launch_template_id}...")
-        delete_launch_template(ec2_client, launch_template_id)
+        if delete_ec2_fleet(ec2_client, fleet_id):
+            journal.fleet_deleted(region, fleet_id)
+        # A worker may have removed it in the meantime, when cleaning up after an interrupt
+        if (ec2_client, region, fleet_id) in fleet_ids:
+            fleet_ids.remove((ec2_client, region, fleet_id))
+    for ec2_client, region, launch_template_id in list(launch_templates):
+        if not keep_launch_template:
+            print(f"Cleaning up Launch Template {launch_template_id}...")
+            if delete_launch_template(ec2_client, launch_template_id, launch_template_cache_files.get(region, DEFAULT_CACHE_FILE)):
+                journal.launch_template_deleted(region, launch_template_id)
+        if (ec2_client, region, launch_template_id) in launch_templates:
+            launch_templates.remove((ec2_client, region, launch_template_id))
 
 def launch_ec2_instance(ec2_client, ami_id, instance_type, key_name, security_group_ids, subnet_id):
     # Launch EC2 instance
@@ -73,46 +90,290 @@ def launch_ec2_instance(ec2_client, ami_id, instance_type, key_name, security_gr
     return instance_id
 
 
-def generate_ssh_key_pair(args, private_key_file_path):
-    # Create an RSA key object
-    private_key = paramiko.RSAKey.generate(2048)
-
-    # Store private key in memory (PEM format)
-    private_key_file = io.StringIO()
-    private_key.write_private_key(private_key_file)
-    private_key_pem = private_key_file.getvalue()
-
-    # Generate public key (OpenSSH format)
-    public_key = f"{private_key.get_name()} {private_key.get_base64()}"
-
+def write_private_key(args, ssh_key, private_key_file_path):
     # Print the keys
     if args.debug:
-        print("Private Key (PEM):\n", private_key)
-        print("Public Key (OpenSSH):\n", public_key)
+        print(f"Serial console key type: {ssh_key.key_type}")
+        print("Public Key (OpenSSH):\n", ssh_key.public_key)
 
     # Write the private key to a file
     if args.debug:
         with open(private_key_file_path, 'w') as private_key_file:
-            private_key_file.write(str(private_key))
+            private_key_file.write(ssh_key.private_key_text)
 
+def run_jobs_on_fleet(args, config, userdata, ec2_client, ec2_instance_connect, jobs, concurrency):
+    """Create the launch template, then launch fleets and run every job on them. Returns (completed, failed) jobs.
 
-    return private_key_pem, public_key
+    The caller owns the clients and is responsible for cleanup_resources(), so this can also be driven against
+    the local simulator in ec2_simulator.py.
+    """
+    return run_jobs_in_regions(args, [(config, ec2_client, ec2_instance_connect)], userdata, jobs, concurrency)
 
-def fleet_main():
-    ec2_client = None
-    global fleet_id, launch_template_id
+def run_jobs_in_regions(args, regions, userdata, jobs, concurrency, resume=None):
+    """Run every job on fleets in one or more regions, given as a list of (region_config, ec2_client,
+    ec2_instance_connect) - see region_configs() in ec2_region_helper.py. Returns (completed, failed) jobs.
 
-    # Set up argument parser
-    parser = argparse.ArgumentParser(description="EC2 instance configuration and launcher script.")
+    Each region gets its own launch template, fleets, state tracker, serial console endpoint and orchestrator
+    with its own concurrency limits, and all of them take their jobs from one shared list on one event loop.
 
-    # Option to specify the config file (default is config.yaml)
-    parser.add_argument(
-        '--config',
-        type=str,
-        default='config.yaml',
-        help='Path to the configuration YAML file. Default is "config.yaml".'
-    )
+    Given resume, the JournalState of an interrupted run (see ec2_run_journal.py), the jobs it completed are not
+    run again, instances it had already booted with their job are waited for rather than replaced, and its
+    other fleets are deleted before anything new is launched.
+    """
+    import asyncio
+    from ec2_warm_pool_helper import userdata_for_every_boot
+    from ec2_key_provider import key_provider_from_config
+    from ec2_instance_worker import resumed_instance_worker
+    from ec2_fleet_orchestrator import run_fleets, warm_pool_queues
+    global keep_launch_template
+    state_trackers = []
+    key_provider = None
+    config = regions[0][0]
+    # Warm pool instances are stopped rather than terminated after each job, and restarted for the next one
+    warm_pool = config.get('warm_pool') or {}
+    template_cache = config.get('launch_template_cache') or {}
+    keep_launch_template = template_cache.get('enabled', True)
+    # Every boot reads its job from the instance tags, and checks its kernel command line before the workload runs
+    userdata_settings = load_userdata_settings(config)
+    userdata = userdata_with_job_channel(userdata, userdata_settings)
+    # Outside the console mode, the userdata boots each instance with its kernel arguments itself
+    boot_mode = load_boot_mode(config)
+    userdata = userdata_for_boot_mode(userdata, boot_mode)
+    if warm_pool.get('enabled'):
+        # Restarted instances must run the userdata again, and the template they come from must outlive the run
+        userdata = userdata_for_every_boot(userdata)
+        keep_launch_template = True
+    elif not uses_serial_console(boot_mode):
+        # The userdata runs again on the boot with the kernel arguments, to carry on into the workload
+        userdata = userdata_for_every_boot(userdata)
+    # gzipped if it would not fit in the 16 KB EC2 allows otherwise
+    userdata = compress_userdata(userdata, userdata_settings)
+
+    previous = []
+    resumed = {}
+    jobs_to_run = jobs
+    if resume is not None:
+        previous, booted, jobs_to_run = resume.split_jobs(jobs)
+        region_names = [region_config.get('region') for region_config, _, _ in regions]
+        for region, instance_id, job in booted:
+            if region in region_names:
+                resumed.setdefault(region, []).append((instance_id, job))
+            else:
+                jobs_to_run.append(job)
+        print(f"Resuming: {len(previous)} jobs already completed, {sum(len(instances) for instances in resumed.values())} to wait for on instances booted before, {len(jobs_to_run)} to run.")
+
+    try:
+        # Temporary SSH keys for the serial console - one for the run, or one per instance from a background pool.
+        # Serial console keys are not regional, so every region shares them.
+        if uses_serial_console(boot_mode):
+            print("Generating temporary SSH key pair...")
+            key_provider = key_provider_from_config(config).start()
+            if not key_provider.per_instance:
+                write_private_key(args, key_provider.get_key(), config['private_key_file_path'])
+
+        region_runs = []
+        for region_config, ec2_client, ec2_instance_connect in regions:
+            region_runs.append(prepare_region(args, region_config, userdata, ec2_client, ec2_instance_connect, key_provider))
+            state_trackers.append(region_runs[-1]['state_tracker'])
+        if resume is not None:
+            adopt_journal_resources(args, resume, regions, resumed)
+
+        async def run_all_jobs(orchestrators):
+            # Every region takes its waves from the same list, so faster regions end up running more jobs
+            pending = list(jobs_to_run)
+            results = await asyncio.gather(*(
+                orchestrator.run_jobs(
+                    jobs_to_run,
+                    region_run['total_capacity'],
+                    region_run['launch_fleet'],
+                    region_run['finish_fleet'],
+                    partial(region_run['make_pipeline'], orchestrator),
+                    region_run['backfill'],
+                    pending=pending if len(region_runs) > 1 else None
+                )
+                for orchestrator, region_run in zip(orchestrators, region_runs)
+            ), *run_resumed(orchestrators))
+            return merge_results(jobs, results + [(previous, [])])
+
+        async def run_all_jobs_on_warm_pool(orchestrators):
+            job_queues = warm_pool_queues(jobs_to_run)
+            results = run_resumed(orchestrators)
+            for orchestrator, region_run in zip(orchestrators, region_runs):
+                results.append(orchestrator.run_warm_pool(
+                    jobs_to_run,
+                    region_run['total_capacity'],
+                    await orchestrator.call_ec2(region_run['find_warm_instances']),
+                    region_run['launch_instances'],
+                    partial(region_run['make_warm_pipeline'], orchestrator),
+                    job_queues
+                ))
+            return merge_results(jobs, await asyncio.gather(*results) + [(previous, [])])
+
+        def run_resumed(orchestrators):
+            # Instances an interrupted run had booted finish their jobs alongside the new fleets
+            return [
+                orchestrator.run_resumed(resumed.get(region_run['region'], []), partial(resumed_instance_worker, orchestrator))
+                for orchestrator, region_run in zip(orchestrators, region_runs)
+            ]
+
+        concurrencies = [concurrency] * len(region_runs)
+        if not warm_pool.get('enabled'):
+            return run_fleets(state_trackers, concurrencies, run_all_jobs)
+
+        result = run_fleets(state_trackers, concurrencies, run_all_jobs_on_warm_pool)
+        for region_run in region_runs:
+            with tracer.span('trim_warm_pool', region=region_run['region']):
+                region_run['trim_warm_pool']()
+        return result
+    finally:
+        if key_provider is not None:
+            key_provider.stop()
+
+        for state_tracker in state_trackers:
+            state_tracker.stop()
+            if args.debug:
+                print(f"Instance state tracker made {state_tracker.api_calls} DescribeInstances calls.")
+
+def merge_results(jobs, results):
+    """Combine the (completed, failed) of every region into one, failing whatever no region completed."""
+    completed = [job for region_completed, _ in results for job in region_completed]
+    done_ids = {job['job_id'] for job in completed}
+    failed = [job for job in jobs if job['job_id'] not in done_ids]
+    return completed, failed
 
+def adopt_journal_resources(args, state, regions, resumed):
+    """Take over the fleets and launch templates an interrupted run left behind, in the regions of this run.
+
+    Fleets with instances still finishing a resumed job are deleted along with the fleets of this run, the others
+    straight away, as their instances were never booted with a job or have finished it.
+    """
+    from ec2_fleet_helper import delete_ec2_fleet
+    clients = {region_config.get('region'): ec2_client for region_config, ec2_client, _ in regions}
+    resumed_instances = {instance_id for instances in resumed.values() for instance_id, _ in instances}
+    for fleet_id, fleet in state.fleets.items():
+        ec2_client = clients.get(fleet['region'])
+        if ec2_client is None:
+            print(f"Fleet {fleet_id} is in {fleet['region']}, which is not part of this run - use 'python automate.py cleanup' to delete it.")
+        elif args.keep or resumed_instances.intersection(fleet['instance_ids']):
+            fleet_ids.append((ec2_client, fleet['region'], fleet_id))
+        else:
+            print(f"Deleting fleet {fleet_id} left behind by the interrupted run...")
+            if delete_ec2_fleet(ec2_client, fleet_id):
+                journal.fleet_deleted(fleet['region'], fleet_id)
+    for launch_template_id, template in state.launch_templates.items():
+        in_use = any(existing_id == launch_template_id for _, _, existing_id in launch_templates)
+        if not template['keep'] and not in_use and template['region'] in clients:
+            launch_templates.append((clients[template['region']], template['region'], launch_template_id))
+
+def prepare_region(args, config, userdata, ec2_client, ec2_instance_connect, key_provider):
+    """Create the launch template and state tracker of one region, and the callbacks its orchestrator needs."""
+    from ec2_launchtemplate_helper import create_launch_template, DEFAULT_CACHE_FILE, DEFAULT_MAX_VERSIONS
+    from ec2_fleet_helper import create_ec2_fleet, delete_ec2_fleet, build_fleet_overrides, fleet_instance_types
+    from ec2_warm_pool_helper import find_warm_instances, launch_warm_instances, trim_warm_pool
+    from ec2_instance_worker import instance_worker, warm_instance_worker
+    from ec2_instance_state_tracker import InstanceStateTracker
+    from ec2_fleet_orchestrator import load_backfill
+    from ec2_resource_sweeper import load_resource_expiry, run_tags
+    region = config.get('region')
+    template_name = config['launch_template_name']
+    total_capacity = config['total_capacity']
+    on_demand_capacity = config['on_demand_capacity']
+    serial_console_endpoint = config.get('serial_console_endpoint')
+    polling = config.get('state_polling') or {}
+    backfill = load_backfill(config.get('backfill'))
+    fleet_settings = config.get('fleet_overrides') or {}
+    template_cache = config.get('launch_template_cache') or {}
+    warm_pool = config.get('warm_pool') or {}
+    # Fleets and launch templates are tagged with the run and when they expire, so 'automate.py sweep' can find
+    # any this run loses track of
+    expiry = load_resource_expiry(config)
+
+    # Create the Launch Template if it doesn't already exist
+    # Create a launch template
+    with tracer.span('create_launch_template', region=region):
+        launch_template_id, launch_template_version = create_launch_template(
+            ec2_client,
+            template_name,
+            config['ami_id'],
+            config['instance_type'],
+            config['key_name'],
+            config['security_group_ids'],
+            config['subnet_id'],
+            config['iam_instance_profile_arn'],
+            userdata,
+            cache_file=template_cache.get('cache_file', DEFAULT_CACHE_FILE),
+            max_versions=template_cache.get('max_versions', DEFAULT_MAX_VERSIONS),
+            metadata_tags=not uses_serial_console(load_boot_mode(config)) or load_userdata_settings(config)['job_channel'],
+            tags=run_tags(journal.run_id, expiry['launch_template_hours'])
+        )
+    launch_templates.append((ec2_client, region, launch_template_id))
+    launch_template_cache_files[region] = template_cache.get('cache_file', DEFAULT_CACHE_FILE)
+    journal.launch_template_created(region, launch_template_id, keep_launch_template)
+
+    # One tracker polls the state of the region's instances in batched calls for all the workers
+    state_tracker = InstanceStateTracker(ec2_client, debug=args.debug, **polling)
+    state_tracker.start()
+
+    def launch_fleet(fleet_instance_type, count, attempt=0):
+        # Create an EC2 Fleet request using the created (or existing) launch template - on demand capacity
+        # first, spot for the rest of the wave
+        on_demand = min(on_demand_capacity, count)
+        # Spread the fleet over every instance type and subnet it may use, see ec2_fleet_helper.py
+        subnet_ids = list(fleet_settings.get('subnet_ids') or [])
+        if attempt:
+            # Follow-up fleets replace capacity that was lost or never came up, optionally from other subnets
+            # or on demand
+            if backfill['on_demand']:
+                on_demand = count
+            if backfill['subnet_ids']:
+                subnet_ids = (subnet_ids or [config['subnet_id']]) + [subnet_id for subnet_id in backfill['subnet_ids'] if subnet_id not in subnet_ids and subnet_id != config['subnet_id']]
+        overrides = build_fleet_overrides(fleet_instance_types(config, fleet_instance_type), subnet_ids, fleet_settings.get('max_price'))
+        with tracer.span('create_ec2_fleet', region=region, instance_type=fleet_instance_type, count=count, attempt=attempt, pools=len(overrides)) as span:
+            fleet_id, instance_ids = create_ec2_fleet(ec2_client, args, launch_template_id, count, on_demand, count - on_demand, fleet_instance_type, launch_template_version, overrides=overrides, tags=run_tags(journal.run_id, expiry['fleet_hours']))
+            span['launched'] = len(instance_ids)
+        fleet_ids.append((ec2_client, region, fleet_id))
+        journal.fleet_created(region, fleet_id, instance_ids)
+        return fleet_id, instance_ids
+
+    def finish_fleet(fleet_id):
+        # Instances stop themselves once their job has run, so each wave's fleet can go as soon as it is done
+        if not args.keep:
+            with tracer.span('cleanup', region=region, fleet_id=fleet_id):
+                deleted = delete_ec2_fleet(ec2_client, fleet_id)
+            if deleted:
+                # Otherwise cleanup_resources() tries again at the end of the run
+                journal.fleet_deleted(region, fleet_id)
+                fleet_ids.remove((ec2_client, region, fleet_id))
+
+    def launch_instances(instance_type, count):
+        with tracer.span('launch_warm_instances', region=region, instance_type=instance_type, count=count):
+            return launch_warm_instances(ec2_client, launch_template_id, launch_template_version, instance_type, count, template_name, tags=run_tags(journal.run_id, expiry['launch_template_hours']))
+
+    # Each instance runs as a coroutine pipeline on one event loop, with per-stage concurrency limits
+    def make_pipeline(orchestrator, instance_id, job_queue):
+        return instance_worker(orchestrator, ec2_client, ec2_instance_connect, args, config, instance_id, job_queue, key_provider, serial_console_endpoint)
+
+    def make_warm_pipeline(orchestrator, instance_id, job_queue):
+        return warm_instance_worker(orchestrator, ec2_client, ec2_instance_connect, args, config, instance_id, job_queue, key_provider, serial_console_endpoint)
+
+    return {
+        'region': region,
+        'state_tracker': state_tracker,
+        'total_capacity': total_capacity,
+        'backfill': backfill,
+        'launch_fleet': launch_fleet,
+        'finish_fleet': finish_fleet,
+        'make_pipeline': make_pipeline,
+        'make_warm_pipeline': make_warm_pipeline,
+        'launch_instances': launch_instances,
+        'find_warm_instances': partial(find_warm_instances, ec2_client, template_name, launch_template_id, launch_template_version),
+        'trim_warm_pool': partial(trim_warm_pool, ec2_client, template_name, warm_pool.get('max_size', total_capacity), launch_template_id, launch_template_version),
+    }
+
+def report_startup(command):
+    print(f"automate.py {command} ready in {(time.monotonic() - STARTED) * 1000:.0f} ms.")
+
+def add_fleet_arguments(parser):
     parser.add_argument(
         '--userdata',
         type=str,
@@ -133,43 +394,125 @@ def fleet_main():
         help='Keep the EC2 instances, Fleet and Launch Template on script exit'
     )
 
-    # Parse the command-line arguments
-    args = parser.parse_args()
+    parser.add_argument(
+        '--trace',
+        type=str,
+        default=None,
+        help='Append a JSON line per stage and instance, with its duration, to this file.'
+    )
+
+    parser.add_argument(
+        '--boot-mode',
+        choices=BOOT_MODES,
+        default=None,
+        help='How instances get their kernel arguments, overriding boot_mode in the config: the GRUB menu over the serial console, or kexec or grub-editenv from the userdata on a stock AMI.'
+    )
+
+    parser.add_argument(
+        '--build-ami',
+        action='store_true',
+        help='Build the AMI from base_ami_id in the ami_build section of the config, or reuse the one built from the same inputs before, and use it instead of ami_id.'
+    )
+
+    parser.add_argument(
+        '--journal',
+        type=str,
+        default=DEFAULT_JOURNAL_FILE,
+        help=f'Record every fleet and launch template created, and how far each job got, in this file. Default is "{DEFAULT_JOURNAL_FILE}".'
+    )
+
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help='Resume the run recorded in the journal: skip the jobs it completed, wait for the instances it had booted and run the rest.'
+    )
 
+    parser.add_argument(
+        '--check',
+        action='store_true',
+        help='Only check the config and userdata script and list the jobs, without calling AWS.'
+    )
+
+def fleet_main(args):
+    # Everything that can be checked without AWS is checked before anything is launched
+    overrides = {}
+    if args.boot_mode:
+        overrides['boot_mode'] = {'mode': args.boot_mode}
+    if args.build_ami:
+        overrides['ami_build'] = {'enabled': True}
+    config = load_config(args.config, 'fleet', overrides)
+    # How instances get their kernel arguments - see ec2_boot_mode_helper.py
+    boot_mode = load_boot_mode(config)
+
+    userdata_script = args.userdata
+    if not os.path.exists(userdata_script):
+        print(f"Error: Userdata script {userdata_script} not found!")
+        return 1
+    elif args.debug:
+        print(f"Using Userdata script: {userdata_script}")
+    # The {{NAME}} placeholders of the script take their values from the userdata section - see ec2_userdata_helper.py
     try:
+        userdata = render_userdata(load_userdata(userdata_script), load_userdata_settings(config)['variables'])
+    except ValueError as e:
+        print(f"Error: {e}")
+        return 1
 
-        # Load configuration from the YAML file (default or specified)
-        config_file = args.config
-        if not os.path.exists(config_file):
-            print(f"Error: Configuration file {config_file} not found!")
-            return
+    # One job per instance boot - a single kernel_arguments string, or every combination in the 'sweep' section
+    jobs = expand_jobs(config)
+    long_argument_jobs = [] if uses_serial_console(boot_mode) else jobs_with_long_arguments(jobs)
+    if long_argument_jobs:
+        print(f"Error: {len(long_argument_jobs)} jobs have kernel arguments too long for the userdata to read from a tag in the {boot_mode['mode']} boot mode - use the console boot mode for them.")
+        return 1
+    if args.check:
+        # Neither of these imports paramiko or botocore, so checking a config stays quick
+        from ec2_host_keys import check_host_keys
+        from ec2_region_helper import region_configs
+        report_startup('fleet')
+        if uses_serial_console(boot_mode):
+            if not check_host_keys(config, [region_config['serial_console_endpoint'] for region_config in region_configs(config)]):
+                return 1
+        print(f"{args.config} is valid: {len(jobs)} jobs in {len(config.get('regions') or [None])} region(s), {boot_mode['mode']} boot mode.")
+        if (config.get('ami_build') or {}).get('enabled'):
+            print(f"The AMI is built from {config['ami_build']['base_ami_id']} first, or reused if built from the same inputs before.")
+        for job in jobs:
+            print(f"  {job['job_id']}: {job['instance_type']} {job['kernel_arguments']} (repetition {job['repetition']})")
+        return
+
+    from ec2_client_pool import client_pool_from_config
+    from ec2_fleet_orchestrator import load_concurrency
+    from ec2_region_helper import region_configs
+    from ec2_host_keys import check_host_keys, report_first_use
+    report_startup('fleet')
 
-        config = load_config(config_file)
+    # Serial console endpoints without a trusted host key would fail every job, so find out before launching any
+    if uses_serial_console(boot_mode) and not check_host_keys(config, [region_config['serial_console_endpoint'] for region_config in region_configs(config)]):
+        return 1
 
-        userdata_script = args.userdata
-        if not os.path.exists(userdata_script):
-            print(f"Error: Userdata script {userdata_script} not found!")
-            return
-        elif args.debug:
-            print(f"Using Userdata script: {userdata_script}")
+    # Kept resources are left alone on Ctrl+C as on any other exit
+    if not args.keep:
+        signal.signal(signal.SIGINT, signal_handler)
+        signal.signal(signal.SIGTERM, signal_handler)
 
-        userdata = load_userdata(userdata_script)
+    if args.trace:
+        tracer.open(args.trace)
 
-        ami_id = config['ami_id']
+    try:
+        # Use config.get to prevent exceptions if an optional dictionary element does not exist - in a multi-region
+        # run, the regional settings may be given per region instead (see ec2_region_helper.py)
+        ami_id = config.get('ami_id')
         instance_type = config['instance_type']
         key_name = config['key_name']
-        security_group_ids = config['security_group_ids']
-        subnet_id = config['subnet_id']
-        # Use config.get to prevent exceptions if an optional dictionary element does not exist
+        security_group_ids = config.get('security_group_ids')
+        subnet_id = config.get('subnet_id')
         aws_profile = config.get('aws_profile')
 
         # Serial Console endpoint, as documented here: https://docs.aws.amazon.com/AWSEC2/latest/UserGuide/connect-to-serial-console.html#sc-endpoints-and-fingerprints
-        serial_console_endpoint = config['serial_console_endpoint']
+        serial_console_endpoint = config.get('serial_console_endpoint')
         # SSH username and key path (replace with your key and username)
-        private_key_file_path = config['private_key_file_path']
+        private_key_file_path = config.get('private_key_file_path')
         # Kernel command line arguments to pass
         # isolcpus=1,2,3 will (on a 4 core system) mean that commands are scheduled only on core 0
-        kernel_arguments = config['kernel_arguments']
+        kernel_arguments = config.get('kernel_arguments')
 
         # Launch template specifics
         # Launch template name
@@ -177,9 +520,12 @@ def fleet_main():
         iam_instance_profile_arn = config['iam_instance_profile_arn']
 
         # Fleet specifics
-        total_capacity = config['total_capacity']
-        on_demand_capacity = config['on_demand_capacity']
-        spot_capacity = config['spot_capacity']
+        total_capacity = config.get('total_capacity')
+        on_demand_capacity = config.get('on_demand_capacity')
+        spot_capacity = config.get('spot_capacity')
+
+        # Per-stage concurrency limits for the orchestrator
+        concurrency = load_concurrency(config)
 
         # Debug mode actions
         if args.debug:
@@ -194,72 +540,200 @@ def fleet_main():
             print(f"Serial Console Endpoint: {serial_console_endpoint}")
             print(f"Private Key File Path: {private_key_file_path}")
             print(f"Kernel Arguments: {kernel_arguments}")
+            print(f"Boot Mode: {boot_mode['mode']}")
             print(f"Launch template name: {template_name}")
             print(f"IAM Instance Profile ARN: {iam_instance_profile_arn}")
             print(f"Total Fleet Capacity: {total_capacity}")
             print(f"On Demand Capacity: {on_demand_capacity}")
             print(f"Spot Capacity: {spot_capacity}")
+            print(f"Concurrency: {concurrency}")
+            print(f"Jobs: {len(jobs)}")
+            for job in jobs:
+                print(f"  {job['job_id']}: {job['instance_type']} {job['kernel_arguments']} (repetition {job['repetition']})")
 
-        # Initialize a session using the specified profile
-        session = boto3.Session(profile_name=aws_profile)
-
-        # Initialize the EC2 client
-        ec2_client = session.client('ec2')
-        ec2_instance_connect = session.client('ec2-instance-connect')
-
-        # Create the Launch Template if it doesn't already exist
-        # Create a launch template
-        launch_template_id = create_launch_template(
-            ec2_client,
-            template_name,
-            ami_id,
-            instance_type,
-            key_name,
-            security_group_ids,
-            subnet_id,
-            iam_instance_profile_arn,
-            userdata
-        )
+        # Every resource the run creates and every stage its jobs reach goes in the journal, so that an interrupted
+        # run can be resumed or cleaned up after - a journal with resources still live belongs to such a run
+        resume = None
+        state = load_journal(args.journal)
+        if args.resume:
+            print(f"Resuming from {args.journal}: {len(state.jobs)} jobs recorded, {len(state.fleets)} fleets still live.")
+            resume = state
+        elif state.live_resources():
+            print(f"Error: {args.journal} lists {len(state.live_resources())} fleets and launch templates left by an earlier run. "
+                  f"Resume it with --resume, delete them with 'python automate.py cleanup', or pass another --journal.")
+            return 1
+        journal.open(args.journal, resume=args.resume, run_id=state.run_id if args.resume else None)
 
-        # Create an EC2 Fleet request using the created (or existing) launch template
-        fleet_id, instance_ids = create_ec2_fleet(ec2_client, args, launch_template_id, total_capacity, on_demand_capacity, spot_capacity)
+        # Initialize a session using the specified profile. Clients are created once, with a connection
+        # pool sized for the concurrency limits, and shared by every stage of the run.
+        client_pool = client_pool_from_config(config, concurrency)
 
-        # Generate a temporary SSH key pair
-        print("Generating temporary SSH key pair...")
-        private_key, public_key = generate_ssh_key_pair(args, private_key_file_path)
+        # Build the GRUB-enabled AMI first if asked to - unchanged inputs return the AMI built before straight away
+        if (config.get('ami_build') or {}).get('enabled'):
+            from ec2_ami_build_helper import load_ami_build, build_ami
+            ami_build = load_ami_build(config)
+            with tracer.span('build_ami'):
+                config['ami_id'] = build_ami(client_pool.client('ec2'), config, ami_build, run_id=journal.run_id)
+            if config['ami_id'] is None:
+                return 1
+            # The built AMI shows the GRUB menu for its grub_timeout, unless the config says otherwise
+            config['serial_console'] = dict({'grub_timeout': ami_build['grub_timeout']}, **(config.get('serial_console') or {}))
 
-        threads = []
-        for instance_id in instance_ids:
-            thread = threading.Thread(target=instance_worker, args=(ec2_client, ec2_instance_connect, args, instance_id, public_key, private_key, serial_console_endpoint, kernel_arguments))
-            threads.append(thread)
-            thread.start()
+        # Initialize the EC2 clients - one pair per region of a multi-region run, otherwise for the profile's region
+        regions = []
+        for region_config in region_configs(config):
+            region_name = region_config.get('region')
+            regions.append((region_config, client_pool.client('ec2', region_name), client_pool.client('ec2-instance-connect', region_name)))
+            if args.debug and region_name:
+                print(f"Region {region_name}: capacity {region_config['total_capacity']}, serial console endpoint {region_config['serial_console_endpoint']}")
 
-        # Wait for all threads to complete
-        for thread in threads:
-            thread.join()
+        completed, failed = run_jobs_in_regions(args, regions, userdata, jobs, concurrency, resume)
+        print(f"{len(completed)} of {len(jobs)} jobs completed.")
+        # Jobs may have run on a stand-in instance type from fleet_overrides, so say what they actually ran on
+        launched_types = {}
+        for job in completed:
+            placement = (job.get('launched_instance_type'), job.get('availability_zone'))
+            launched_types[placement] = launched_types.get(placement, 0) + 1
+        for (launched_type, availability_zone), count in sorted(launched_types.items(), key=str):
+            print(f"  {count} jobs ran on {launched_type} in {availability_zone}")
+        for job in failed:
+            print(f"Job {job['job_id']} failed: {job['instance_type']} {job['kernel_arguments']}")
 
         print("All operations completed.")
+        # Non-zero if any job failed, so a scheduler can tell a partial sweep from a complete one
+        return 1 if failed else 0
     except Exception as e:
         print(f"An error occurred: {e}")
+        return 1
 
     finally:
         # Cleanup the fleet and launch template after execution
-        if ec2_client is not None and not args.keep:
-            cleanup_resources(ec2_client)
+        if not args.keep:
+            with tracer.span('cleanup'):
+                cleanup_resources()
+
+        tracer.print_summary()
+        rate_limiter.print_summary()
+        report_first_use()
+        tracer.close()
+        journal.close()
 
-def instance_main():
-    global fleet_id, launch_template_id
-    # Set up argument parser
-    parser = argparse.ArgumentParser(description="EC2 instance configuration and launcher script.")
 
-    # Option to specify the config file (default is config.yaml)
+def add_cleanup_arguments(parser):
     parser.add_argument(
-        '--config',
+        '--journal',
         type=str,
-        default='config.yaml',
-        help='Path to the configuration YAML file. Default is "config.yaml".'
+        default=DEFAULT_JOURNAL_FILE,
+        help=f'Journal of the run to clean up after. Default is "{DEFAULT_JOURNAL_FILE}".'
+    )
+
+    parser.add_argument(
+        '--dry-run',
+        action='store_true',
+        help='Only list what would be deleted.'
     )
 
+def cleanup_main(args):
+    if not os.path.exists(args.journal):
+        print(f"Error: Journal {args.journal} not found!")
+        return 1
+    state = load_journal(args.journal)
+    report_startup('cleanup')
+    if state.damaged:
+        print(f"Skipped {state.damaged} unreadable lines of {args.journal}, e.g. one cut short by a crash.")
+    live_templates = {launch_template_id: template for launch_template_id, template in state.launch_templates.items() if not template['keep']}
+    if not state.fleets and not live_templates:
+        print(f"Nothing left to clean up in {args.journal}.")
+        return
+
+    for fleet_id, fleet in state.fleets.items():
+        print(f"Fleet {fleet_id} ({fleet['region'] or 'default region'}): {len(fleet['instance_ids'])} instances")
+    for launch_template_id, template in live_templates.items():
+        print(f"Launch Template {launch_template_id} ({template['region'] or 'default region'})")
+    if args.dry_run:
+        return
+
+    from ec2_client_pool import client_pool_from_config
+    from ec2_fleet_helper import delete_ec2_fleet
+    from ec2_launchtemplate_helper import delete_launch_template
+    from ec2_region_helper import launch_template_cache_file
+
+    config = load_config(args.config, 'cleanup') if os.path.exists(args.config) else {}
+    client_pool = client_pool_from_config(config)
+    # Deletions go in the journal too, so running cleanup again only retries what failed
+    journal.open(args.journal, resume=True, command='cleanup')
+    try:
+        for fleet_id, fleet in state.fleets.items():
+            if delete_ec2_fleet(client_pool.client('ec2', fleet['region']), fleet_id):
+                journal.fleet_deleted(fleet['region'], fleet_id)
+        for launch_template_id, template in live_templates.items():
+            if delete_launch_template(client_pool.client('ec2', template['region']), launch_template_id, launch_template_cache_file(config, template['region'])):
+                journal.launch_template_deleted(template['region'], launch_template_id)
+    finally:
+        journal.close()
+
+def add_sweep_arguments(parser):
+    parser.add_argument(
+        '--region',
+        type=str,
+        action='append',
+        default=None,
+        help='A region to sweep. May be given more than once. Defaults to the regions of the config, or the profile\'s region.'
+    )
+
+    parser.add_argument(
+        '--run-id',
+        type=str,
+        default=None,
+        help='Sweep the fleets and launch templates of this run, whether they have expired or not - e.g. after a run with --keep.'
+    )
+
+    parser.add_argument(
+        '--journal',
+        type=str,
+        default=DEFAULT_JOURNAL_FILE,
+        help=f'Record what is deleted in this journal, if it exists, so cleanup and status know. Default is "{DEFAULT_JOURNAL_FILE}".'
+    )
+
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=None,
+        help='Describe and delete calls in flight at once. Defaults to workers in the resource_expiry section of the config, or 16.'
+    )
+
+    parser.add_argument(
+        '--dry-run',
+        action='store_true',
+        help='Only list what would be deleted.'
+    )
+
+def sweep_main(args):
+    config = load_config(args.config, 'sweep') if os.path.exists(args.config) else {}
+    regions = args.region or [region['region'] for region in config.get('regions') or []] or [None]
+
+    from ec2_client_pool import client_pool_from_config
+    from ec2_resource_sweeper import load_resource_expiry, sweep_resources
+    report_startup('sweep')
+
+    workers = args.workers or load_resource_expiry(config)['workers']
+
+    client_pool = client_pool_from_config(config, {'executor_workers': workers})
+    swept = sweep_resources({region: client_pool.client('ec2', region) for region in regions}, workers, args.run_id, args.dry_run)
+    if not args.dry_run and os.path.exists(args.journal):
+        journal.open(args.journal, resume=True, command='sweep')
+        try:
+            for region, fleet_ids in swept['fleets'].items():
+                for fleet_id in fleet_ids:
+                    journal.fleet_deleted(region, fleet_id)
+            for region, launch_template_ids in swept['launch_templates'].items():
+                for launch_template_id in launch_template_ids:
+                    journal.launch_template_deleted(region, launch_template_id)
+        finally:
+            journal.close()
+    rate_limiter.print_summary()
+
+def add_instance_arguments(parser):
     # Option to enable debug mode
     parser.add_argument(
         '--debug',
@@ -267,23 +741,25 @@ def instance_main():
         help='Enable debug mode to perform additional actions.'
     )
 
-    # Parse the command-line arguments
-    args = parser.parse_args()
-
+def instance_main(args):
     # Load configuration from the YAML file (default or specified)
-    config_file = args.config
-    if not os.path.exists(config_file):
-        print(f"Error: Configuration file {config_file} not found!")
-        return
+    config = load_config(args.config, 'instance')
 
-    config = load_config(config_file)
+    from ec2_client_pool import client_pool_from_config
+    from ec2_enable_serial_helper import enable_serial_console
+    from ec2_get_instance_ip_helper import get_instance_ip
+    from ec2_key_provider import key_provider_from_config
+    from ec2_send_serial_console_public_key import send_serial_console_key
+    from ec2_send_serial_commands import connect_serial_console
+    from ec2_host_keys import check_host_keys, report_first_use
+    report_startup('instance')
 
     ami_id = config['ami_id']
     instance_type = config['instance_type']
     key_name = config['key_name']
     security_group_ids = config['security_group_ids']
     subnet_id = config['subnet_id']
-    aws_profile = config['aws_profile']
+    aws_profile = config.get('aws_profile')
     # Serial Console endpoint, as documented here: https://docs.aws.amazon.com/AWSEC2/latest/UserGuide/connect-to-serial-console.html#sc-endpoints-and-fingerprints
     serial_console_endpoint = config['serial_console_endpoint']
     # SSH username and key path (replace with your key and username)
@@ -306,12 +782,16 @@ def instance_main():
         print(f"Private Key File Path: {private_key_file_path}")
         print(f"Kernel Arguments: {kernel_arguments}")
 
+    # Check the serial console host key can be trusted before launching an instance that could not be driven
+    if not check_host_keys(config, [serial_console_endpoint]):
+        return 1
+
     # Initialize a session using the specified profile
-    session = boto3.Session(profile_name=aws_profile)
+    client_pool = client_pool_from_config(config)
 
     # Initialize the EC2 client
-    ec2_client = session.client('ec2')
-    ec2_instance_connect = session.client('ec2-instance-connect')
+    ec2_client = client_pool.client('ec2')
+    ec2_instance_connect = client_pool.client('ec2-instance-connect')
 
     # Step 1: Launch EC2 instance
     instance_id = launch_ec2_instance(ec2_client, ami_id, instance_type, key_name, security_group_ids, subnet_id)
@@ -331,17 +811,235 @@ def instance_main():
 
     # Step 4 - generate a temporary SSH key pair
     print("Generating temporary SSH key pair...")
-    private_key, public_key = generate_ssh_key_pair(args, private_key_file_path)
+    key_provider = key_provider_from_config(config)
 
     # Step 5 - send the SSH public key to the instance serial console
     print("Sending SSH public key to the instance serial console...")
-    send_serial_console_ssh_public_key(ec2_instance_connect, instance_id, public_key)
+    ssh_key = send_serial_console_key(ec2_instance_connect, key_provider, instance_id)
+    write_private_key(args, ssh_key, private_key_file_path)
 
     # Step 6 - connect to the serial console and send keystrokes
     print("Connecting to the serial console and sending keystrokes...")
-    # Connect to serial console and send keystrokes
-    connect_serial_console(serial_console_endpoint, instance_id, private_key, kernel_arguments)
+    # Connect to serial console and send keystrokes, checking its host key against the ones configured above
+    connect_serial_console(serial_console_endpoint, instance_id, ssh_key.pkey, kernel_arguments)
+    report_first_use()
     print("EC2 instance setup completed.")
 
+
+def add_build_ami_arguments(parser):
+    parser.add_argument(
+        '--base-ami',
+        type=str,
+        default=None,
+        help='AMI to build from, overriding base_ami_id in the ami_build section of the config.'
+    )
+
+    parser.add_argument(
+        '--rebuild',
+        action='store_true',
+        help='Build a new AMI even if one was built from the same inputs before.'
+    )
+
+    parser.add_argument(
+        '--keep-builder',
+        action='store_true',
+        help='Leave the builder instance for inspection if the build fails, rather than terminating it.'
+    )
+
+def build_ami_main(args):
+    config = load_config(args.config, 'build-ami', {'ami_build': {'base_ami_id': args.base_ami}} if args.base_ami else None)
+
+    from ec2_client_pool import client_pool_from_config
+    from ec2_ami_build_helper import load_ami_build, build_ami
+    report_startup('build-ami')
+
+    client_pool = client_pool_from_config(config)
+    image_id = build_ami(client_pool.client('ec2'), config, load_ami_build(config), args.rebuild, args.keep_builder)
+    if image_id is None:
+        return 1
+    # The last line is the setting to use, for scripts as much as for people
+    print(f"ami_id: \"{image_id}\"")
+
+def add_collect_arguments(parser):
+    parser.add_argument(
+        '--source',
+        type=str,
+        default=None,
+        help='Where the results are, as s3://bucket/prefix or a local directory. Defaults to source in the results section of the config.'
+    )
+
+    parser.add_argument(
+        '--store',
+        type=str,
+        default=None,
+        help='Directory of the local result store. Defaults to store_dir in the results section of the config, or "results".'
+    )
+
+    parser.add_argument(
+        '--journal',
+        type=str,
+        default=DEFAULT_JOURNAL_FILE,
+        help=f'Journal of the run, to attribute each result to its run and job. Default is "{DEFAULT_JOURNAL_FILE}".'
+    )
+
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=None,
+        help='Downloads in flight at the same time. Defaults to workers in the results section of the config, or 16.'
+    )
+
+def collect_main(args):
+    config = load_config(args.config, 'collect') if os.path.exists(args.config) else {}
+    settings = load_results_settings(config)
+    location = args.source or settings['source']
+    if not location:
+        print("Error: No result source - pass --source or set source in the results section of the config.")
+        return 1
+    workers = args.workers or settings['workers']
+
+    from ec2_client_pool import client_pool_from_config
+    from ec2_results_collector import collect_results, result_source
+    report_startup('collect')
+
+    # One connection per download thread, on top of the rate limiter's S3 bucket
+    client_pool = client_pool_from_config(config, {'executor_workers': workers}) if location.startswith('s3://') else None
+    collect_results(result_source(location, client_pool), args.store or settings['store_dir'], workers, args.journal)
+    rate_limiter.print_summary()
+
+def add_analyze_arguments(parser):
+    parser.add_argument(
+        '--store',
+        type=str,
+        default=None,
+        help='Directory of the local result store. Defaults to store_dir in the results section of the config, or "results".'
+    )
+
+    parser.add_argument(
+        '--baseline',
+        type=str,
+        default=None,
+        help='Kernel arguments to compare the others with. Defaults to baseline in the analysis section of the config, or the set with the fewest arguments.'
+    )
+
+    parser.add_argument(
+        '--metric',
+        type=str,
+        action='append',
+        default=None,
+        help='A metric to report, as a dotted path into results_all.yml, e.g. Benchmark.runtime_seconds. May be given more than once. Default is every numeric field.'
+    )
+
+    parser.add_argument('--run-id', type=str, default=None, help='Only analyze the results of this run.')
+    parser.add_argument('--instance-type', type=str, default=None, help='Only analyze the results of this instance type.')
+    parser.add_argument('--json', type=str, default=None, help='Also write the report to this file as JSON.')
+
+def analyze_main(args):
+    config = load_config(args.config, 'analyze') if os.path.exists(args.config) else {}
+    analysis = config.get('analysis') or {}
+    store_dir = args.store or load_results_settings(config)['store_dir']
+    if not os.path.isdir(store_dir):
+        print(f"Error: Result store {store_dir} not found - run 'python automate.py collect' first.")
+        return 1
+
+    from ec2_results_analysis import analyze_results, print_report, write_report
+    report_startup('analyze')
+
+    report = analyze_results(store_dir, args.baseline or analysis.get('baseline'), args.run_id, args.instance_type, args.metric or analysis.get('metrics'))
+    print_report(report)
+    if args.json:
+        write_report(report, args.json)
+
+def add_status_arguments(parser):
+    parser.add_argument(
+        '--journal',
+        type=str,
+        default=DEFAULT_JOURNAL_FILE,
+        help=f'Journal of the run to report on. Default is "{DEFAULT_JOURNAL_FILE}".'
+    )
+
+    parser.add_argument(
+        '--json',
+        action='store_true',
+        help='Print the status as one JSON object, for schedulers.'
+    )
+
+def status_main(args):
+    if not os.path.exists(args.journal):
+        print(f"Error: Journal {args.journal} not found!")
+        return 1
+    state = load_journal(args.journal)
+    stages = {stage: 0 for stage in JOB_STAGES}
+    for record in state.jobs.values():
+        stages[record['stage']] = stages.get(record['stage'], 0) + 1
+    live_templates = [launch_template_id for launch_template_id, template in state.launch_templates.items() if not template['keep']]
+    if args.json:
+        print(json.dumps({
+            'journal': args.journal,
+            'run_id': state.run_id,
+            'runs': state.runs,
+            'jobs': stages,
+            'fleets': state.fleets,
+            'launch_templates': live_templates,
+            'damaged_lines': state.damaged,
+        }, sort_keys=True))
+        return
+    report_startup('status')
+
+    print(f"{args.journal}: {state.runs} runs recorded, the last fleet run {state.run_id or 'none'}.")
+    print("Jobs by the last stage they reached: " + ', '.join(f"{count} {stage}" for stage, count in stages.items()))
+    for fleet_id, fleet in state.fleets.items():
+        print(f"Fleet {fleet_id} ({fleet['region'] or 'default region'}) is still live, with {len(fleet['instance_ids'])} instances.")
+    for launch_template_id in live_templates:
+        print(f"Launch Template {launch_template_id} ({state.launch_templates[launch_template_id]['region'] or 'default region'}) is still live.")
+    if state.fleets or live_templates:
+        print("Resume the run with 'python automate.py fleet --resume', or delete them with 'python automate.py cleanup'.")
+    if state.damaged:
+        print(f"Skipped {state.damaged} unreadable lines, e.g. one cut short by a crash.")
+
+# Subcommand name: (argument setup, entry point, description)
+SUBCOMMANDS = {
+    'fleet': (add_fleet_arguments, fleet_main, "Run every job of the config on fleets of EC2 instances, each booted with its kernel arguments."),
+    'sweep': (add_sweep_arguments, sweep_main, "Find the fleets and launch templates of any run that have expired, by their tags, and delete them in every region at once."),
+    'instance': (add_instance_arguments, instance_main, "Launch a single EC2 instance and boot it with the config's kernel_arguments over the serial console."),
+    'build-ami': (add_build_ami_arguments, build_ami_main, "Build a GRUB-enabled AMI from a stock one with the AMI_Prep scripts, or return the one built from the same inputs before."),
+    'cleanup': (add_cleanup_arguments, cleanup_main, "Delete the fleets and launch templates that an interrupted run, or one with --keep, left behind, as listed in its journal."),
+    'collect': (add_collect_arguments, collect_main, "Download the results uploaded by the instances of fleet runs into a local store, skipping those already collected."),
+    'analyze': (add_analyze_arguments, analyze_main, "Compare the collected results of each set of kernel arguments with a baseline set, per instance type."),
+    'status': (add_status_arguments, status_main, "Report what the journal says about the last run: how far its jobs got and what it left live."),
+}
+
+def build_parser():
+    # Options every subcommand takes
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument(
+        '--config',
+        type=str,
+        default='config.yaml',
+        help='Path to the configuration YAML file. Default is "config.yaml".'
+    )
+
+    parser = argparse.ArgumentParser(description="EC2 instance configuration and launcher script.", epilog="Without a subcommand, runs fleet.")
+    subparsers = parser.add_subparsers(dest='command', metavar='command')
+    for name, (add_arguments, main, description) in SUBCOMMANDS.items():
+        subparser = subparsers.add_parser(name, parents=[common], help=description, description=description)
+        add_arguments(subparser)
+        subparser.set_defaults(main=main)
+    return parser
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    # "automate.py --config ..." runs a fleet, as it did before there were subcommands
+    if not argv or (argv[0] not in SUBCOMMANDS and argv[0] not in ('-h', '--help')):
+        argv = ['fleet'] + argv
+    args = build_parser().parse_args(argv)
+    try:
+        return args.main(args)
+    except ConfigError as e:
+        print(f"Error: {e.filename} cannot be used:")
+        for problem in e.problems:
+            print(f"  - {problem}")
+        return 1
+
 if __name__ == "__main__":
-    fleet_main()
+    sys.exit(main())
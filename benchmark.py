@@ -0,0 +1,352 @@
+# benchmark.py
+#
+# Run the fleet orchestration against the local simulator in ec2_simulator.py, for fleets of several sizes, and
+# report throughput, API call counts and per-stage latency. Nothing here talks to AWS.
+#
+# $ python benchmark.py --sizes 10 100 1000
+
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+import automate
+from ec2_fleet_orchestrator import load_concurrency
+from ec2_simulator import SimulatedCloud, SimulatedEc2Client, SimulatedInstanceConnectClient, SimulatedClientPool, SimulatedS3Client, SerialConsoleServer, upload_simulated_results
+from ec2_rate_limiter import rate_limiter
+from ec2_region_helper import region_configs
+from ec2_host_keys import configure_host_keys, host_key_fingerprint
+from ec2_boot_mode_helper import BOOT_MODES
+from ec2_ami_build_helper import load_ami_build, build_ami
+from ec2_fleet_helper import create_ec2_fleet
+from ec2_launchtemplate_helper import create_launch_template
+from ec2_resource_sweeper import run_tags, sweep_resources
+from ec2_results_collector import S3ResultSource, ResultStore, collect_results
+from ec2_run_journal import journal
+from ec2_sweep_helper import expand_jobs
+from ec2_trace_helper import tracer
+
+
+def benchmark_config(size, serial_console_endpoint, max_console_sessions, max_ec2_calls, jobs_per_instance=1, warm_pool=False, pools=1, grub_timeout=30.0, boot_mode='console'):
+    config = {
+        'ami_id': 'ami-00000000000000000',
+        'instance_type': 't4g.nano',
+        'key_name': 'benchmark',
+        'security_group_ids': ['sg-00000000000000000'],
+        'subnet_id': 'subnet-00000000000000000',
+        'serial_console_endpoint': serial_console_endpoint,
+        'private_key_file_path': os.devnull,
+        'kernel_arguments': 'isolcpus=1',
+        'launch_template_name': 'benchmark',
+        'iam_instance_profile_arn': 'arn:aws:iam::000000000000:instance-profile/benchmark',
+        'total_capacity': size,
+        'on_demand_capacity': 0,
+        'spot_capacity': size,
+        'concurrency': {
+            'max_console_sessions': max_console_sessions,
+            'max_ec2_calls': max_ec2_calls,
+        },
+        # Simulated instances change state in about a second, so poll faster than against EC2
+        'state_polling': {'min_interval': 0.25, 'max_interval': 1.0},
+        # Every benchmark starts from an empty simulator, so do not keep or reuse launch templates
+        'launch_template_cache': {'enabled': False, 'cache_file': os.path.join(tempfile.gettempdir(), 'benchmark_launch_template_cache.json')},
+        'warm_pool': {'enabled': warm_pool, 'max_size': 0},
+        # Simulated capacity comes back in seconds, so retry sooner than against EC2
+        'backfill': {'retry_delay': 0.5, 'max_retry_delay': 2.0},
+        # Simulated GRUB shows its menu about a second after 'running'
+        'serial_console': {'grub_timeout': grub_timeout, 'grub_delay': 1.0, 'retry_delay': 0.25, 'release_delay': 0.25},
+        'boot_mode': {'mode': boot_mode},
+    }
+    if pools > 1:
+        # Spread every fleet over one subnet per simulated availability zone
+        config['fleet_overrides'] = {'subnet_ids': [f"subnet-{index:017x}" for index in range(pools)]}
+    if jobs_per_instance > 1:
+        # A sweep of distinct kernel arguments, so every boot of an instance has to be driven through GRUB again
+        config['sweep'] = {'parameters': {'isolcpus': [str(cpu) for cpu in range(1, jobs_per_instance + 1)]}, 'repetitions': size}
+    return config
+
+
+def benchmark_collect(clouds, journal_file, options):
+    """Upload a result for every boot of the run to a simulated bucket, then collect them twice - the second
+    time there is nothing new, so it only lists the bucket."""
+    s3_client = SimulatedS3Client(api_latency=options.api_latency)
+    uploaded = upload_simulated_results(s3_client, 'benchmark', clouds.values())
+    region_name = next(iter(clouds))
+    client_pool = SimulatedClientPool({('s3', region_name): s3_client}, region_name, rate_limiter if options.rate_limit else None)
+    source = S3ResultSource(client_pool.client('s3'), 'benchmark', 'results/')
+    store_dir = tempfile.mkdtemp(prefix='benchmark-results-')
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            started = time.monotonic()
+            collected, _ = collect_results(source, store_dir, options.collect_workers, journal_file)
+            collect_seconds = time.monotonic() - started
+            started = time.monotonic()
+            recollected, _ = collect_results(source, store_dir, options.collect_workers, journal_file)
+            recollect_seconds = time.monotonic() - started
+        rows = list(ResultStore(store_dir).rows())
+    finally:
+        shutil.rmtree(store_dir)
+    return {
+        'objects': uploaded,
+        'collected': collected,
+        'seconds': round(collect_seconds, 2),
+        'recollected': recollected,
+        'incremental_seconds': round(recollect_seconds, 2),
+        'attributed': sum(1 for row in rows if row['job_id'] is not None),
+        'api_calls': dict(sorted(s3_client.calls.items())),
+    }
+
+
+def benchmark_build_ami(options):
+    """Build an AMI in the simulator, then build it again from the same inputs - the second time it comes from the
+    cache, without launching anything."""
+    cloud = SimulatedCloud(timings={'grub_timeout': options.grub_timeout}, api_latency=options.api_latency)
+    ec2_client = SimulatedClientPool({('ec2', 'sim-region-1'): SimulatedEc2Client(cloud)}, 'sim-region-1').client('ec2')
+    cache_dir = tempfile.mkdtemp(prefix='benchmark-ami-build-')
+    config = benchmark_config(1, None, 1, 1)
+    config['launch_template_cache'] = {'cache_file': os.path.join(cache_dir, 'launch_template_cache.json')}
+    config['ami_build'] = {'base_ami_id': 'ami-00000000000000000', 'cache_file': os.path.join(cache_dir, 'ami_build_cache.json'), 'poll_interval': 0.25}
+    settings = load_ami_build(config)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            started = time.monotonic()
+            image_id = build_ami(ec2_client, config, settings)
+            build_seconds = time.monotonic() - started
+            calls = sum(cloud.calls.values())
+            started = time.monotonic()
+            cached_image_id = build_ami(ec2_client, config, settings)
+            cached_seconds = time.monotonic() - started
+    finally:
+        shutil.rmtree(cache_dir)
+    return {
+        'image_id': image_id,
+        'seconds': round(build_seconds, 2),
+        'api_calls': calls,
+        'cached_image_id': cached_image_id,
+        'cached_seconds': round(cached_seconds, 3),
+        'cached_api_calls': sum(cloud.calls.values()) - calls,
+        'builders_launched': len(cloud.instances),
+    }
+
+
+def benchmark_sweep(options):
+    """Leave options.sweep expired fleets in every simulated region, each with its own expired launch template,
+    next to as many that have not expired, then time sweeping them all."""
+    region_names = [f"sim-region-{index + 1}" for index in range(options.regions)]
+    clouds = {region_name: SimulatedCloud(api_latency=options.api_latency, throttle_rate=options.throttle_rate, throttle_burst=options.throttle_burst) for region_name in region_names}
+    rate_limiter.configure(enabled=options.rate_limit)
+    client_pool = SimulatedClientPool({('ec2', region_name): SimulatedEc2Client(cloud) for region_name, cloud in clouds.items()}, region_names[0], rate_limiter if options.rate_limit else None)
+    clients = {region_name: client_pool.client('ec2', region_name) for region_name in clouds}
+    config = benchmark_config(1, None, 1, 1)
+    args = argparse.Namespace(debug=False)
+    cache_dir = tempfile.mkdtemp(prefix='benchmark-sweep-')
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            for region_name, ec2_client in clients.items():
+                for index in range(options.sweep * 2):
+                    # Every other run expired an hour ago, the rest expire in an hour
+                    tags = run_tags(f"leaked{index:04d}", -1 if index % 2 == 0 else 1)
+                    launch_template_id, version = create_launch_template(
+                        ec2_client, f"benchmark-{index}", config['ami_id'], config['instance_type'], config['key_name'], config['security_group_ids'], config['subnet_id'],
+                        config['iam_instance_profile_arn'], "#!/bin/sh\n", cache_file=os.path.join(cache_dir, f"{region_name}.json"), tags=tags
+                    )
+                    create_ec2_fleet(ec2_client, args, launch_template_id, 1, 0, 1, config['instance_type'], version, tags=tags)
+            before = sum(sum(cloud.calls.values()) for cloud in clouds.values())
+            started = time.monotonic()
+            swept = sweep_resources(clients, options.sweep_workers)
+            seconds = time.monotonic() - started
+    finally:
+        shutil.rmtree(cache_dir)
+    return {
+        'fleets': sum(len(fleet_ids) for fleet_ids in swept['fleets'].values()),
+        'launch_templates': sum(len(template_ids) for template_ids in swept['launch_templates'].values()),
+        'left': sum(len(cloud.fleets) + len(cloud.launch_templates) for cloud in clouds.values()),
+        'seconds': round(seconds, 2),
+        'api_calls': sum(sum(cloud.calls.values()) for cloud in clouds.values()) - before,
+    }
+
+
+def run_benchmark(size, options):
+    # Each simulated region has its own API limits, capacity and serial console
+    region_names = [f"sim-region-{index + 1}" for index in range(options.regions)]
+    clouds = {}
+    servers = {}
+    for region_name in region_names:
+        clouds[region_name] = SimulatedCloud(
+            timings={'grub_timeout': options.grub_timeout},
+            api_latency=options.api_latency,
+            throttle_rate=options.throttle_rate,
+            throttle_burst=options.throttle_burst,
+            capacity=options.capacity,
+            pool_capacity=options.pool_capacity,
+            interruption_rate=options.interruption_rate,
+            key_lifetime=options.key_lifetime,
+            max_console_sessions=options.console_session_limit
+        )
+        servers[region_name] = SerialConsoleServer(clouds[region_name]).start()
+    # Calls go through boto3 clients built like a run's, with botocore's retries and the shared rate limiter if
+    # it is enabled, and only the requests themselves are answered by the simulator
+    rate_limiter.configure(enabled=options.rate_limit)
+    simulated_clients = {}
+    for region_name, cloud in clouds.items():
+        simulated_clients[('ec2', region_name)] = SimulatedEc2Client(cloud)
+        simulated_clients[('ec2-instance-connect', region_name)] = SimulatedInstanceConnectClient(cloud)
+    client_pool = SimulatedClientPool(simulated_clients, region_names[0], rate_limiter if options.rate_limit else None)
+
+    config = benchmark_config(size, servers[region_names[0]].endpoint, options.max_console_sessions, options.max_ec2_calls, options.jobs_per_instance, options.warm_pool, options.pools, options.grub_timeout, options.boot_mode)
+    if options.regions > 1:
+        # The fleet size is shared out between the regions
+        config['regions'] = [
+            {'region': region_name, 'serial_console_endpoint': servers[region_name].endpoint, 'total_capacity': size // options.regions, 'spot_capacity': size // options.regions}
+            for region_name in region_names
+        ]
+    # Pin the host key of every simulated serial console, as a real run pins the published fingerprints
+    config['serial_console_host_keys'] = {'fingerprints': {server.endpoint: host_key_fingerprint(server.host_key) for server in servers.values()}}
+    configure_host_keys(config)
+    regions = []
+    for region_config in region_configs(config):
+        regions.append((
+            region_config,
+            client_pool.client('ec2', region_config.get('region')),
+            client_pool.client('ec2-instance-connect', region_config.get('region'))
+        ))
+    args = argparse.Namespace(debug=False, keep=False)
+    jobs = expand_jobs(config)
+    tracer.spans = []
+
+    # Collected results are matched to their jobs through the run journal
+    journal_file = None
+    if options.collect:
+        journal_file = os.path.join(tempfile.mkdtemp(prefix='benchmark-journal-'), 'run-journal.jsonl')
+        journal.open(journal_file)
+
+    output = contextlib.nullcontext() if options.verbose else contextlib.redirect_stdout(io.StringIO())
+    started = time.monotonic()
+    try:
+        with output:
+            completed, failed = automate.run_jobs_in_regions(args, regions, "#!/bin/sh\n", jobs, load_concurrency(config))
+            automate.cleanup_resources()
+    finally:
+        journal.close()
+        for server in servers.values():
+            server.stop()
+    elapsed = time.monotonic() - started
+
+    collect = {}
+    if options.collect:
+        collect = benchmark_collect(clouds, journal_file, options)
+        shutil.rmtree(os.path.dirname(journal_file))
+
+    expected = {job['job_id']: job['kernel_arguments'] for job in jobs}
+    instances = [instance for cloud in clouds.values() for instance in cloud.instances.values()]
+    booted_with_arguments = sum(
+        1 for instance in instances for job_id, cmdline in instance.boots
+        if cmdline and expected.get(job_id, '\0') in cmdline
+    )
+    api_calls = {}
+    for cloud in clouds.values():
+        for operation, count in cloud.calls.items():
+            api_calls[operation] = api_calls.get(operation, 0) + count
+
+    return {
+        'instances': size,
+        'jobs': len(jobs),
+        'instances_launched': len(instances),
+        'seconds': round(elapsed, 2),
+        'jobs_completed': len(completed),
+        'jobs_failed': len(failed),
+        'jobs_per_minute': round(len(completed) / elapsed * 60, 1),
+        'booted_with_arguments': booted_with_arguments,
+        'jobs_per_region': {region_name: sum(1 for job in completed if job.get('region') == region_name) for region_name in region_names} if options.regions > 1 else {},
+        'api_calls': dict(sorted(api_calls.items())),
+        'api_calls_total': sum(api_calls.values()),
+        'throttled': sum(cloud.throttled for cloud in clouds.values()),
+        'console_sessions': sum(server.sessions for server in servers.values()),
+        'console_sessions_refused': sum(server.refused for server in servers.values()),
+        'stages': tracer.summary()['stages'],
+        'rate_limiting': rate_limiter.stats() if options.rate_limit else {},
+        'collect': collect,
+    }
+
+
+def print_result(result):
+    print(f"{result['instances']} instances: {result['jobs_completed']} of {result['jobs']} jobs completed, {result['jobs_failed']} failed "
+          f"in {result['seconds']}s ({result['jobs_per_minute']} jobs/minute) on {result['instances_launched']} launched instances")
+    print(f"  booted with the requested kernel arguments: {result['booted_with_arguments']}")
+    for region_name, count in result['jobs_per_region'].items():
+        print(f"  jobs completed in {region_name}: {count}")
+    print(f"  serial console sessions: {result['console_sessions']}, {result['console_sessions_refused']} refused")
+    print(f"  API calls: {result['api_calls_total']} total, {result['throttled']} throttled")
+    for operation, count in result['api_calls'].items():
+        print(f"    {operation:<32} {count:>8}")
+    print(f"  {'stage':<24} {'count':>6} {'p50':>9} {'p95':>9} {'max':>9}")
+    for stage, stats in result['stages'].items():
+        print(f"  {stage:<24} {stats['count']:>6} {stats['p50']:>9.2f} {stats['p95']:>9.2f} {stats['max']:>9.2f}")
+    if result['rate_limiting']:
+        print(f"  {'rate limit family':<40} {'calls':>7} {'waits':>7} {'waited':>9} {'throttles':>10}")
+        for family, stats in result['rate_limiting'].items():
+            print(f"  {family:<40} {stats['calls']:>7} {stats['waits']:>7} {stats['wait_seconds']:>9.2f} {stats['throttles']:>10}")
+    collect = result['collect']
+    if collect:
+        print(f"  collect: {collect['collected']} of {collect['objects']} results in {collect['seconds']}s, {collect['attributed']} matched to their job, "
+              f"then {collect['recollected']} again in {collect['incremental_seconds']}s - S3 calls {collect['api_calls']}")
+
+
+def main():
+    # Simulated spot interruptions drop serial console sessions, which paramiko logs as socket errors
+    logging.getLogger('paramiko.transport').setLevel(logging.CRITICAL)
+    parser = argparse.ArgumentParser(description="Benchmark the fleet orchestration against a local EC2 and serial console simulator.")
+    parser.add_argument('--sizes', type=int, nargs='*', default=[10, 100, 1000], help='Fleet sizes to run. Default is 10 100 1000.')
+    parser.add_argument('--api-latency', type=float, default=0.02, help='Seconds added to every simulated API call. Default is 0.02.')
+    parser.add_argument('--throttle-rate', type=float, default=None, help='Simulated API calls per second before RequestLimitExceeded. Default is no limit.')
+    parser.add_argument('--throttle-burst', type=int, default=100, help='Simulated API call burst allowance. Default is 100.')
+    parser.add_argument('--capacity', type=int, default=None, help='Most simulated instances that may exist at once. Default is no limit.')
+    parser.add_argument('--pool-capacity', type=int, default=None, help='Most simulated instances that may exist at once per instance type and subnet. Default is no limit.')
+    parser.add_argument('--regions', type=int, default=1, help='Simulated regions to share each fleet size between, each with its own API limits, capacity and serial console. Default is 1.')
+    parser.add_argument('--pools', type=int, default=1, help='Subnets, one per availability zone, to spread each fleet over. Default is 1.')
+    parser.add_argument('--interruption-rate', type=float, default=0.0, help='Fraction of spot instances reclaimed before their job finishes. Default is 0.')
+    parser.add_argument('--rate-limit', action='store_true', help='Put the shared per API family rate limiter in front of the simulated API.')
+    parser.add_argument('--grub-timeout', type=float, default=30.0, help='Simulated GRUB menu timeout in seconds. Default is 30.')
+    parser.add_argument('--key-lifetime', type=float, default=60.0, help='Seconds a simulated serial console key stays valid. Default is 60.')
+    parser.add_argument('--console-session-limit', type=int, default=None, help='Simulated serial console sessions allowed at once before connections are refused. Default is no limit.')
+    parser.add_argument('--boot-mode', choices=BOOT_MODES, default='console', help='How simulated instances get their kernel arguments: over the serial console, or from the userdata with kexec or grub-editenv. Default is console.')
+    parser.add_argument('--max-console-sessions', type=int, default=20, help='Concurrent serial console sessions. Default is 20.')
+    parser.add_argument('--max-ec2-calls', type=int, default=10, help='Concurrent EC2 API calls. Default is 10.')
+    parser.add_argument('--jobs-per-instance', type=int, default=1, help='Jobs to run for each instance of the fleet size. Default is 1.')
+    parser.add_argument('--warm-pool', action='store_true', help='Restart stopped instances for each job instead of launching new ones.')
+    parser.add_argument('--collect', action='store_true', help='Upload a simulated result for every boot and time collecting them, then collecting again.')
+    parser.add_argument('--collect-workers', type=int, default=16, help='Concurrent downloads when collecting results. Default is 16.')
+    parser.add_argument('--build-ami', action='store_true', help='Time building the GRUB-enabled AMI, and building it again from the same inputs, before the fleet sizes.')
+    parser.add_argument('--sweep', type=int, default=0, help='Time sweeping this many expired fleets and launch templates per simulated region, next to as many that have not expired, before the fleet sizes.')
+    parser.add_argument('--sweep-workers', type=int, default=16, help='Concurrent calls when sweeping. Default is 16.')
+    parser.add_argument('--json', type=str, default=None, help='Also write the results to this file as JSON.')
+    parser.add_argument('--verbose', action='store_true', help='Show the output of the orchestration itself.')
+    options = parser.parse_args()
+
+    results = []
+    if options.build_ami:
+        build = benchmark_build_ami(options)
+        print(f"AMI build: {build['image_id']} in {build['seconds']}s with {build['api_calls']} API calls, "
+              f"then {build['cached_image_id']} again from the cache in {build['cached_seconds']}s with {build['cached_api_calls']} - {build['builders_launched']} builder launched")
+        results.append({'build_ami': build})
+    if options.sweep:
+        sweep = benchmark_sweep(options)
+        print(f"Sweep: {sweep['fleets']} fleets and {sweep['launch_templates']} launch templates in {options.regions} regions in {sweep['seconds']}s "
+              f"with {sweep['api_calls']} API calls, {sweep['left']} unexpired left")
+        results.append({'sweep': sweep})
+    for size in options.sizes:
+        result = run_benchmark(size, options)
+        print_result(result)
+        results.append(result)
+
+    if options.json:
+        with open(options.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
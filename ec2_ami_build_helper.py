@@ -0,0 +1,295 @@
+# ec2_ami_build_helper.py
+
+import hashlib
+import json
+import os
+import time
+from botocore.exceptions import ClientError
+from ec2_launchtemplate_helper import create_launch_template, load_template_cache, save_template_cache, DEFAULT_CACHE_FILE
+from ec2_resource_sweeper import load_resource_expiry, run_tags
+
+"""
+Example of AMI build settings in config.yaml:
+
+ami_build:
+  # Build the AMI before a fleet run and use it instead of ami_id - the same as passing --build-ami
+  enabled: true
+  # Stock AMI to build from, e.g. the official Ubuntu 24.04 AMI of the region
+  base_ami_id: "ami-0123456789abcdef0"
+  # GRUB_TIMEOUT of the built AMI - a fleet run that builds it uses this as grub_timeout under serial_console too
+  grub_timeout: 30
+  # Scripts the builder runs after enabling the GRUB menu, in order. The builder is imaged once it shuts down.
+  scripts: ["AMI_Prep/ubuntu-clean-for-ami.sh"]
+  # Builder instance type, of the base AMI's architecture - defaults to instance_type
+  instance_type: "t4g.small"
+  # Built AMIs are named <name_prefix>-<start of the hash of their inputs>
+  name_prefix: "grub-menu"
+  # Local index of built AMIs by the hash of their inputs
+  cache_file: ".ami_build_cache.json"
+  # Seconds to wait for the builder to shut down, and for the image to become available
+  builder_timeout: 1800
+  image_timeout: 3600
+  poll_interval: 15
+"""
+
+DEFAULT_AMI_BUILD = {
+    'enabled': False,
+    'base_ami_id': None,
+    'grub_timeout': 30,
+    'scripts': ['AMI_Prep/ubuntu-clean-for-ami.sh'],
+    'instance_type': None,
+    'name_prefix': 'grub-menu',
+    'cache_file': '.ami_build_cache.json',
+    'builder_timeout': 1800,
+    'image_timeout': 3600,
+    'poll_interval': 15,
+}
+
+# Built images and their snapshots carry the hash of their inputs in this tag, so they can be found again even
+# without the local index
+BUILD_HASH_TAG = 'AmiBuildHash'
+
+# The GRUB settings of AMI_Prep/README.md: show the menu for grub_timeout seconds, on the serial console too
+GRUB_SETTINGS = """# Cloud Image specific Grub settings for AWS EC2 images
+# CLOUD_IMG: This file was created/modified by the Cloud Image build process
+
+# Set the recordfail timeout
+GRUB_RECORDFAIL_TIMEOUT=0
+
+# Wait on the grub prompt, so the kernel arguments can be edited over the serial console
+GRUB_TIMEOUT={grub_timeout}
+GRUB_TIMEOUT_STYLE=menu
+
+# Set the default commandline
+GRUB_CMDLINE_LINUX_DEFAULT="console=tty1 console=ttyS0 nvme_core.io_timeout=4294967295"
+
+# Set the grub console type
+GRUB_TERMINAL="console serial"
+GRUB_SERIAL_COMMAND="serial --speed 115200"
+"""
+
+# Userdata of the builder. Each prep script is written out and run in turn - a failing step leaves the builder
+# running rather than imaging it half prepared, and the build gives up after builder_timeout.
+BUILDER_SCRIPT = """#!/bin/sh
+# GRUB-enabled AMI build - added by ec2_ami_build_helper.py
+BUILD_DIR=/run/ami-build
+mkdir -p $BUILD_DIR
+fail() {{
+  echo "AMI build failed: $1 - leaving the builder running."
+  exit 1
+}}
+
+cat > /etc/default/grub.d/50-cloudimg-settings.cfg <<'AMI_BUILD_EOF'
+{grub_settings}AMI_BUILD_EOF
+update-grub || fail "update-grub"
+{scripts}
+# In case the last script did not shut the builder down itself
+shutdown -h now
+"""
+
+BUILDER_STEP = """
+cat > $BUILD_DIR/{index} <<'AMI_BUILD_EOF'
+{content}AMI_BUILD_EOF
+chmod +x $BUILD_DIR/{index}
+$BUILD_DIR/{index} || fail "{name}"
+"""
+
+
+def load_ami_build(config):
+    """Merge the optional 'ami_build' section of config.yaml over the defaults."""
+    settings = dict(DEFAULT_AMI_BUILD)
+    settings.update(config.get('ami_build') or {})
+    settings['instance_type'] = settings['instance_type'] or config.get('instance_type')
+    return settings
+
+
+def builder_userdata(settings):
+    """The builder's userdata, with the GRUB settings and the contents of every prep script in it."""
+    steps = []
+    for index, path in enumerate(settings['scripts']):
+        with open(path, 'r') as script_file:
+            content = script_file.read()
+        if not content.startswith('#!'):
+            content = '#!/bin/sh\n' + content
+        if not content.endswith('\n'):
+            content += '\n'
+        steps.append(BUILDER_STEP.format(index=index, content=content, name=os.path.basename(path)))
+    return BUILDER_SCRIPT.format(grub_settings=GRUB_SETTINGS.format(grub_timeout=int(settings['grub_timeout'])), scripts=''.join(steps))
+
+
+def build_inputs_hash(base_ami_id, userdata):
+    """Hash of everything that goes into a built AMI: the base AMI and the builder's userdata, which holds the GRUB
+    settings and the prep scripts."""
+    canonical = json.dumps({'base_ami_id': base_ami_id, 'userdata': userdata}, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def describe_image(ec2_client, image_id):
+    """Return the image, or None if it does not exist (any more)."""
+    try:
+        images = ec2_client.describe_images(ImageIds=[image_id])['Images']
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('InvalidAMIID.NotFound', 'InvalidAMIID.Unavailable', 'InvalidAMIID.Malformed'):
+            return None
+        raise
+    return images[0] if images else None
+
+
+def find_image_by_hash(ec2_client, inputs_hash):
+    """Look for an image of this account built from the same inputs, e.g. by a run on another host. Images that
+    failed or are being deregistered are ignored."""
+    images = ec2_client.describe_images(Owners=['self'], Filters=[{'Name': f"tag:{BUILD_HASH_TAG}", 'Values': [inputs_hash]}])['Images']
+    images = [image for image in images if image['State'] in ('available', 'pending')]
+    # An available image over one still pending
+    images.sort(key=lambda image: image['State'] != 'available')
+    return images[0] if images else None
+
+
+def wait_for_image(ec2_client, image_id, timeout, poll_interval):
+    """Poll the image until it is available. Returns True if it is, False if it failed or took too long."""
+    deadline = time.monotonic() + timeout
+    while True:
+        image = describe_image(ec2_client, image_id)
+        state = image['State'] if image else 'deregistered'
+        if state == 'available':
+            return True
+        if state != 'pending':
+            reason = (image or {}).get('StateReason', {}).get('Message', '')
+            print(f"Image {image_id} is {state}{': ' + reason if reason else ''}")
+            return False
+        if time.monotonic() >= deadline:
+            print(f"Image {image_id} is still pending after {timeout}s.")
+            return False
+        time.sleep(poll_interval)
+
+
+def wait_for_builder(ec2_client, instance_id, timeout, poll_interval):
+    """Poll the builder until it has stopped. Returns True if it has, False if it was terminated or took too long.
+    The instance_stopped waiter is no use here - it gives up on an instance that is still pending."""
+    deadline = time.monotonic() + timeout
+    while True:
+        reservations = ec2_client.describe_instances(InstanceIds=[instance_id])['Reservations']
+        state = reservations[0]['Instances'][0]['State']['Name'] if reservations else 'terminated'
+        if state == 'stopped':
+            return True
+        if state in ('shutting-down', 'terminated'):
+            print(f"Builder {instance_id} is {state}.")
+            return False
+        if time.monotonic() >= deadline:
+            print(f"Builder {instance_id} is still {state} after {timeout}s.")
+            return False
+        time.sleep(poll_interval)
+
+
+def launch_builder(ec2_client, config, settings, userdata, run_id=None):
+    """Launch the builder instance from the base AMI, through a launch template like the fleet instances. The
+    template is tagged like theirs, so 'automate.py sweep' deletes it once it expires."""
+    template_cache = config.get('launch_template_cache') or {}
+    launch_template_id, launch_template_version = create_launch_template(
+        ec2_client,
+        f"{settings['name_prefix']}-builder",
+        settings['base_ami_id'],
+        settings['instance_type'],
+        config['key_name'],
+        config['security_group_ids'],
+        config['subnet_id'],
+        config['iam_instance_profile_arn'],
+        userdata,
+        cache_file=template_cache.get('cache_file', DEFAULT_CACHE_FILE),
+        tags=run_tags(run_id, load_resource_expiry(config)['launch_template_hours'])
+    )
+    response = ec2_client.run_instances(
+        LaunchTemplate={
+            'LaunchTemplateId': launch_template_id,
+            'Version': str(launch_template_version),
+        },
+        MinCount=1,
+        MaxCount=1,
+        InstanceInitiatedShutdownBehavior='stop'
+    )
+    return response['Instances'][0]['InstanceId']
+
+
+def create_builder_image(ec2_client, instance_id, settings, inputs_hash):
+    tags = [
+        {'Key': 'Name', 'Value': f"{settings['name_prefix']}-{inputs_hash[:12]}"},
+        {'Key': BUILD_HASH_TAG, 'Value': inputs_hash},
+    ]
+    response = ec2_client.create_image(
+        InstanceId=instance_id,
+        Name=f"{settings['name_prefix']}-{inputs_hash[:12]}",
+        Description=f"GRUB menu enabled, built from {settings['base_ami_id']} by ec2_ami_build_helper.py",
+        TagSpecifications=[
+            {'ResourceType': 'image', 'Tags': tags},
+            {'ResourceType': 'snapshot', 'Tags': tags},
+        ]
+    )
+    return response['ImageId']
+
+
+def build_ami(ec2_client, config, settings, rebuild=False, keep_builder=False, run_id=None):
+    """Return the ID of a GRUB-enabled AMI built from the base AMI with the prep scripts, or None if the build failed.
+
+    Builds are keyed by a hash of their inputs. Unchanged inputs return the AMI built before, found in the local
+    index or by its tag, and only changed ones - a new base AMI, GRUB timeout or prep script - launch a builder.
+    Pass rebuild to build again regardless, and run_id to tag the builder's launch template with the run.
+    """
+    userdata = builder_userdata(settings)
+    inputs_hash = build_inputs_hash(settings['base_ami_id'], userdata)
+    index = load_template_cache(settings['cache_file'])
+
+    # Cache hit - one call to make sure nobody deregistered the image since
+    cached = None if rebuild else index.get(inputs_hash)
+    if cached:
+        image = describe_image(ec2_client, cached['image_id'])
+        if image and image['State'] == 'available':
+            print(f"AMI {cached['image_id']} was built from these inputs ({inputs_hash[:12]}) on {cached['built_at']}.")
+            return cached['image_id']
+        del index[inputs_hash]
+
+    image = None if rebuild else find_image_by_hash(ec2_client, inputs_hash)
+    if image:
+        print(f"AMI {image['ImageId']} ({image['State']}) was built from these inputs ({inputs_hash[:12]}).")
+        image_id = image['ImageId']
+        if image['State'] != 'available' and not wait_for_image(ec2_client, image_id, settings['image_timeout'], settings['poll_interval']):
+            return None
+    else:
+        image_id = build_new_ami(ec2_client, config, settings, userdata, inputs_hash, keep_builder, run_id)
+        if image_id is None:
+            return None
+
+    index[inputs_hash] = {'image_id': image_id, 'base_ami_id': settings['base_ami_id'], 'built_at': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    save_template_cache(settings['cache_file'], index)
+    return image_id
+
+
+def build_new_ami(ec2_client, config, settings, userdata, inputs_hash, keep_builder=False, run_id=None):
+    """Launch a builder, wait for it to prepare itself and shut down, and image it. The builder is terminated
+    afterwards, unless keep_builder is set and the build failed."""
+    print(f"Building an AMI from {settings['base_ami_id']} on a {settings['instance_type']} builder ({inputs_hash[:12]})...")
+    started = time.monotonic()
+    instance_id = None
+    image_id = None
+    try:
+        instance_id = launch_builder(ec2_client, config, settings, userdata, run_id)
+        print(f"Builder {instance_id} launched, waiting for it to shut down...")
+        if not wait_for_builder(ec2_client, instance_id, settings['builder_timeout'], settings['poll_interval']):
+            return None
+        image_id = create_builder_image(ec2_client, instance_id, settings, inputs_hash)
+        print(f"Builder {instance_id} stopped after {time.monotonic() - started:.0f}s, creating image {image_id}...")
+        if not wait_for_image(ec2_client, image_id, settings['image_timeout'], settings['poll_interval']):
+            image_id = None
+    except Exception as e:
+        print(f"Error building the AMI: {e}")
+        if instance_id:
+            print(f"The console output of builder {instance_id} shows how far its userdata got.")
+        image_id = None
+    finally:
+        if instance_id and (image_id or not keep_builder):
+            try:
+                ec2_client.terminate_instances(InstanceIds=[instance_id])
+            except ClientError as e:
+                print(f"Error terminating builder {instance_id}: {e}")
+    if image_id:
+        print(f"AMI {image_id} is available, built in {time.monotonic() - started:.0f}s.")
+    return image_id
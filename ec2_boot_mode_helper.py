@@ -0,0 +1,116 @@
+# ec2_boot_mode_helper.py
+
+import uuid
+from ec2_sweep_helper import MAX_TAG_VALUE_LENGTH
+
+"""
+Example of boot mode settings in config.yaml:
+
+boot_mode:
+  # How each instance gets the kernel arguments of its job:
+  #   console      - keystrokes to the GRUB menu over the serial console, on an AMI prepared as in AMI_Prep/
+  #   kexec        - the userdata kexecs into the running kernel with the arguments appended, on a stock AMI
+  #   grub-editenv - the userdata sets the arguments in the GRUB environment block and reboots once, on a stock AMI
+  mode: "kexec"
+  # Seconds the userdata waits for the instance to be tagged with its job before powering off without running it
+  tag_timeout: 600
+"""
+
+BOOT_MODES = ('console', 'kexec', 'grub-editenv')
+
+DEFAULT_BOOT_MODE = {
+    'mode': 'console',
+    'tag_timeout': 600,
+}
+
+# Put in front of the userdata script in the kexec and grub-editenv modes, and run on every boot. The first boot
+# of each job waits for automate.py to tag the instance with it, applies its kernel arguments and boots again; the
+# second boot carries on into the rest of the userdata with them on /proc/cmdline. A BootToken tag, new for every
+# job an instance takes, tells a restarted warm pool instance's new job from the one it finished before.
+BOOTSTRAP_SCRIPT = """#!/bin/sh
+# Kernel arguments without the GRUB menu - added by ec2_boot_mode_helper.py
+BOOT_MODE={mode}
+TAG_TIMEOUT={tag_timeout}
+STATE_DIR=/var/lib/kernel-arguments
+mkdir -p $STATE_DIR
+
+instance_tag() {{
+  IMDS_TOKEN=`curl -s -X PUT "http://169.254.169.254/latest/api/token" -H "X-aws-ec2-metadata-token-ttl-seconds: 300"`
+  curl -s -f -H "X-aws-ec2-metadata-token: $IMDS_TOKEN" "http://169.254.169.254/latest/meta-data/tags/instance/$1"
+}}
+
+# automate.py tags the instance with its job once it is running
+WAITED=0
+until BOOT_TOKEN=`instance_tag BootToken` && [ "$BOOT_TOKEN" != "`cat $STATE_DIR/done 2>/dev/null`" ]; do
+  if [ $WAITED -ge $TAG_TIMEOUT ]; then
+    echo "No job for this instance after ${{TAG_TIMEOUT}}s, powering off."
+    shutdown -h now
+    exit 1
+  fi
+  sleep 2
+  WAITED=$((WAITED + 2))
+done
+KERNEL_ARGUMENTS=`instance_tag KernelArguments`
+
+if [ "$BOOT_TOKEN" != "`cat $STATE_DIR/applied 2>/dev/null`" ]; then
+  echo "$BOOT_TOKEN" > $STATE_DIR/applied
+  if [ "$BOOT_MODE" = "kexec" ] && [ -n "$KERNEL_ARGUMENTS" ]; then
+    command -v kexec > /dev/null || DEBIAN_FRONTEND=noninteractive apt-get -y install kexec-tools
+    KERNEL=/boot/vmlinuz-`uname -r`
+    INITRD=/boot/initrd.img-`uname -r`
+    APPEND="`cat /proc/cmdline` $KERNEL_ARGUMENTS"
+    # kexec_file_load where the kernel has it, otherwise the older kexec_load
+    kexec -s -l $KERNEL --initrd=$INITRD --append="$APPEND" || kexec -l $KERNEL --initrd=$INITRD --append="$APPEND"
+    systemctl kexec --no-block
+    exit 0
+  fi
+  if [ "$BOOT_MODE" = "grub-editenv" ] && [ "`grub-editenv /boot/grub/grubenv list | sed -n 's/^kernel_arguments=//p'`" != "$KERNEL_ARGUMENTS" ]; then
+    if [ ! -f /etc/default/grub.d/99-kernel-arguments.cfg ]; then
+      # Once per instance: have the kernel command line take ${{kernel_arguments}} from the GRUB environment block
+      echo 'GRUB_CMDLINE_LINUX="$GRUB_CMDLINE_LINUX \\${{kernel_arguments}}"' > /etc/default/grub.d/99-kernel-arguments.cfg
+      update-grub
+    fi
+    grub-editenv /boot/grub/grubenv set kernel_arguments="$KERNEL_ARGUMENTS"
+    systemctl reboot --no-block
+    exit 0
+  fi
+fi
+# Booted with the job's kernel arguments, or they did not take - Aws.CmdLine in the results tells which
+echo "$BOOT_TOKEN" > $STATE_DIR/done
+"""
+
+
+def load_boot_mode(config):
+    """Merge the optional 'boot_mode' section of config.yaml over the defaults."""
+    settings = dict(DEFAULT_BOOT_MODE)
+    settings.update(config.get('boot_mode') or {})
+    if settings['mode'] not in BOOT_MODES:
+        raise ValueError(f"boot_mode mode must be one of {', '.join(BOOT_MODES)}, not '{settings['mode']}'")
+    return settings
+
+
+def uses_serial_console(settings):
+    """True if kernel arguments are typed into the GRUB menu, rather than applied by the userdata itself."""
+    return settings['mode'] == 'console'
+
+
+def userdata_for_boot_mode(script_content, settings):
+    """Put the bootstrap for the boot mode in front of a userdata script. The script must then run on every boot,
+    see userdata_for_every_boot() in ec2_warm_pool_helper.py. The console mode leaves the script as it is."""
+    if uses_serial_console(settings):
+        return script_content
+    lines = script_content.splitlines(keepends=True)
+    if lines and lines[0].startswith('#!'):
+        # The bootstrap brings its own
+        lines = lines[1:]
+    return BOOTSTRAP_SCRIPT.format(mode=settings['mode'], tag_timeout=int(settings['tag_timeout'])) + ''.join(lines)
+
+
+def jobs_with_long_arguments(jobs):
+    """Jobs whose kernel arguments do not fit in a tag. The userdata reads them from the instance tags through the
+    instance metadata service, so it would only see them cut short."""
+    return [job for job in jobs if len(job['kernel_arguments']) > MAX_TAG_VALUE_LENGTH]
+
+
+def new_boot_token():
+    return uuid.uuid4().hex[:12]
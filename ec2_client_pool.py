@@ -0,0 +1,60 @@
+# ec2_client_pool.py
+
+import threading
+import boto3
+from botocore.config import Config
+from ec2_rate_limiter import configure_rate_limiter
+
+# botocore's own default, used when nothing in the run needs more connections than this
+DEFAULT_MAX_POOL_CONNECTIONS = 10
+# Connections on top of the executor threads, for the instance state tracker and calls made from the main thread
+SPARE_POOL_CONNECTIONS = 4
+
+
+class AwsClientPool:
+    """Build boto3 clients once per service and region and hand the same clients to every stage of a run.
+
+    boto3 clients are thread safe once created, but sessions are not, so creation happens under a lock. Every
+    client uses a connection pool sized for the run's concurrency, so calls from many workers do not queue on
+    urllib3's default pool of 10. Given a rate_limiter (see ec2_rate_limiter.py), every client shares its token
+    buckets and botocore's standard retries back off on top; without one, botocore's adaptive retries limit
+    each client on its own.
+    """
+
+    def __init__(self, profile_name=None, region_name=None, max_pool_connections=DEFAULT_MAX_POOL_CONNECTIONS, max_attempts=10, rate_limiter=None, session=None):
+        self.session = session or boto3.Session(profile_name=profile_name, region_name=region_name)
+        self.region_name = self.session.region_name
+        self.rate_limiter = rate_limiter
+        self.client_config = Config(
+            max_pool_connections=max_pool_connections,
+            retries={'mode': 'standard' if rate_limiter is not None else 'adaptive', 'max_attempts': max_attempts},
+        )
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def client(self, service_name, region_name=None):
+        region_name = region_name or self.region_name
+        key = (service_name, region_name)
+        with self._lock:
+            if key not in self._clients:
+                self._clients[key] = self.create_client(service_name, region_name)
+            return self._clients[key]
+
+    def create_client(self, service_name, region_name):
+        client = self.session.client(service_name, region_name=region_name, config=self.client_config)
+        if self.rate_limiter is not None:
+            self.rate_limiter.attach(client)
+        return client
+
+
+def client_pool_from_config(config, concurrency=None):
+    """Create the client pool for a run, sized from the concurrency limits when there are any."""
+    max_pool_connections = DEFAULT_MAX_POOL_CONNECTIONS
+    if concurrency is not None:
+        max_pool_connections = max(max_pool_connections, concurrency['executor_workers'] + SPARE_POOL_CONNECTIONS)
+    rate_limiter = configure_rate_limiter(config)
+    return AwsClientPool(
+        profile_name=config.get('aws_profile'),
+        max_pool_connections=max_pool_connections,
+        rate_limiter=rate_limiter if rate_limiter.enabled else None
+    )
@@ -0,0 +1,157 @@
+# ec2_config_helper.py
+
+import os
+import yaml
+from ec2_boot_mode_helper import BOOT_MODES, MAX_TAG_VALUE_LENGTH
+
+# Settings each subcommand of automate.py cannot do without. A fleet run needs the regional ones in every region,
+# where a region may set them itself (see ec2_region_helper.py).
+REQUIRED_SETTINGS = {
+    'fleet': ('instance_type', 'key_name', 'launch_template_name', 'iam_instance_profile_arn'),
+    'build-ami': ('instance_type', 'key_name', 'security_group_ids', 'subnet_id', 'iam_instance_profile_arn'),
+    'instance': ('ami_id', 'instance_type', 'key_name', 'security_group_ids', 'subnet_id', 'serial_console_endpoint', 'private_key_file_path', 'kernel_arguments'),
+}
+REGIONAL_SETTINGS = ('ami_id', 'subnet_id', 'security_group_ids', 'total_capacity', 'on_demand_capacity')
+
+# Optional sections, each a mapping of its own settings
+SECTIONS = (
+    'sweep', 'serial_console_keys', 'console_capture', 'launch_template_cache', 'fleet_overrides', 'backfill', 'warm_pool',
+    'rate_limits', 'serial_console_host_keys', 'boot_mode', 'serial_console', 'results', 'analysis', 'concurrency', 'state_polling',
+    'ami_build', 'resource_expiry', 'userdata',
+)
+# Settings that count something, so must be whole numbers of at least zero
+COUNTS = ('total_capacity', 'on_demand_capacity', 'spot_capacity')
+
+
+class ConfigError(Exception):
+    """config.yaml cannot be used as it is. Carries every problem found, not just the first."""
+
+    def __init__(self, filename, problems):
+        self.filename = filename
+        self.problems = problems
+        super().__init__(f"{filename}: " + '; '.join(problems))
+
+
+def read_config(filename):
+    """Parse config.yaml without checking it - for the subcommands where every setting is optional."""
+    with open(filename, 'r') as config_file:
+        config = yaml.safe_load(config_file)
+    return config or {}
+
+
+def check_settings(config, required, where=''):
+    problems = []
+    for name in required:
+        if config.get(name) in (None, '', []):
+            problems.append(f"{name} is not set{where}")
+    for name in COUNTS:
+        value = config.get(name)
+        if value is not None and (not isinstance(value, int) or isinstance(value, bool) or value < 0):
+            problems.append(f"{name} must be a whole number of at least 0{where}, not {value!r}")
+    if isinstance(config.get('total_capacity'), int) and isinstance(config.get('on_demand_capacity'), int) and config['on_demand_capacity'] > config['total_capacity']:
+        problems.append(f"on_demand_capacity is more than total_capacity{where}")
+    if config.get('security_group_ids') is not None and not isinstance(config['security_group_ids'], list):
+        problems.append(f"security_group_ids must be a list{where}")
+    return problems
+
+
+def check_ami_build(ami_build):
+    problems = []
+    if not ami_build.get('base_ami_id'):
+        problems.append("ami_build base_ami_id is not set")
+    # The defaults of ec2_ami_build_helper.py, which is not imported here as it needs botocore
+    scripts = ami_build.get('scripts', ['AMI_Prep/ubuntu-clean-for-ami.sh'])
+    if not isinstance(scripts, list):
+        problems.append("ami_build scripts must be a list of script paths")
+    else:
+        problems += [f"ami_build script {script} not found" for script in scripts if not os.path.isfile(str(script))]
+    grub_timeout = ami_build.get('grub_timeout', 30)
+    if not isinstance(grub_timeout, int) or isinstance(grub_timeout, bool) or grub_timeout < 1:
+        problems.append(f"ami_build grub_timeout must be a whole number of seconds of at least 1, not {grub_timeout!r}")
+    return problems
+
+
+def check_config(config, command):
+    """Return the problems with config for a subcommand of automate.py, as a list of messages."""
+    if not isinstance(config, dict):
+        return ["the file must hold a mapping of settings"]
+
+    problems = []
+    for name in SECTIONS:
+        if config.get(name) is not None and not isinstance(config[name], dict):
+            problems.append(f"{name} must be a mapping of settings")
+    if command not in REQUIRED_SETTINGS:
+        return problems
+
+    boot_mode = config['boot_mode'] if isinstance(config.get('boot_mode'), dict) else {}
+    if boot_mode.get('mode', 'console') not in BOOT_MODES:
+        problems.append(f"boot_mode mode must be one of {', '.join(BOOT_MODES)}, not '{boot_mode['mode']}'")
+    console = boot_mode.get('mode', 'console') == 'console'
+
+    # A fleet run may build its AMI first, see ec2_ami_build_helper.py
+    ami_build = config['ami_build'] if isinstance(config.get('ami_build'), dict) else {}
+    building = command == 'build-ami' or (command == 'fleet' and ami_build.get('enabled'))
+    if building:
+        problems += check_ami_build(ami_build)
+
+    regions = config.get('regions')
+    if regions is not None and (not isinstance(regions, list) or not all(isinstance(region, dict) and region.get('region') for region in regions)):
+        problems.append("regions must be a list of mappings, each with a region name")
+        regions = None
+    # The built AMI stands in for ami_id
+    regional_settings = tuple(name for name in REGIONAL_SETTINGS if not (building and name == 'ami_id'))
+    if command == 'fleet' and regions:
+        if building:
+            problems.append("ami_build is for runs in one region - build the AMI of each region with 'python automate.py build-ami' and set its ami_id")
+        problems += check_settings({key: value for key, value in config.items() if key not in REGIONAL_SETTINGS}, REQUIRED_SETTINGS[command])
+        # Regional settings at the top level are the defaults of every region
+        for region in regions:
+            problems += [problem for problem in check_settings(dict(config, **region), REGIONAL_SETTINGS, f" for region {region['region']}") if problem.split()[0] in REGIONAL_SETTINGS]
+    else:
+        problems += check_settings(config, REQUIRED_SETTINGS[command] + (regional_settings if command == 'fleet' else ()))
+        if command == 'fleet' and console and not config.get('serial_console_endpoint'):
+            problems.append("serial_console_endpoint is not set, and the console boot mode needs it")
+
+    if command == 'fleet':
+        if console and not config.get('private_key_file_path'):
+            problems.append("private_key_file_path is not set, and the console boot mode needs it")
+        sweep = config['sweep'] if isinstance(config.get('sweep'), dict) else None
+        if sweep is None and config.get('kernel_arguments') is None:
+            problems.append("neither kernel_arguments nor a sweep section is set")
+        if sweep is None and config.get('kernel_arguments') is not None and not console and len(str(config['kernel_arguments'])) > MAX_TAG_VALUE_LENGTH:
+            problems.append(f"kernel_arguments is longer than the {MAX_TAG_VALUE_LENGTH} characters the {boot_mode['mode']} boot mode can read from a tag")
+        if sweep is not None and not isinstance(sweep.get('parameters') or {}, dict):
+            problems.append("sweep parameters must be a mapping of argument names to values")
+        fleet_overrides = config['fleet_overrides'] if isinstance(config.get('fleet_overrides'), dict) else {}
+        instance_types = fleet_overrides.get('instance_types') if isinstance(fleet_overrides.get('instance_types'), dict) else {}
+        for job_instance_type, specs in instance_types.items():
+            if any(isinstance(spec, dict) and 'weighted_capacity' in spec for spec in specs or []):
+                problems.append(f"fleet_overrides instance_types for {job_instance_type} set weighted_capacity, but every instance runs one job, so each counts as one unit of capacity")
+        userdata = config['userdata'] if isinstance(config.get('userdata'), dict) else {}
+        if not isinstance(userdata.get('variables') or {}, dict):
+            problems.append("userdata variables must be a mapping of placeholder names to values")
+        if userdata.get('compress', 'auto') not in ('auto', True, False):
+            problems.append(f"userdata compress must be auto, true or false, not {userdata['compress']!r}")
+    return problems
+
+
+def load_config(filename, command=None, overrides=None):
+    """Load config.yaml and check it for the given subcommand of automate.py up front, rather than failing on a
+    missing or mistyped setting minutes into a run. Raises ConfigError listing everything wrong with it.
+
+    overrides are settings from the command line, merged over the file's - into the section for a dict.
+    """
+    if not os.path.exists(filename):
+        raise ConfigError(filename, ["file not found"])
+    try:
+        config = read_config(filename)
+    except yaml.YAMLError as e:
+        raise ConfigError(filename, [f"not valid YAML: {e}"])
+    for name, value in (overrides or {}).items() if isinstance(config, dict) else ():
+        if isinstance(value, dict) and isinstance(config.get(name) or {}, dict):
+            value = dict(config.get(name) or {}, **value)
+        config[name] = value
+    problems = check_config(config, command)
+    if problems:
+        raise ConfigError(filename, problems)
+    return config
@@ -0,0 +1,163 @@
+# ec2_console_capture.py
+
+import json
+import os
+import re
+import socket
+import threading
+import time
+
+"""
+Example of console capture settings in config.yaml:
+
+console_capture:
+  enabled: true
+  # One <instance-id>.log and <instance-id>.json per instance, plus boot_timings.jsonl for the whole run
+  log_dir: "console-logs"
+  # The capture holds a serial console session, and its slot, until it sees this milestone (see BOOT_MILESTONES)
+  # or has run for max_seconds. power_off records the workload as well, at the cost of a session for all of it.
+  until: userdata_start
+  max_seconds: 600
+"""
+
+DEFAULT_CONSOLE_CAPTURE = {
+    'enabled': False,
+    'log_dir': 'console-logs',
+    'until': 'userdata_start',
+    'max_seconds': 600,
+}
+
+# Boot milestones in the order they normally happen, each with the console output that marks it
+BOOT_MILESTONES = (
+    ('grub_menu', re.compile(r"GNU GRUB|to edit the commands|executed automatically in")),
+    ('kernel_entry', re.compile(r"Booting a command list|Booting `|EFI stub: ")),
+    ('linux_version', re.compile(r"Linux version \d")),
+    ('cloud_init_start', re.compile(r"Cloud-init v\. \S+ running 'init")),
+    ('userdata_start', re.compile(r"Cloud-init v\. \S+ running 'modules:final'")),
+    ('power_off', re.compile(r"reboot: Power down|reboot: System halted|Reached target .*Power-Off")),
+)
+
+# Terminal control sequences are stripped from the log so it reads as plain text
+CONTROL_SEQUENCE = re.compile(r"\x1b\[[0-9;?]*[@-~]|\x1b[()][0-9A-Za-z]|\x1b[78=>DEM]|\r")
+
+
+class ConsoleCapture:
+    """Write everything an instance prints on its serial console to a timestamped log and time its boot phases."""
+
+    def __init__(self, instance_id, log_dir, job=None, log_name=None, until=None, max_seconds=None):
+        self.instance_id = instance_id
+        self.log_dir = log_dir
+        # Warm pool instances boot once per job, so their logs are named per job as well
+        self.log_name = log_name or instance_id
+        self.job = job
+        self.until = until
+        self.max_seconds = max_seconds
+        self.started_at = time.time()
+        self.milestones = {}
+        self._started = time.monotonic()
+        self._partial = ''
+        self._ssh = None
+        self._console = None
+        self._lock = threading.Lock()
+        os.makedirs(log_dir, exist_ok=True)
+        self._log = open(os.path.join(log_dir, f"{self.log_name}.log"), 'w')
+
+    def elapsed(self):
+        return time.monotonic() - self._started
+
+    def feed(self, data):
+        """Add console output to the log and note any milestones in it."""
+        with self._lock:
+            elapsed = self.elapsed()
+            lines = (self._partial + CONTROL_SEQUENCE.sub('', data)).split('\n')
+            self._partial = lines.pop()
+            for line in lines:
+                self._log.write(f"[{elapsed:10.3f}] {line}\n")
+                self._check_milestones(line, elapsed)
+            # GRUB redraws its screen without newlines, so look at the unfinished line as well
+            self._check_milestones(self._partial, elapsed)
+            self._log.flush()
+
+    def _check_milestones(self, line, elapsed):
+        for name, pattern in BOOT_MILESTONES:
+            if name not in self.milestones and pattern.search(line):
+                self.milestones[name] = round(elapsed, 3)
+
+    def follow(self, ssh, console):
+        """Take over the session once GRUB has been driven, for read() to record the rest of the boot."""
+        self._ssh = ssh
+        self._console = console
+
+    def finished(self):
+        """True once the until milestone has been seen or max_seconds have passed."""
+        if self.until is not None and self.until in self.milestones:
+            return True
+        return self.max_seconds is not None and self.elapsed() >= self.max_seconds
+
+    def read(self):
+        """Record the session until it closes or the capture is finished, then close it. Blocks - the fleet runs
+        it on the orchestrator's executor, in the serial console slot the session already holds."""
+        try:
+            while not self.finished():
+                try:
+                    data = self._console.recv(4096)
+                except socket.timeout:
+                    continue
+                if not data:
+                    break
+                self.feed(data.decode('utf-8', errors='replace'))
+        except Exception as e:
+            print(f"Console capture for instance {self.instance_id} stopped: {e}")
+        finally:
+            self._ssh.close()
+
+    def stop(self):
+        """Close the session under read(), e.g. once the instance has stopped before the until milestone."""
+        if self._ssh is not None:
+            self._ssh.close()
+
+    def close(self):
+        """Write the capture's log and timing record. read(), if it ran, must have returned."""
+        with self._lock:
+            if self._partial:
+                self._log.write(f"[{self.elapsed():10.3f}] {self._partial}\n")
+                self._partial = ''
+            self._log.close()
+        record = self.record()
+        with open(os.path.join(self.log_dir, f"{self.log_name}.json"), 'w') as record_file:
+            json.dump(record, record_file, indent=2)
+        with open(os.path.join(self.log_dir, 'boot_timings.jsonl'), 'a') as timings_file:
+            timings_file.write(json.dumps(record) + '\n')
+        return record
+
+    def record(self):
+        """Milestone times in seconds from the start of the console session, and the time spent between them."""
+        phases = {}
+        previous = None
+        for name, _ in BOOT_MILESTONES:
+            if name not in self.milestones:
+                continue
+            if previous is not None:
+                phases[f"{previous}_to_{name}"] = round(self.milestones[name] - self.milestones[previous], 3)
+            previous = name
+        record = {
+            'instance_id': self.instance_id,
+            'started_at': self.started_at,
+            'milestones': dict(self.milestones),
+            'phases': phases,
+        }
+        if self.job is not None:
+            record['job_id'] = self.job['job_id']
+            record['kernel_arguments'] = self.job['kernel_arguments']
+            record['instance_type'] = self.job.get('launched_instance_type', self.job['instance_type'])
+            record['availability_zone'] = self.job.get('availability_zone')
+        return record
+
+
+def console_capture_from_config(config, instance_id, job=None, log_name=None):
+    """Return a ConsoleCapture for the instance if capture is enabled in config.yaml, otherwise None."""
+    settings = dict(DEFAULT_CONSOLE_CAPTURE)
+    settings.update(config.get('console_capture') or {})
+    if not settings['enabled']:
+        return None
+    return ConsoleCapture(instance_id, settings['log_dir'], job, log_name, settings['until'], settings['max_seconds'])
@@ -0,0 +1,157 @@
+# ec2_console_scheduler.py
+
+import asyncio
+import heapq
+import time
+from ec2_send_serial_commands import SerialConsoleError
+
+"""
+Example of serial console settings in config.yaml:
+
+serial_console:
+  # GRUB_TIMEOUT of the AMI - AMI_Prep/README.md sets 30 seconds
+  grub_timeout: 30
+  # Seconds from the instance reaching 'running' until GRUB starts its countdown
+  grub_delay: 15
+  # Connections per session, each after pushing the key again, before the job fails
+  max_connect_attempts: 4
+  # Seconds before reconnecting after the serial console refused a connection, doubling for each attempt
+  retry_delay: 1
+  # Seconds a slot stays taken after its session closed, while the serial console notices the hang up
+  release_delay: 1
+"""
+
+DEFAULT_SERIAL_CONSOLE = {
+    'grub_timeout': 30,
+    'grub_delay': 15,
+    'max_connect_attempts': 4,
+    'retry_delay': 1,
+    'release_delay': 1,
+}
+
+
+def load_serial_console(config):
+    """Merge the optional 'serial_console' section of config.yaml over the defaults."""
+    settings = dict(DEFAULT_SERIAL_CONSOLE)
+    settings.update(config.get('serial_console') or {})
+    return settings
+
+
+class ConsoleSlot:
+    """One admitted serial console session. release() hands the slot to the next instance in line."""
+
+    def __init__(self, scheduler, instance_id, deadline, release_delay=0):
+        self.scheduler = scheduler
+        self.instance_id = instance_id
+        self.deadline = deadline
+        self.release_delay = release_delay
+        self.released = False
+        self.is_connected = False
+
+    def remaining(self):
+        """Seconds left until GRUB is expected to boot the default entry."""
+        return self.deadline - time.monotonic()
+
+    def connected(self):
+        """Record that the serial console accepted the session."""
+        if not self.released and not self.is_connected:
+            self.is_connected = True
+            self.scheduler._connected()
+
+    def release(self):
+        if self.released:
+            return
+        self.released = True
+        if self.is_connected and self.release_delay:
+            # The next session could otherwise be refused because the serial console still counts this one
+            asyncio.get_running_loop().call_later(self.release_delay, self.scheduler._release)
+        else:
+            self.scheduler._release()
+        self.is_connected = False
+
+    async def refused(self, delay=0):
+        """Give the slot back after the serial console refused the session, and wait in line for another one
+        after delay seconds."""
+        self.scheduler._refused()
+        self.release()
+        await asyncio.sleep(delay)
+        await self.scheduler._wait(self.instance_id, self.deadline)
+        self.released = False
+
+
+class ConsoleSessionScheduler:
+    """Admit at most limit serial console sessions at a time, earliest GRUB deadline first.
+
+    EC2 limits the serial console sessions open at once per account and region, and a key pushed with
+    SendSerialConsoleSSHPublicKey is only valid for about 60 seconds - so instead of every instance pushing its
+    key and connecting as soon as it is running, each waits here for a slot and pushes its key once it has one.
+    An instance whose GRUB countdown is closest to running out goes first, and one whose deadline has passed
+    while waiting is turned away, as GRUB has most likely booted the default entry by then.
+
+    If the serial console refuses a session below limit, the account allows fewer than configured: the scheduler
+    drops to the other sessions open at the time and works its way back up by one for every limit sessions that
+    connect after that.
+    """
+
+    def __init__(self, limit):
+        self.max_limit = limit
+        self.limit = limit
+        self.active = 0
+        self.admitted = 0
+        self.expired = 0
+        self.refusals = 0
+        self._connected_since_refusal = 0
+        self._waiting = []
+        self._sequence = 0
+
+    async def acquire(self, instance_id, deadline, release_delay=0):
+        """Wait for a session slot for instance_id, whose GRUB menu times out at deadline (time.monotonic())."""
+        await self._wait(instance_id, deadline)
+        self.admitted += 1
+        return ConsoleSlot(self, instance_id, deadline, release_delay)
+
+    async def _wait(self, instance_id, deadline):
+        if self.active < self.limit and not self._waiting:
+            self.active += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            self._sequence += 1
+            heapq.heappush(self._waiting, (deadline, self._sequence, future))
+            try:
+                await future
+            except asyncio.CancelledError:
+                # Granted a slot just as we were cancelled - pass it on
+                if future.done() and not future.cancelled():
+                    self._release()
+                raise
+
+        if time.monotonic() >= deadline:
+            self.expired += 1
+            self._release()
+            raise SerialConsoleError(f"No serial console slot for {instance_id} before its GRUB menu timed out.")
+
+    def _connected(self):
+        if self.limit < self.max_limit:
+            self._connected_since_refusal += 1
+            if self._connected_since_refusal >= self.limit:
+                self._connected_since_refusal = 0
+                self.limit += 1
+                self._admit()
+
+    def _refused(self):
+        self.refusals += 1
+        self._connected_since_refusal = 0
+        # The refused session does not count - the others that are open are what the account allows right now
+        self.limit = max(1, min(self.limit, self.active - 1))
+
+    def _release(self):
+        self.active -= 1
+        self._admit()
+
+    def _admit(self):
+        while self.active < self.limit and self._waiting:
+            _, _, future = heapq.heappop(self._waiting)
+            if future.done():
+                continue
+            self.active += 1
+            future.set_result(None)
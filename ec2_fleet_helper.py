@@ -3,26 +3,84 @@
 import boto3
 
 """
-Example of Launch Template overrides:
+Example of fleet overrides in config.yaml - each fleet draws on every combination of instance type and subnet
+listed for the instance type of its jobs, so it is not limited to the capacity pool of the launch template:
+
+fleet_overrides:
+  # Subnets in different availability zones to spread every fleet over
+  subnet_ids: ["subnet-aaaaaa", "subnet-bbbbbb", "subnet-cccccc"]
+  # Default spot max price for every override, in USD per hour - leave out to pay up to the on-demand price
+  max_price: "0.01"
+  # Instance types that may stand in for the instance type of a job, most preferred first. A job instance
+  # type not listed here only launches as itself. Every instance runs one job at a time, so every override
+  # counts as one unit of capacity - there is no weighted_capacity.
+  instance_types:
+    t4g.nano:
+      - instance_type: t4g.nano
+      - instance_type: t4g.micro
+        max_price: "0.012"
+
+These become the Overrides of the fleet's launch template config, for example:
 
                 'Overrides': [
                     {
-                        'InstanceType': 't3.micro',
-                        'AvailabilityZone': 'eu-central-1a',
-                        'MaxPrice': '0.05',
-                        'WeightedCapacity': 1,
+                        'InstanceType': 't4g.nano',
+                        'SubnetId': 'subnet-aaaaaa',
+                        'MaxPrice': '0.01',
+                        'Priority': 0,
                     },
                     {
-                        'InstanceType': 'm5.large',
-                        'AvailabilityZone': 'eu-central-1b',
-                        'MaxPrice': '0.10',
-                        'WeightedCapacity': 1,
+                        'InstanceType': 't4g.micro',
+                        'SubnetId': 'subnet-aaaaaa',
+                        'MaxPrice': '0.012',
+                        'Priority': 1,
                     },
+                    ...
                 ],
 """
 
-def create_ec2_fleet(ec2_client, args, launch_template_id, total_capacity, on_demand_capacity, spot_capacity):
-    """Create an EC2 fleet using the provided launch template."""
+def fleet_instance_types(config, instance_type):
+    """Return the instance type specs a fleet for jobs of instance_type may launch, from the fleet_overrides section."""
+    settings = config.get('fleet_overrides') or {}
+    specs = (settings.get('instance_types') or {}).get(instance_type) or [{'instance_type': instance_type}]
+    return [spec if isinstance(spec, dict) else {'instance_type': spec} for spec in specs]
+
+def build_fleet_overrides(instance_types, subnet_ids=None, max_price=None):
+    """Build fleet Overrides for every combination of instance type spec and subnet.
+
+    Each spec is a dict with instance_type and optionally max_price. The order of the specs sets the on-demand
+    Priority, so the first is preferred. No override is weighted, as the fleet's target capacity is counted in
+    instances - one per job.
+    """
+    overrides = []
+    for priority, spec in enumerate(instance_types):
+        for subnet_id in subnet_ids or [None]:
+            override = {'InstanceType': spec['instance_type'], 'Priority': float(priority)}
+            if subnet_id:
+                override['SubnetId'] = subnet_id
+            if spec.get('max_price', max_price) is not None:
+                override['MaxPrice'] = str(spec.get('max_price', max_price))
+            overrides.append(override)
+    return overrides
+
+def create_ec2_fleet(ec2_client, args, launch_template_id, total_capacity, on_demand_capacity, spot_capacity, instance_type=None, launch_template_version='$Latest', subnet_ids=None, overrides=None, tags=None):
+    """Create an EC2 fleet using the provided launch template version.
+
+    overrides, if given, are used as they are (see build_fleet_overrides). Otherwise the fleet can override the
+    launch template's instance type and choose between several subnets. tags go on the fleet itself, so that it
+    can be found again if this run loses track of it (see ec2_resource_sweeper.py).
+    """
+
+    if overrides is None:
+        overrides = []
+        for subnet_id in subnet_ids or [None]:
+            override = {}
+            if instance_type:
+                override['InstanceType'] = instance_type
+            if subnet_id:
+                override['SubnetId'] = subnet_id
+            if override:
+                overrides.append(override)
 
     # Define the EC2 Fleet request configuration
     fleet_config = {
@@ -36,9 +94,9 @@ def create_ec2_fleet(ec2_client, args, launch_template_id, total_capacity, on_de
             {
                 'LaunchTemplateSpecification': {
                     'LaunchTemplateId': launch_template_id,
-                    'Version': '$Latest',
+                    'Version': str(launch_template_version),
                 },
-                'Overrides': [],
+                'Overrides': overrides,
             },
         ],
         'OnDemandOptions': {
@@ -50,6 +108,8 @@ def create_ec2_fleet(ec2_client, args, launch_template_id, total_capacity, on_de
         },
         'Type': 'instant',
     }
+    if tags:
+        fleet_config['TagSpecifications'] = [{'ResourceType': 'fleet', 'Tags': tags}]
 
     # Make the API call to launch the EC2 Fleet
     response = ec2_client.create_fleet(
@@ -57,7 +117,8 @@ def create_ec2_fleet(ec2_client, args, launch_template_id, total_capacity, on_de
         TargetCapacitySpecification=fleet_config['TargetCapacitySpecification'],
         SpotOptions=fleet_config['SpotOptions'],
         OnDemandOptions=fleet_config['OnDemandOptions'],
-        Type=fleet_config['Type']
+        Type=fleet_config['Type'],
+        **({'TagSpecifications': fleet_config['TagSpecifications']} if tags else {})
     )
 
     print("EC2 Fleet request created successfully.")
@@ -69,21 +130,40 @@ def create_ec2_fleet(ec2_client, args, launch_template_id, total_capacity, on_de
     for instance in response['Instances']:
         for instance_data in instance['InstanceIds']:
             instance_ids.append(instance_data)
+        # With several overrides, say which capacity pools the instances came from
+        pool = instance.get('LaunchTemplateAndOverrides', {}).get('Overrides', {})
+        if len(overrides) > 1:
+            print(f"  {len(instance['InstanceIds'])} {instance.get('Lifecycle', '')} {instance.get('InstanceType')} in {pool.get('SubnetId') or pool.get('AvailabilityZone') or 'the launch template subnet'}")
 
     # Extract fleet ID from the response
     fleet_id = response['FleetId']
 
     print(f"Fleet ID: {fleet_id}")
     print(f"Instances launched: {instance_ids}")
+
+    # An instant fleet reports capacity it could not launch here rather than failing the call
+    for error in fleet_errors(response):
+        print(f"Fleet {fleet_id} could not launch all instances: {error}")
     return fleet_id, instance_ids
 
+def fleet_errors(response):
+    """Return a readable line for each entry of the Errors list of a CreateFleet response."""
+    errors = []
+    for error in response.get('Errors', []):
+        overrides = error.get('LaunchTemplateAndOverrides', {}).get('Overrides', {})
+        where = ' '.join(str(value) for value in (overrides.get('InstanceType'), overrides.get('SubnetId'), overrides.get('AvailabilityZone')) if value)
+        errors.append(f"{error.get('ErrorCode')} ({error.get('Lifecycle', 'unknown')}{' ' + where if where else ''}): {error.get('ErrorMessage')}")
+    return errors
+
 def delete_ec2_fleet(ec2_client, fleet_id):
-    """Delete an EC2 fleet."""
+    """Delete an EC2 fleet. Returns True if it was deleted."""
     try:
         ec2_client.delete_fleets(
             FleetIds=[fleet_id],
             TerminateInstances=True  # Also terminates the instances in the fleet
         )
         print(f"Fleet {fleet_id} deleted successfully.")
+        return True
     except Exception as e:
-        print(f"Error deleting fleet {fleet_id}: {e}")
\ No newline at end of file
+        print(f"Error deleting fleet {fleet_id}: {e}")
+        return False
\ No newline at end of file
@@ -0,0 +1,388 @@
+# ec2_fleet_orchestrator.py
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from ec2_console_scheduler import ConsoleSessionScheduler
+from ec2_instance_state_tracker import InstanceStateError, InstanceTerminatedError, FINAL_STATES
+from ec2_sweep_helper import next_wave
+from ec2_warm_pool_helper import warm_pool_sizes
+
+# Per-stage concurrency limits, overridden by the 'concurrency' section of config.yaml
+DEFAULT_CONCURRENCY = {
+    # Serial console sessions open at the same time
+    'max_console_sessions': 20,
+    # EC2 / EC2 Instance Connect API calls in flight at the same time
+    'max_ec2_calls': 10,
+    # Threads available for blocking boto3 and paramiko calls - defaults to enough for both limits above
+    'executor_workers': None,
+    # Seconds an instance may take to reach 'running', and to reach 'stopped' once it has its job - the whole
+    # benchmark. An instance that takes longer fails its job, so one hung instance cannot hold up the run.
+    'running_timeout': 600,
+    'stopped_timeout': 3600,
+}
+
+
+# How lost spot capacity is replaced during a wave, overridden by the 'backfill' section of config.yaml
+DEFAULT_BACKFILL = {
+    # Follow-up fleets per instance type and wave, for fleets that came up short and for terminated instances
+    'max_follow_up_fleets': 10,
+    # Times a job may lose its instance before it counts as failed
+    'max_interruptions': 3,
+    # Seconds before the first follow-up fleet, doubling for each one after it
+    'retry_delay': 5,
+    'max_retry_delay': 60,
+    # Subnets, e.g. in other availability zones, that follow-up fleets may also launch into
+    'subnet_ids': [],
+    # Whether follow-up fleets ask for on-demand instead of spot capacity
+    'on_demand': False,
+}
+
+
+def load_backfill(settings):
+    """Merge the optional 'backfill' section of config.yaml over the defaults."""
+    backfill = dict(DEFAULT_BACKFILL)
+    backfill.update(settings or {})
+    return backfill
+
+
+def load_concurrency(config):
+    """Merge the optional 'concurrency' section of config.yaml over the defaults."""
+    concurrency = dict(DEFAULT_CONCURRENCY)
+    concurrency.update(config.get('concurrency') or {})
+    if not concurrency['executor_workers']:
+        concurrency['executor_workers'] = concurrency['max_console_sessions'] + concurrency['max_ec2_calls']
+    return concurrency
+
+
+class FleetOrchestrator:
+    """Run one coroutine pipeline per instance on a single event loop.
+
+    Blocking boto3 and paramiko calls go to a fixed-size thread pool, gated per stage - EC2 calls by a semaphore,
+    serial console sessions by a ConsoleSessionScheduler - so the number of OS threads depends on the concurrency
+    limits rather than on the size of the fleet.
+    """
+
+    def __init__(self, state_tracker, concurrency):
+        self.state_tracker = state_tracker
+        self.concurrency = concurrency
+        self.loop = None
+        self.executor = None
+        self.ec2_calls = None
+        self.console_sessions = None
+        self._waiters = {}
+        # time.monotonic() at which each instance was first seen 'running' since it last started
+        self._running_since = {}
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency['executor_workers'], thread_name_prefix='fleet-worker')
+        self.ec2_calls = asyncio.Semaphore(self.concurrency['max_ec2_calls'])
+        self.console_sessions = ConsoleSessionScheduler(self.concurrency['max_console_sessions'])
+        self.state_tracker.add_listener(self._on_state_change)
+
+    def shutdown(self):
+        self.state_tracker.remove_listener(self._on_state_change)
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+    async def run_blocking(self, semaphore, func, *args):
+        """Run a blocking call on the executor once a slot in the given stage semaphore (if any) is free."""
+        if semaphore is None:
+            return await self.loop.run_in_executor(self.executor, func, *args)
+        async with semaphore:
+            return await self.loop.run_in_executor(self.executor, func, *args)
+
+    async def call_ec2(self, func, *args):
+        return await self.run_blocking(self.ec2_calls, func, *args)
+
+    async def run_console(self, func, *args):
+        """Run a serial console session - the caller must hold a slot from console_sessions.acquire()."""
+        return await self.run_blocking(None, func, *args)
+
+    def running_since(self, instance_id):
+        """Return the time.monotonic() at which instance_id was seen entering 'running', or None."""
+        return self._running_since.get(instance_id)
+
+    async def wait_for_state(self, instance_id, states, timeout=None):
+        """Wait for the state tracker to report instance_id in one of states, without holding a thread.
+
+        Raises InstanceStateError if it has not after timeout seconds, if given.
+        """
+        if isinstance(states, str):
+            states = (states,)
+        future = self.loop.create_future()
+        self._waiters.setdefault(instance_id, []).append((states, future))
+        # The tracker may already have seen the state before we registered
+        self._resolve(instance_id, self.state_tracker.get_state(instance_id))
+        if timeout is None:
+            return await future
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            raise InstanceStateError(f"Instance {instance_id} did not reach {' or '.join(states)} within {timeout}s.") from None
+
+    def _on_state_change(self, instance_id, old_state, new_state, instance):
+        # Called on the tracker thread - hand the event over to the event loop
+        self.loop.call_soon_threadsafe(self._resolve, instance_id, new_state)
+
+    def _resolve(self, instance_id, state):
+        if state == 'running':
+            self._running_since.setdefault(instance_id, time.monotonic())
+        else:
+            self._running_since.pop(instance_id, None)
+        waiting = []
+        for states, future in self._waiters.get(instance_id, []):
+            if future.done():
+                continue
+            if state in states:
+                future.set_result(state)
+            elif state in FINAL_STATES:
+                future.set_exception(InstanceTerminatedError(instance_id, self.state_tracker.termination_reason(instance_id)))
+            else:
+                waiting.append((states, future))
+        if waiting:
+            self._waiters[instance_id] = waiting
+        else:
+            self._waiters.pop(instance_id, None)
+
+    async def run(self, pipelines):
+        """Run the given pipeline coroutines to completion. A failed pipeline does not stop the others."""
+        results = await asyncio.gather(*pipelines, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                print(f"Instance pipeline failed: {result}")
+        return results
+
+    async def run_jobs(self, jobs, capacity, launch_fleet, finish_fleet, make_pipeline, backfill=None, pending=None):
+        """Work through jobs in waves of at most capacity instances.
+
+        launch_fleet(instance_type, count, attempt) returns (fleet_id, instance_ids) for a new fleet, attempt
+        being 0 for the first fleet of a wave and counting up for follow-up fleets. make_pipeline(instance_id,
+        job_queue) returns a coroutine that takes its job off the queue once the instance is running and returns
+        the job when it has run.
+
+        Capacity lost during a wave is backfilled straight away: a fleet that comes up short is followed by
+        another for the missing instances, and a job whose instance is terminated under it (InstanceTerminatedError)
+        goes back on the queue with a replacement instance launched for it, up to the limits in backfill. Jobs
+        left unclaimed at the end of a wave go into the next one. Returns (completed_jobs, failed_jobs).
+
+        Given pending, a list shared with run_jobs() of other orchestrators on the same loop (one per region, say),
+        waves are taken from and unclaimed jobs returned to that list instead of a copy of jobs, and jobs still in
+        it when no instance of this orchestrator picks any up are left to the others rather than failed.
+        """
+        backfill = load_backfill(backfill)
+        shared = pending is not None
+        if not shared:
+            pending = list(jobs)
+        completed = []
+        failed = []
+        interruptions = {}
+        while pending:
+            wave = next_wave(pending, capacity)
+            job_queues = {}
+            for instance_type, wave_jobs in wave.items():
+                job_queues[instance_type] = asyncio.Queue()
+                for job in wave_jobs:
+                    job_queues[instance_type].put_nowait(job)
+
+            fleets = []
+            tasks = {}
+            follow_ups = {instance_type: 0 for instance_type in wave}
+
+            def launch(instance_type, count, attempt, delay=0):
+                task = asyncio.ensure_future(self._launch_fleet(launch_fleet, instance_type, count, attempt, delay))
+                tasks[task] = ('launch', instance_type, count, attempt)
+
+            def backfill_launch(instance_type, count, reason):
+                if follow_ups[instance_type] >= backfill['max_follow_up_fleets']:
+                    print(f"Not replacing {count} {instance_type} instances ({reason}): {backfill['max_follow_up_fleets']} follow-up fleets already requested in this wave.")
+                    return
+                follow_ups[instance_type] += 1
+                attempt = follow_ups[instance_type]
+                delay = min(backfill['retry_delay'] * 2 ** (attempt - 1), backfill['max_retry_delay'])
+                print(f"Requesting {count} replacement {instance_type} instances in {delay:.0f}s ({reason}).")
+                launch(instance_type, count, attempt, delay)
+
+            for instance_type, wave_jobs in wave.items():
+                launch(instance_type, len(wave_jobs), 0)
+
+            while tasks:
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    kind, instance_type, *details = tasks.pop(task)
+                    if kind == 'launch':
+                        count, attempt = details
+                        try:
+                            fleet_id, instance_ids = task.result()
+                        except Exception as e:
+                            print(f"Error launching a fleet of {instance_type} instances: {e}")
+                            fleet_id, instance_ids = None, []
+                        if fleet_id is not None:
+                            fleets.append((fleet_id, instance_ids))
+                        self.state_tracker.track(instance_ids)
+                        for instance_id in instance_ids:
+                            tasks[asyncio.ensure_future(make_pipeline(instance_id, job_queues[instance_type]))] = ('pipeline', instance_type, instance_id)
+                        if len(instance_ids) < count:
+                            backfill_launch(instance_type, count - len(instance_ids), f"fleet launched {len(instance_ids)} of {count}")
+                        continue
+
+                    try:
+                        result = task.result()
+                    except InstanceTerminatedError as e:
+                        job = e.job
+                        if job is not None:
+                            interruptions[job['job_id']] = interruptions.get(job['job_id'], 0) + 1
+                            if interruptions[job['job_id']] > backfill['max_interruptions']:
+                                print(f"Job {job['job_id']} lost its instance {interruptions[job['job_id']]} times, giving up on it.")
+                                failed.append(job)
+                                continue
+                            print(f"Job {job['job_id']} lost instance {e.instance_id}, putting it back on the queue.")
+                            job_queues[instance_type].put_nowait(job)
+                        backfill_launch(instance_type, 1, f"instance {e.instance_id} terminated")
+                        continue
+                    except Exception as e:
+                        print(f"Instance pipeline failed: {e}")
+                        continue
+                    if isinstance(result, dict):
+                        completed.append(result)
+
+            # Jobs nobody picked up are retried in the next wave, jobs that were picked up but did not
+            # finish have failed
+            unclaimed = []
+            for job_queue in job_queues.values():
+                while not job_queue.empty():
+                    unclaimed.append(job_queue.get_nowait())
+            for fleet_id, instance_ids in fleets:
+                for instance_id in instance_ids:
+                    self.state_tracker.untrack(instance_id)
+                await self.call_ec2(finish_fleet, fleet_id)
+            settled = {job['job_id'] for job in unclaimed} | {job['job_id'] for job in completed} | {job['job_id'] for job in failed}
+            wave_jobs = [job for wave_jobs in wave.values() for job in wave_jobs]
+            claimed = [job for job in wave_jobs if job['job_id'] not in {unclaimed_job['job_id'] for unclaimed_job in unclaimed}]
+            failed.extend(job for job in wave_jobs if job['job_id'] not in settled)
+            pending.extend(unclaimed)
+
+            done_ids = {job['job_id'] for job in completed}
+            print(f"Wave finished: {sum(1 for job in claimed if job['job_id'] in done_ids)} of {len(claimed)} jobs completed, {len(pending)} jobs remaining.")
+            if not claimed:
+                if shared:
+                    print(f"No instance in this wave picked up a job, leaving {len(pending)} remaining jobs to the other fleets.")
+                    break
+                print(f"No instance in this wave picked up a job, giving up on {len(pending)} remaining jobs.")
+                failed.extend(pending)
+                break
+
+        return completed, failed
+
+    async def run_resumed(self, instances, make_pipeline):
+        """Finish the jobs of an interrupted run whose instances it had already booted.
+
+        instances is a list of (instance_id, job), and make_pipeline(instance_id, job) returns a coroutine that
+        returns the job once its instance has finished it. Instances EC2 no longer knows about are not waited for.
+        Returns (completed_jobs, failed_jobs).
+        """
+        if not instances:
+            return [], []
+        self.state_tracker.track([instance_id for instance_id, _ in instances])
+        # One poll up front, as an instance that was terminated long enough ago is never reported again
+        await self.call_ec2(self.state_tracker.poll_once)
+        pipelines = []
+        failed = []
+        for instance_id, job in instances:
+            if self.state_tracker.get_state(instance_id) is None:
+                print(f"Instance {instance_id} of resumed job {job['job_id']} no longer exists.")
+                self.state_tracker.untrack(instance_id)
+                failed.append(job)
+                continue
+            pipelines.append(make_pipeline(instance_id, job))
+
+        results = await self.run(pipelines)
+        completed = [result for result in results if isinstance(result, dict)]
+        for instance_id, _ in instances:
+            self.state_tracker.untrack(instance_id)
+        done_ids = {job['job_id'] for job in completed}
+        failed.extend(job for instance_id, job in instances if job['job_id'] not in done_ids and job not in failed)
+        print(f"Resumed instances finished: {len(completed)} of {len(instances)} jobs completed.")
+        return completed, failed
+
+    async def _launch_fleet(self, launch_fleet, instance_type, count, attempt, delay):
+        if delay:
+            await asyncio.sleep(delay)
+        return await self.call_ec2(launch_fleet, instance_type, count, attempt)
+
+    async def run_warm_pool(self, jobs, capacity, warm_instances, launch_instances, make_pipeline, job_queues=None):
+        """Work through jobs on a pool of at most capacity reusable instances.
+
+        Capacity is shared between instance types by warm_pool_sizes(). Each type uses its stopped instances in
+        warm_instances ({instance_type: [instance_id, ...]}) first, topped up by launch_instances(instance_type,
+        count), which returns the IDs of the new instances. make_pipeline(instance_id, job_queue) returns a
+        coroutine that keeps taking jobs of its instance type off the queue and returns the list it completed.
+        Returns (completed_jobs, failed_jobs).
+
+        Given job_queues ({instance_type: asyncio.Queue}) shared with the warm pools of other orchestrators on the
+        same loop, jobs are taken from those instead, and failed_jobs only makes sense across all of them.
+        """
+        sizes = warm_pool_sizes(jobs, capacity)
+        if job_queues is None:
+            job_queues = warm_pool_queues(jobs)
+
+        pool = {instance_type: list(warm_instances.get(instance_type, []))[:size] for instance_type, size in sizes.items()}
+        shortfall = [(instance_type, size - len(pool[instance_type])) for instance_type, size in sizes.items() if size > len(pool[instance_type])]
+        for instance_type, size in sizes.items():
+            print(f"Warm pool: {len(pool[instance_type])} stopped {instance_type} instances reused, {size - len(pool[instance_type])} to launch.")
+        launches = await asyncio.gather(
+            *(self.call_ec2(launch_instances, instance_type, count) for instance_type, count in shortfall),
+            return_exceptions=True
+        )
+        for (instance_type, count), launched in zip(shortfall, launches):
+            if isinstance(launched, Exception):
+                print(f"Error launching {count} {instance_type} instances for the warm pool: {launched}")
+                continue
+            pool[instance_type].extend(launched)
+
+        pipelines = []
+        for instance_type, instance_ids in pool.items():
+            self.state_tracker.track(instance_ids)
+            pipelines.extend(make_pipeline(instance_id, job_queues[instance_type]) for instance_id in instance_ids)
+
+        results = await self.run(pipelines)
+        completed = [job for result in results if isinstance(result, list) for job in result]
+        for instance_ids in pool.values():
+            for instance_id in instance_ids:
+                self.state_tracker.untrack(instance_id)
+
+        done_ids = {job['job_id'] for job in completed}
+        failed = [job for job in jobs if job['job_id'] not in done_ids]
+        print(f"Warm pool run finished: {len(completed)} of {len(jobs)} jobs completed on {sum(len(ids) for ids in pool.values())} instances.")
+        return completed, failed
+
+
+def warm_pool_queues(jobs):
+    """Return {instance_type: asyncio.Queue} holding jobs, for run_warm_pool()."""
+    job_queues = {}
+    for job in jobs:
+        job_queues.setdefault(job['instance_type'], asyncio.Queue()).put_nowait(job)
+    return job_queues
+
+
+def run_fleet(state_tracker, concurrency, make_main):
+    """Run the coroutine returned by make_main(orchestrator) on a new event loop."""
+    return run_fleets([state_tracker], [concurrency], lambda orchestrators: make_main(orchestrators[0]))
+
+
+def run_fleets(state_trackers, concurrencies, make_main):
+    """Run the coroutine returned by make_main(orchestrators) on a new event loop, with one orchestrator for each
+    state tracker and its concurrency limits - e.g. one per region, each with its own clients and limits."""
+
+    async def main():
+        orchestrators = [FleetOrchestrator(state_tracker, concurrency) for state_tracker, concurrency in zip(state_trackers, concurrencies)]
+        for orchestrator in orchestrators:
+            await orchestrator.start()
+        try:
+            return await make_main(orchestrators)
+        finally:
+            for orchestrator in orchestrators:
+                orchestrator.shutdown()
+
+    return asyncio.run(main())
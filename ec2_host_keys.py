@@ -0,0 +1,247 @@
+# ec2_host_keys.py
+
+import base64
+import hashlib
+import hmac
+import os
+import re
+import threading
+from ec2_region_helper import serial_console_endpoint_for
+
+"""
+Example of serial console host key settings in config.yaml:
+
+serial_console_host_keys:
+  # SHA256 fingerprints of the serial console endpoints, by region or endpoint, exactly as AWS publishes them in
+  # https://docs.aws.amazon.com/AWSEC2/latest/UserGuide/connect-to-serial-console.html#sc-endpoints-and-fingerprints
+  fingerprints:
+    eu-central-1: "SHA256:..."
+  # Also trust the host keys in this known_hosts file. Read once per run.
+  known_hosts_file: ~/.ssh/known_hosts
+  # Refuse endpoints with neither a fingerprint nor a known_hosts entry - a run checks this before it launches
+  # anything. Set to false to trust the first host key seen for each such endpoint for the rest of the run
+  # instead, which does not protect the first connection against a man in the middle.
+  strict: true
+"""
+
+DEFAULT_KNOWN_HOSTS_FILE = '~/.ssh/known_hosts'
+# 'SHA256:' and the unpadded base64 of a SHA256 digest, as ssh-keygen -l and the AWS documentation print them
+FINGERPRINT_PATTERN = re.compile(r'^SHA256:[A-Za-z0-9+/]{43}$')
+
+
+# paramiko is only imported once a session needs it, so 'fleet --check' can check the endpoints without it
+
+class HostKeyVerificationError(Exception):
+    """Raised when a serial console endpoint presents a host key we do not trust."""
+
+
+def host_key_fingerprint(key):
+    """Return the OpenSSH style SHA256 fingerprint of a paramiko key, as AWS publishes them."""
+    digest = hashlib.sha256(key.asbytes()).digest()
+    return 'SHA256:' + base64.b64encode(digest).decode('ascii').rstrip('=')
+
+
+def known_hosts_name(endpoint):
+    """Return the name paramiko and known_hosts use for an endpoint, e.g. '[127.0.0.1]:2222' for a port other than 22."""
+    hostname, _, port = endpoint.partition(':')
+    if port and int(port) != 22:
+        return f"[{hostname}]:{port}"
+    return hostname
+
+
+def known_hosts_entry_matches(pattern, name):
+    """True if one host pattern of a known_hosts line names name - plainly or, for hashed entries, as
+    '|1|<base64 salt>|<base64 HMAC-SHA1 of the name>'. Like paramiko, wildcards are not expanded."""
+    if not pattern.startswith('|1|'):
+        return pattern == name
+    try:
+        salt, digest = (base64.b64decode(part) for part in pattern[len('|1|'):].split('|'))
+    except ValueError:
+        return False
+    return hmac.compare_digest(hmac.new(salt, name.encode('utf-8'), hashlib.sha1).digest(), digest)
+
+
+def read_known_hosts_patterns(known_hosts_file):
+    """Return the host patterns of every key line of a known_hosts file, to tell which endpoints have an entry
+    without parsing the keys themselves."""
+    patterns = []
+    if not os.path.exists(known_hosts_file):
+        return patterns
+    with open(known_hosts_file, 'r') as known_hosts:
+        for line in known_hosts:
+            fields = line.split()
+            # paramiko ignores lines with @cert-authority or @revoked markers, and lines without a key
+            if len(fields) < 3 or fields[0].startswith(('#', '@')):
+                continue
+            patterns.extend(fields[0].split(','))
+    return patterns
+
+
+class HostKeyStore:
+    """Trusted host keys of the serial console endpoints, loaded once per run and shared by every session.
+
+    Replaces loading ~/.ssh/known_hosts and accepting any key in each connection. A host key is checked against
+    the configured fingerprints first, then known_hosts. An endpoint with neither is refused when strict, and
+    otherwise pinned to the first key it presents for the rest of the run.
+
+    The store also remembers the host key type, cipher and MAC each endpoint negotiated. Later connections offer
+    only those, so the server presents the host key that was verified and the key exchange has less to agree on.
+    """
+
+    def __init__(self):
+        self.fingerprints = {}
+        self.known_hosts_file = None
+        self.known_hosts_patterns = []
+        # paramiko.HostKeys of known_hosts_file, parsed at the first host key that has to be checked against it
+        self._known_hosts = None
+        self.strict = True
+        self._first_use = {}
+        self._transport_profiles = {}
+        self._lock = threading.Lock()
+
+    def configure(self, settings=None):
+        settings = settings or {}
+        fingerprints = {}
+        for name, values in (settings.get('fingerprints') or {}).items():
+            # Keys without a dot are region names, the rest are endpoints
+            endpoint = name if '.' in name else serial_console_endpoint_for(name)
+            fingerprints[known_hosts_name(endpoint)] = set([values] if isinstance(values, str) else values)
+        known_hosts_file = os.path.expanduser(settings.get('known_hosts_file', DEFAULT_KNOWN_HOSTS_FILE))
+        known_hosts_patterns = read_known_hosts_patterns(known_hosts_file)
+        with self._lock:
+            self.fingerprints = fingerprints
+            self.known_hosts_file = known_hosts_file
+            self.known_hosts_patterns = known_hosts_patterns
+            self._known_hosts = None
+            self.strict = settings.get('strict', True)
+            self._first_use = {}
+            self._transport_profiles = {}
+        return self
+
+    def untrusted(self, endpoints):
+        """Return the endpoints with neither a configured fingerprint nor a known_hosts entry - refused when strict,
+        and trusted on first use otherwise."""
+        names = [known_hosts_name(endpoint) for endpoint in endpoints]
+        return sorted({name for name in names if name not in self.fingerprints and not self.in_known_hosts(name)})
+
+    def in_known_hosts(self, hostname):
+        return any(known_hosts_entry_matches(pattern, hostname) for pattern in self.known_hosts_patterns)
+
+    def known_hosts(self):
+        """Return the paramiko.HostKeys of the known_hosts file, parsed once per run."""
+        import paramiko
+        with self._lock:
+            if self._known_hosts is None:
+                self._known_hosts = paramiko.HostKeys()
+                if self.known_hosts_patterns:
+                    self._known_hosts.load(self.known_hosts_file)
+            return self._known_hosts
+
+    def trusted_on_first_use(self):
+        """Return {hostname: fingerprint} of the host keys this run trusted on first use."""
+        with self._lock:
+            return dict(self._first_use)
+
+    def verify(self, hostname, key):
+        """Raise HostKeyVerificationError unless key is trusted for hostname (in known_hosts_name() form)."""
+        fingerprint = host_key_fingerprint(key)
+        pinned = self.fingerprints.get(hostname)
+        if pinned is not None:
+            if fingerprint not in pinned:
+                raise HostKeyVerificationError(f"Host key {fingerprint} of {hostname} does not match its configured fingerprints {sorted(pinned)}.")
+            return
+
+        known = self.known_hosts().lookup(hostname) if self.in_known_hosts(hostname) else None
+        if known is not None and key.get_name() in known:
+            if known[key.get_name()] != key:
+                raise HostKeyVerificationError(f"Host key {fingerprint} of {hostname} does not match its known_hosts entry.")
+            return
+
+        if self.strict:
+            raise HostKeyVerificationError(f"No trusted host key for {hostname} (got {fingerprint}) - add its fingerprint to serial_console_host_keys.")
+        with self._lock:
+            first = self._first_use.get(hostname)
+            if first is None:
+                self._first_use[hostname] = fingerprint
+        if first is None:
+            print(f"Warning: trusting host key {fingerprint} of {hostname} on first use - pin it under serial_console_host_keys.")
+        elif first != fingerprint:
+            raise HostKeyVerificationError(f"Host key {fingerprint} of {hostname} changed during the run, it was {first}.")
+
+    def policy(self):
+        return PinnedHostKeyPolicy(self)
+
+    def connect_options(self, hostname):
+        """Return extra SSHClient.connect() arguments for hostname, from what it negotiated before."""
+        with self._lock:
+            profile = self._transport_profiles.get(hostname)
+        if profile is None:
+            return {}
+        import paramiko
+        return {'disabled_algorithms': {
+            'keys': [name for name in paramiko.Transport._preferred_keys if name != profile['host_key_type']],
+            'ciphers': [name for name in paramiko.Transport._preferred_ciphers if name != profile['cipher']],
+            'macs': [name for name in paramiko.Transport._preferred_macs if name != profile['mac']],
+        }}
+
+    def remember_transport(self, hostname, transport):
+        with self._lock:
+            self._transport_profiles[hostname] = {
+                'host_key_type': transport.host_key_type,
+                'cipher': transport.local_cipher,
+                'mac': transport.local_mac,
+            }
+
+    def forget_transport(self, hostname):
+        """Negotiate from scratch next time, e.g. after a connection with the remembered settings failed."""
+        with self._lock:
+            self._transport_profiles.pop(hostname, None)
+
+
+class PinnedHostKeyPolicy:
+    """Check every host key against a HostKeyStore - the SSHClient itself is given no host keys, so paramiko asks
+    this policy about each one. paramiko only calls missing_host_key(), so this need not subclass its
+    MissingHostKeyPolicy."""
+
+    def __init__(self, store):
+        self.store = store
+
+    def missing_host_key(self, client, hostname, key):
+        self.store.verify(hostname, key)
+
+
+def configure_host_keys(config):
+    """Apply the optional 'serial_console_host_keys' section of config.yaml to the shared host key store."""
+    return host_key_store.configure(config.get('serial_console_host_keys'))
+
+
+def check_host_keys(config, endpoints):
+    """Configure the shared store and say up front whether the serial console endpoints can be trusted. Returns
+    False if the store is strict and an endpoint has no trusted host key, so the run would fail every job."""
+    store = configure_host_keys(config)
+    malformed = sorted({fingerprint for fingerprints in store.fingerprints.values() for fingerprint in fingerprints if not FINGERPRINT_PATTERN.match(str(fingerprint))})
+    if malformed:
+        print(f"Error: serial_console_host_keys fingerprints must be SHA256 fingerprints like the ones AWS publishes, not {', '.join(malformed)}.")
+        return False
+    untrusted = store.untrusted(endpoints)
+    if not untrusted:
+        return True
+    if store.strict:
+        print(f"Error: no trusted host key for the serial console endpoint(s) {', '.join(untrusted)}. Add the SHA256 fingerprints AWS "
+              f"publishes for them under serial_console_host_keys fingerprints (see the README), or add them to the known_hosts_file.")
+        return False
+    print("*" * 100)
+    print(f"WARNING: serial_console_host_keys strict is off, and {', '.join(untrusted)} have no trusted host key. The first key each")
+    print("presents is trusted for the run, so the first connection is open to a man in the middle. Pin their fingerprints.")
+    print("*" * 100)
+    return True
+
+
+def report_first_use():
+    """Remind at the end of a run of every host key it trusted on first use."""
+    for hostname, fingerprint in sorted(host_key_store.trusted_on_first_use().items()):
+        print(f"WARNING: host key {fingerprint} of {hostname} was trusted on first use - verify it against the fingerprint AWS publishes, and pin it.")
+
+
+# Shared by every serial console session of a run
+host_key_store = HostKeyStore()
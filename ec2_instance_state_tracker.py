@@ -0,0 +1,210 @@
+# ec2_instance_state_tracker.py
+
+import threading
+import time
+from botocore.exceptions import ClientError
+
+# DescribeInstances accepts up to 1000 instance IDs per call
+DESCRIBE_BATCH_SIZE = 1000
+# Filters accept at most 200 values, used when a batch contains IDs EC2 does not know about yet
+FILTER_BATCH_SIZE = 200
+
+# States an instance passes through on its way somewhere else - while any tracked instance is in one
+# of these we poll at the fastest interval
+TRANSITIONAL_STATES = ('pending', 'stopping', 'shutting-down')
+# States an instance never leaves
+FINAL_STATES = ('terminated',)
+
+THROTTLE_ERROR_CODES = ('RequestLimitExceeded', 'Throttling', 'ThrottlingException')
+
+
+class InstanceStateError(Exception):
+    """Raised when an instance cannot reach the state a worker is waiting for."""
+
+
+class InstanceTerminatedError(InstanceStateError):
+    """Raised when an instance was terminated under a worker, e.g. by a spot interruption.
+
+    job is the job the instance was running, if it had taken one, so that it can be run again elsewhere.
+    """
+
+    def __init__(self, instance_id, reason=None, job=None):
+        self.instance_id = instance_id
+        self.reason = reason
+        self.job = job
+        super().__init__(f"Instance {instance_id} was terminated" + (f": {reason}" if reason else "."))
+
+
+class InstanceStateTracker:
+    """Poll the state of every instance in a run with batched DescribeInstances calls.
+
+    One background thread makes a single DescribeInstances call per 1000 tracked instances each cycle,
+    instead of every worker running its own boto3 waiter. Workers block in wait_for_state() or register a
+    listener to receive state-change events.
+    """
+
+    def __init__(self, ec2_client, min_interval=2.0, max_interval=5.0, debug=False):
+        self.ec2_client = ec2_client
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.debug = debug
+        self.api_calls = 0
+
+        self._instances = {}
+        self._states = {}
+        self._listeners = []
+        self._condition = threading.Condition()
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def track(self, instance_ids):
+        """Start tracking instance_ids. New instances are polled on the next cycle."""
+        with self._condition:
+            for instance_id in instance_ids:
+                self._states.setdefault(instance_id, None)
+        self.interval = self.min_interval
+        self._wake.set()
+
+    def untrack(self, instance_id):
+        with self._condition:
+            self._states.pop(instance_id, None)
+            self._instances.pop(instance_id, None)
+
+    def add_listener(self, callback):
+        """Call callback(instance_id, old_state, new_state, instance) from the polling thread on every state change."""
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        self._listeners.remove(callback)
+
+    def get_state(self, instance_id):
+        with self._condition:
+            return self._states.get(instance_id)
+
+    def get_instance(self, instance_id):
+        """Return the most recent DescribeInstances data for instance_id, or None if it has not been seen yet."""
+        with self._condition:
+            return self._instances.get(instance_id)
+
+    def termination_reason(self, instance_id):
+        """Return the StateReason message EC2 gave for stopping or terminating instance_id, if any."""
+        instance = self.get_instance(instance_id) or {}
+        state_reason = instance.get('StateReason') or {}
+        return state_reason.get('Message') or state_reason.get('Code')
+
+    def wait_for_state(self, instance_id, states, timeout=None):
+        """Block until instance_id reaches one of states and return it.
+
+        Raises InstanceTerminatedError if the instance is terminated first, or InstanceStateError if timeout
+        seconds pass.
+        """
+        if isinstance(states, str):
+            states = (states,)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while True:
+                state = self._states.get(instance_id)
+                if state in states:
+                    return state
+                if state in FINAL_STATES:
+                    instance = self._instances.get(instance_id) or {}
+                    raise InstanceTerminatedError(instance_id, (instance.get('StateReason') or {}).get('Message'))
+                if instance_id not in self._states:
+                    raise InstanceStateError(f"Instance {instance_id} is not being tracked.")
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise InstanceStateError(f"Timed out waiting for instance {instance_id} to reach {'/'.join(states)} (last state: {state}).")
+                self._condition.wait(remaining)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='instance-state-tracker', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def poll_once(self):
+        """Refresh the state of every tracked instance. Returns True if any state changed."""
+        with self._condition:
+            instance_ids = list(self._states)
+
+        seen = {}
+        for start in range(0, len(instance_ids), DESCRIBE_BATCH_SIZE):
+            for instance in self._describe(instance_ids[start:start + DESCRIBE_BATCH_SIZE]):
+                seen[instance['InstanceId']] = instance
+
+        changes = []
+        with self._condition:
+            for instance_id, instance in seen.items():
+                if instance_id not in self._states:
+                    continue
+                old_state = self._states[instance_id]
+                new_state = instance['State']['Name']
+                self._instances[instance_id] = instance
+                if new_state != old_state:
+                    self._states[instance_id] = new_state
+                    changes.append((instance_id, old_state, new_state, instance))
+            if changes:
+                self._condition.notify_all()
+
+        for instance_id, old_state, new_state, instance in changes:
+            if self.debug:
+                print(f"Instance {instance_id}: {old_state} -> {new_state}")
+            for callback in self._listeners:
+                callback(instance_id, old_state, new_state, instance)
+        return bool(changes)
+
+    def _describe(self, instance_ids):
+        try:
+            return self._describe_pages(InstanceIds=instance_ids)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'InvalidInstanceID.NotFound':
+                raise
+        # Freshly launched instances can be unknown to DescribeInstances for a few seconds, which fails
+        # the whole batch. Filtering by ID instead just leaves them out until they appear.
+        instances = []
+        for start in range(0, len(instance_ids), FILTER_BATCH_SIZE):
+            instances.extend(self._describe_pages(
+                Filters=[{'Name': 'instance-id', 'Values': instance_ids[start:start + FILTER_BATCH_SIZE]}]
+            ))
+        return instances
+
+    def _describe_pages(self, **kwargs):
+        instances = []
+        paginator = self.ec2_client.get_paginator('describe_instances')
+        for page in paginator.paginate(**kwargs):
+            self.api_calls += 1
+            for reservation in page['Reservations']:
+                instances.extend(reservation['Instances'])
+        return instances
+
+    def _run(self):
+        while not self._stop.is_set():
+            # Cleared before polling rather than after waking, so a track() or stop() that arrives while the poll
+            # is in flight cuts the next wait short instead of being lost
+            self._wake.clear()
+            try:
+                changed = self.poll_once()
+                # Poll quickly while anything is moving, and back off while the fleet is idle in a state
+                with self._condition:
+                    moving = any(state is None or state in TRANSITIONAL_STATES for state in self._states.values())
+                if changed or moving:
+                    self.interval = self.min_interval
+                else:
+                    self.interval = min(self.interval * 1.5, self.max_interval)
+            except ClientError as e:
+                if e.response['Error']['Code'] in THROTTLE_ERROR_CODES:
+                    self.interval = min(self.interval * 2, self.max_interval * 4)
+                    print(f"DescribeInstances throttled, polling every {self.interval:.1f}s")
+                else:
+                    print(f"Error polling instance states: {e}")
+            except Exception as e:
+                print(f"Error polling instance states: {e}")
+
+            self._wake.wait(self.interval)
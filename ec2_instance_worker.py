@@ -1,48 +1,291 @@
-import boto3
-from botocore.exceptions import ClientError
 from ec2_enable_serial_helper import enable_serial_console
-from ec2_get_instance_ip_helper import get_instance_ip
-from ec2_send_serial_console_public_key import send_serial_console_ssh_public_key
-from ec2_send_serial_commands import connect_serial_console
+from ec2_instance_state_tracker import InstanceStateError, InstanceTerminatedError
+from ec2_send_serial_console_public_key import send_serial_console_key
+from ec2_send_serial_commands import connect_serial_console, SerialConsoleError, SerialConsoleConnectError, SerialConsoleAuthError
+from ec2_console_scheduler import load_serial_console
+from ec2_sweep_helper import tag_instance_with_job
+from ec2_console_capture import console_capture_from_config
+from ec2_warm_pool_helper import start_instance
+from botocore.exceptions import ClientError
+import asyncio
+import random
+import time
+from functools import partial
+from ec2_trace_helper import tracer
+from ec2_run_journal import journal
+from ec2_boot_mode_helper import load_boot_mode, uses_serial_console, new_boot_token
+
+# Seconds each step of driving GRUB may take once the menu is up
+STEP_TIMEOUT = 10
 
-def instance_worker(ec2_client, ec2_instance_connect, args, instance_id, public_key, private_key, serial_console_endpoint, kernel_arguments):
-    """Thread worker function to wait for instance to reach 'running' state and execute commands."""
-    ssm_client = boto3.client('ssm')
+async def instance_worker(orchestrator, ec2_client, ec2_instance_connect, args, config, instance_id, job_queue, key_provider, serial_console_endpoint):
+    """Pipeline for one instance: wait for 'running', take a job, push the key, drive the serial console, wait for 'stopped'.
 
-    # Wait for the instance to reach the 'running' state
-    waiter = ec2_client.get_waiter('instance_running')
+    Returns the job once the instance has booted with its kernel arguments and stopped, or None. Raises
+    InstanceTerminatedError, with the job if it had taken one, if the instance is terminated under it.
+    """
+
+    # Wait for the instance to reach the 'running' state - the shared tracker polls all instances in one call
     try:
         print(f"Waiting for instance {instance_id} to enter 'running' state...")
-        waiter.wait(InstanceIds=[instance_id])
+        with tracer.span('wait_running', instance_id):
+            await orchestrator.wait_for_state(instance_id, 'running', orchestrator.concurrency['running_timeout'])
         print(f"Instance {instance_id} is now running.")
-    except ClientError as e:
+    except InstanceTerminatedError as e:
+        print(f"Instance {instance_id} was lost before it could take a job: {e}")
+        raise
+    except InstanceStateError as e:
         print(f"Error waiting for instance {instance_id} to enter 'running' state: {e}")
         return
 
+    # Jobs are handed out as instances come up, so a slow instance does not hold up a job
+    try:
+        job = job_queue.get_nowait()
+    except asyncio.QueueEmpty:
+        print(f"No job left for instance {instance_id}.")
+        return
+
+    if await run_job(orchestrator, ec2_client, ec2_instance_connect, args, config, instance_id, job, key_provider, serial_console_endpoint):
+        return job
+
+
+async def warm_instance_worker(orchestrator, ec2_client, ec2_instance_connect, args, config, instance_id, job_queue, key_provider, serial_console_endpoint):
+    """Pipeline for one warm pool instance: run jobs off the queue one boot at a time until it is empty.
+
+    The instance may start out stopped (kept from an earlier run) or freshly launched. Each job after its first
+    boot restarts it with start_instances. Returns the list of jobs it completed.
+    """
+    completed = []
+    while True:
+        try:
+            with tracer.span('wait_ready', instance_id):
+                state = await orchestrator.wait_for_state(instance_id, ('running', 'stopped'), orchestrator.concurrency['running_timeout'])
+        except InstanceStateError as e:
+            # Nothing taken off the queue yet, so other instances of the pool pick up the remaining jobs
+            print(f"Error waiting for warm pool instance {instance_id}: {e}")
+            return completed
+
+        try:
+            job = job_queue.get_nowait()
+        except asyncio.QueueEmpty:
+            print(f"No job left for instance {instance_id}, leaving it {state}.")
+            return completed
+
+        if state == 'stopped':
+            try:
+                print(f"Starting warm pool instance {instance_id} for {job['job_id']}...")
+                with tracer.span('start_instance', instance_id, job_id=job['job_id']):
+                    await orchestrator.call_ec2(start_instance, ec2_client, instance_id)
+                    orchestrator.state_tracker.track([instance_id])
+                    await orchestrator.wait_for_state(instance_id, 'running', orchestrator.concurrency['running_timeout'])
+                print(f"Instance {instance_id} is now running.")
+            except (ClientError, InstanceStateError) as e:
+                print(f"Error starting warm pool instance {instance_id}, handing {job['job_id']} back: {e}")
+                job_queue.put_nowait(job)
+                return completed
+
+        # An instance that failed a job may still be booting the default entry, so it takes no more jobs this run
+        try:
+            if not await run_job(orchestrator, ec2_client, ec2_instance_connect, args, config, instance_id, job, key_provider, serial_console_endpoint, log_name=f"{instance_id}-{job['job_id']}"):
+                return completed
+        except InstanceTerminatedError as e:
+            print(f"{e} Handing {job['job_id']} back to the rest of the pool.")
+            job_queue.put_nowait(job)
+            return completed
+        completed.append(job)
+
+
+async def resumed_instance_worker(orchestrator, instance_id, job):
+    """Pipeline for an instance an interrupted run had already driven through GRUB: wait for it to stop.
+
+    The instance is running, or has run, the job with its kernel arguments, so it is not booted again. Returns
+    the job once the instance has stopped, or None if it was lost.
+    """
+    try:
+        print(f"Waiting for instance {instance_id}, resumed with {job['job_id']}, to enter 'stopped' state...")
+        with tracer.span('wait_stopped', instance_id, job_id=job['job_id'], resumed=True):
+            await orchestrator.wait_for_state(instance_id, 'stopped', orchestrator.concurrency['stopped_timeout'])
+        print(f"Instance {instance_id} is now stopped.")
+    except InstanceStateError as e:
+        print(f"Instance {instance_id} of resumed job {job['job_id']} was lost: {e}")
+        journal.job_stage(job, 'failed')
+        return None
+    journal.job_stage(job, 'completed')
+    return job
+
+
+async def check_terminated(orchestrator, instance_id, job, grace=10.0):
+    """Raise InstanceTerminatedError for job if instance_id turns out to be going away.
+
+    A spot interruption shows up first as whichever step was running failing, e.g. the serial console dropping,
+    before the tracker has seen the instance shut down - so give it up to grace seconds to catch up.
+    """
+    orchestrator.state_tracker.track([instance_id])
+    try:
+        await asyncio.wait_for(orchestrator.wait_for_state(instance_id, ('shutting-down', 'terminated')), grace)
+    except asyncio.TimeoutError:
+        return
+    raise InstanceTerminatedError(instance_id, orchestrator.state_tracker.termination_reason(instance_id), job)
+
+
+async def open_serial_console(orchestrator, ec2_instance_connect, key_provider, instance_id, job, slot, settings, connect):
+    """Push a key and run connect(private_key, kernel_arguments, menu_timeout=...) in the slot's serial console session.
+
+    The key is pushed only once the slot is held, as it expires about 60 seconds later. A rejected key is pushed
+    again and the session reconnected straight away. A refused connection hands the slot back and waits in line
+    for the next one, after a jittered backoff. Either happens up to max_connect_attempts times in all, or until
+    the GRUB deadline of the slot has passed.
+    """
+    attempt = 0
+    while True:
+        attempt += 1
+        print(f"Sending SSH public key to the serial console of instance {instance_id}...")
+        with tracer.span('push_key', instance_id, job_id=job['job_id']):
+            ssh_key = await orchestrator.call_ec2(send_serial_console_key, ec2_instance_connect, key_provider, instance_id)
+
+        print(f"Connecting to the serial console of instance {instance_id} and sending keystrokes...")
+        # Give up on the GRUB menu once it has most likely booted the default entry, rather than holding the slot
+        menu_timeout = max(slot.remaining(), 0) + STEP_TIMEOUT
+        try:
+            with tracer.span('console_session', instance_id, job_id=job['job_id']):
+                return await orchestrator.run_console(partial(connect, on_connected=partial(orchestrator.loop.call_soon_threadsafe, slot.connected), menu_timeout=menu_timeout, step_timeout=STEP_TIMEOUT), ssh_key.pkey, job['kernel_arguments'])
+        except SerialConsoleConnectError as e:
+            if attempt >= settings['max_connect_attempts'] or slot.remaining() <= 0:
+                raise
+            print(f"{e} Reconnecting with a new key (attempt {attempt + 1} of {settings['max_connect_attempts']}).")
+            if not isinstance(e, SerialConsoleAuthError):
+                with tracer.span('console_wait', instance_id, job_id=job['job_id']):
+                    await slot.refused(random.uniform(0, settings['retry_delay'] * 2 ** (attempt - 1)))
+
+
+async def drive_grub(orchestrator, ec2_instance_connect, config, instance_id, job, key_provider, serial_console_endpoint, log_name=None):
+    """Type the job's kernel arguments into the GRUB menu of a running instance over its serial console.
+
+    Returns (capture, reader) once the instance boots them, or None if the serial console could not be driven.
+    Without console capture both are None. With it, reader is the task recording the rest of the boot on the
+    orchestrator's executor, and the slot is handed back when it finishes - at the capture's until milestone or
+    max_seconds. Raises InstanceTerminatedError carrying the job if the instance is terminated under it.
+    """
     # Step 3: Enable serial console access
     enable_serial_console(instance_id)
 
-    # EC2 instance public IP or DNS, replace with your own instance's IP
-    if args.debug:
-        instance_ip = get_instance_ip(ec2_client, instance_id)
+    # Steps 5 and 6 - wait for a serial console slot, then send the SSH public key and connect to the serial
+    # console to send keystrokes, optionally recording the rest of the boot
+    settings = load_serial_console(config)
+    running_since = orchestrator.running_since(instance_id) or time.monotonic()
+    deadline = running_since + settings['grub_delay'] + settings['grub_timeout']
+    try:
+        with tracer.span('console_wait', instance_id, job_id=job['job_id']):
+            slot = await orchestrator.console_sessions.acquire(instance_id, deadline, settings['release_delay'])
+    except SerialConsoleError as e:
+        print(f"Error driving the serial console of instance {instance_id}: {e}")
+        return None
 
-    # Step 5 - send the SSH public key to the instance serial console
-    print("Sending SSH public key to the instance serial console...")
-    send_serial_console_ssh_public_key(ec2_instance_connect, instance_id, public_key)
+    capture = console_capture_from_config(config, instance_id, job, log_name)
+    try:
+        await open_serial_console(orchestrator, ec2_instance_connect, key_provider, instance_id, job, slot, settings,
+                                  partial(connect_serial_console, serial_console_endpoint, instance_id, capture=capture))
+    except ClientError:
+        slot.release()
+        if capture is not None:
+            capture.close()
+        await check_terminated(orchestrator, instance_id, job)
+        raise
+    except SerialConsoleError as e:
+        print(f"Error driving the serial console of instance {instance_id}: {e}")
+        slot.release()
+        if capture is not None:
+            capture.close()
+        await check_terminated(orchestrator, instance_id, job)
+        return None
+    except BaseException:
+        # Anything else - an OSError, an unwrapped paramiko error, cancellation - must not keep the slot either,
+        # or the scheduler is one session short for the rest of the run
+        slot.release()
+        if capture is not None:
+            capture.close()
+        raise
+    if capture is None:
+        slot.release()
+        return None, None
+    reader = asyncio.ensure_future(orchestrator.run_console(capture.read))
+    reader.add_done_callback(lambda _: slot.release())
+    return capture, reader
 
-    # Step 6 - connect to the serial console and send keystrokes
-    print("Connecting to the serial console and sending keystrokes...")
-    # Connect to serial console and send keystrokes
-    connect_serial_console(serial_console_endpoint, instance_id, private_key, kernel_arguments)
-    print("EC2 instance setup completed.")
 
-    # Wait for the instance to reach the 'running' state
-    print(f"Waiting for the EC2 instance {instance_id} to reach the stopped state...")
-    waiter = ec2_client.get_waiter('instance_stopped')
+async def finish_capture(orchestrator, capture, reader, wait=5.0):
+    """Stop the capture of an instance that has stopped and write its record. A capture still reading gets wait
+    seconds for the last of the shutdown before its session is closed."""
+    try:
+        await asyncio.wait_for(asyncio.shield(reader), wait)
+    except asyncio.TimeoutError:
+        await orchestrator.run_blocking(None, capture.stop)
+        await reader
+    return await orchestrator.run_blocking(None, capture.close)
+
+
+async def run_job(orchestrator, ec2_client, ec2_instance_connect, args, config, instance_id, job, key_provider, serial_console_endpoint, log_name=None):
+    """Boot a running instance with the job's kernel arguments and wait for it to stop. Returns True on success.
+
+    Raises InstanceTerminatedError carrying the job if the instance is terminated before the job has run.
+    """
+    kernel_arguments = job['kernel_arguments']
+    boot_mode = load_boot_mode(config)
+    # Record where the job actually runs - the fleet may have filled it from any of its capacity pools
+    instance = orchestrator.state_tracker.get_instance(instance_id) or {}
+    job['instance_id'] = instance_id
+    job['launched_instance_type'] = instance.get('InstanceType', job['instance_type'])
+    job['availability_zone'] = instance.get('Placement', {}).get('AvailabilityZone')
+    job['lifecycle'] = instance.get('InstanceLifecycle', 'on-demand')
+    job['region'] = config.get('region')
+    # Tagged on the instance with the job, for its userdata to put in the results (see ec2_userdata_helper.py)
+    job['run_id'] = journal.run_id
+    if not uses_serial_console(boot_mode):
+        job['boot_token'] = new_boot_token()
+    print(f"Instance {instance_id} ({job['launched_instance_type']}, {job['availability_zone']}, {job['lifecycle']}) runs {job['job_id']}: {kernel_arguments}")
+    journal.job_stage(job, 'claimed')
+    try:
+        await orchestrator.call_ec2(tag_instance_with_job, ec2_client, instance_id, job)
+    except ClientError as e:
+        print(f"Error tagging instance {instance_id} with {job['job_id']}: {e}")
+        journal.job_stage(job, 'failed')
+        return False
+
+    capture = None
+    reader = None
+    if uses_serial_console(boot_mode):
+        try:
+            booted = await drive_grub(orchestrator, ec2_instance_connect, config, instance_id, job, key_provider, serial_console_endpoint, log_name)
+        except ClientError as e:
+            print(f"Error driving the serial console of instance {instance_id}: {e}")
+            booted = None
+        if booted is None:
+            journal.job_stage(job, 'failed')
+            return False
+        capture, reader = booted
+        print(f"Instance {instance_id} setup completed.")
+    else:
+        # The userdata reads the job off the tags just set, and boots itself with its kernel arguments
+        print(f"Instance {instance_id} applies its kernel arguments itself ({boot_mode['mode']}).")
+    # From here on the job runs whether or not we are around to see it, so a resumed run only waits for it
+    journal.job_stage(job, 'booted')
+
+    # Wait for the instance to reach the 'stopped' state
     try:
         print(f"Waiting for instance {instance_id} to enter 'stopped' state...")
-        waiter.wait(InstanceIds=[instance_id])
+        with tracer.span('wait_stopped', instance_id, job_id=job['job_id']):
+            await orchestrator.wait_for_state(instance_id, 'stopped', orchestrator.concurrency['stopped_timeout'])
         print(f"Instance {instance_id} is now stopped.")
-    except ClientError as e:
+    except InstanceTerminatedError as e:
+        raise InstanceTerminatedError(instance_id, e.reason, job) from e
+    except InstanceStateError as e:
         print(f"Error waiting for instance {instance_id} to enter 'stopped' state: {e}")
-        return
\ No newline at end of file
+        journal.job_stage(job, 'failed')
+        return False
+    finally:
+        if capture is not None:
+            record = await finish_capture(orchestrator, capture, reader)
+            print(f"Instance {instance_id} boot timings: {record['milestones']}")
+
+    journal.job_stage(job, 'completed')
+    return True
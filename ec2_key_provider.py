@@ -0,0 +1,133 @@
+# ec2_key_provider.py
+
+import io
+import queue
+import threading
+import paramiko
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519
+
+# Key types the EC2 serial console accepts, in order of preference
+SUPPORTED_KEY_TYPES = ('ed25519', 'rsa')
+
+"""
+Example of serial console key settings in config.yaml:
+
+serial_console_keys:
+  # ed25519 keys are generated in microseconds, RSA keys take tens of milliseconds each
+  type: ed25519
+  # Give every instance its own key rather than sharing one for the whole run
+  per_instance: true
+  # Keys kept ready by a background thread when per_instance is set
+  pool_size: 20
+"""
+
+
+class SshKey:
+    """A generated key pair: the parsed paramiko key for connecting and the OpenSSH public key to push."""
+
+    def __init__(self, key_type, pkey, private_key_text):
+        self.key_type = key_type
+        self.pkey = pkey
+        self.private_key_text = private_key_text
+        self.public_key = f"{pkey.get_name()} {pkey.get_base64()}"
+
+
+def generate_key(key_type='ed25519'):
+    """Generate a key pair and parse it once, so workers never re-read PEM text."""
+    if key_type == 'ed25519':
+        # paramiko cannot generate ed25519 keys itself, so generate with cryptography and load the result
+        private_key = ed25519.Ed25519PrivateKey.generate()
+        private_key_text = private_key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.OpenSSH,
+            serialization.NoEncryption()
+        ).decode('utf-8')
+        pkey = paramiko.Ed25519Key(file_obj=io.StringIO(private_key_text))
+    elif key_type == 'rsa':
+        pkey = paramiko.RSAKey.generate(2048)
+        private_key_file = io.StringIO()
+        pkey.write_private_key(private_key_file)
+        private_key_text = private_key_file.getvalue()
+    else:
+        raise ValueError(f"Unsupported serial console key type {key_type}, expected one of {', '.join(SUPPORTED_KEY_TYPES)}")
+    return SshKey(key_type, pkey, private_key_text)
+
+
+class KeyProvider:
+    """Hand out serial console keys - one shared key for the run, or a fresh key per instance.
+
+    With per_instance set, a background thread keeps up to pool_size keys ready so generation does not sit on
+    the critical path of each instance.
+    """
+
+    def __init__(self, key_type='ed25519', per_instance=False, pool_size=0):
+        self.key_type = key_type
+        self.per_instance = per_instance
+        self.pool_size = pool_size
+        self._shared_key = None
+        self._pool = queue.Queue(maxsize=max(pool_size, 1))
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.per_instance and self.pool_size > 0:
+            self._thread = threading.Thread(target=self._fill_pool, name='ssh-key-pool', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def get_key(self):
+        if not self.per_instance:
+            with self._lock:
+                if self._shared_key is None:
+                    self._shared_key = generate_key(self.key_type)
+                return self._shared_key
+        if self._thread is not None:
+            while True:
+                key = self._pool.get()
+                # Keys generated before a fallback to another key type are thrown away
+                if key.key_type == self.key_type:
+                    return key
+        return generate_key(self.key_type)
+
+    def fall_back(self, rejected_key):
+        """Switch to the next supported key type after the serial console rejected rejected_key.
+
+        Returns False if there is no other key type left to try.
+        """
+        with self._lock:
+            if rejected_key.key_type != self.key_type:
+                # Another worker has already fallen back
+                return True
+            position = SUPPORTED_KEY_TYPES.index(self.key_type)
+            if position + 1 >= len(SUPPORTED_KEY_TYPES):
+                return False
+            self.key_type = SUPPORTED_KEY_TYPES[position + 1]
+            self._shared_key = None
+            print(f"Serial console rejected a {rejected_key.key_type} key, falling back to {self.key_type} keys.")
+            return True
+
+    def _fill_pool(self):
+        while not self._stop.is_set():
+            key = generate_key(self.key_type)
+            while not self._stop.is_set():
+                try:
+                    self._pool.put(key, timeout=0.5)
+                    break
+                except queue.Full:
+                    continue
+
+
+def key_provider_from_config(config):
+    settings = config.get('serial_console_keys') or {}
+    return KeyProvider(
+        key_type=settings.get('type', 'ed25519'),
+        per_instance=settings.get('per_instance', False),
+        pool_size=settings.get('pool_size', 0)
+    )
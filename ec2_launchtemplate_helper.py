@@ -1,88 +1,241 @@
-# ec2_fleet_helper.py
+# ec2_launchtemplate_helper.py
 
 import base64
+import hashlib
+import json
+import os
+import time
 from botocore.exceptions import ClientError
+# Local index of launch template versions by the hash of their LaunchTemplateData
+from ec2_region_helper import DEFAULT_CACHE_FILE
 
-def create_launch_template(ec2_client, template_name, ami_id, instance_type, key_name, security_group_ids, subnet_id, iam_instance_profile_arn, script_content):
+# Cached versions kept per template - the least recently used beyond this are deleted
+DEFAULT_MAX_VERSIONS = 5
+# Versions created by this tool carry the hash of their data in the description, so they can be found again
+# even without the local index
+HASH_DESCRIPTION_PREFIX = 'sha256:'
 
-    # Check if a launch template with the given name already exists
+
+def build_launch_template_data(template_name, ami_id, instance_type, key_name, security_group_ids, subnet_id, iam_instance_profile_arn, script_content, metadata_tags=False):
+    # Convert the shell script to base64 format - as bytes it may be gzipped already, see ec2_userdata_helper.py
+    if isinstance(script_content, str):
+        script_content = script_content.encode('utf-8')
+    user_data = base64.b64encode(script_content).decode('utf-8')
+
+    # Define the launch template configuration
+    launch_template_data = {
+        'ImageId': ami_id,
+        'InstanceType': instance_type,
+        'KeyName': key_name,
+        'IamInstanceProfile': {
+            'Arn': iam_instance_profile_arn
+        },
+        "NetworkInterfaces": [{
+            "AssociatePublicIpAddress": True,
+            "DeviceIndex": 0,
+            "Ipv6AddressCount": 0,
+            "SubnetId": subnet_id,
+            'Groups': security_group_ids
+        }],
+        'BlockDeviceMappings': [
+            {
+                'DeviceName': '/dev/sda1',
+                'Ebs': {
+                    'VolumeSize': 8,
+                    'VolumeType': 'gp3',
+                    'DeleteOnTermination': True
+                }
+            }
+        ],
+        'UserData': user_data,
+        'TagSpecifications': [
+            {
+                'ResourceType': 'instance',
+                'Tags': [{'Key': 'Name', 'Value': template_name + "_instance"}]
+            }
+        ]
+    }
+    if metadata_tags:
+        # Let the userdata read the instance's tags from the instance metadata service, see ec2_boot_mode_helper.py
+        # and ec2_userdata_helper.py
+        launch_template_data['MetadataOptions'] = {
+            'HttpEndpoint': 'enabled',
+            'HttpTokens': 'required',
+            'InstanceMetadataTags': 'enabled'
+        }
+    return launch_template_data
+
+
+def launch_template_data_hash(launch_template_data):
+    """Hash of the full LaunchTemplateData, independent of key order."""
+    canonical = json.dumps(launch_template_data, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def load_template_cache(cache_file):
+    if not os.path.exists(cache_file):
+        return {}
+    with open(cache_file, 'r') as cache:
+        return json.load(cache)
+
+
+def save_template_cache(cache_file, index):
+    # Write to a temporary file and rename, so an interrupted run cannot leave a half written index
+    temporary_file = cache_file + '.tmp'
+    with open(temporary_file, 'w') as cache:
+        json.dump(index, cache, indent=2, sort_keys=True)
+    os.replace(temporary_file, cache_file)
+
+
+def find_launch_template_id(ec2_client, template_name):
+    """Return the ID of the launch template with the given name, or None if there is none."""
     try:
         existing_template = ec2_client.describe_launch_templates(
             LaunchTemplateNames=[template_name]
         )
         if existing_template['LaunchTemplates']:
-            # If template exists, return its ID
-            launch_template_id = existing_template['LaunchTemplates'][0]['LaunchTemplateId']
-            print(f"Launch Template '{template_name}' already exists. LaunchTemplateId: {launch_template_id}")
-            return launch_template_id
+            return existing_template['LaunchTemplates'][0]['LaunchTemplateId']
     except ClientError as e:
         if e.response['Error']['Code'] == 'InvalidLaunchTemplateName.NotFoundException':
-            # If the template is not found, we'll create it
-            print(f"Launch Template '{template_name}' not found. Proceeding to create a new one.")
+            return None
+        # Handle other possible exceptions
+        print(f"Unexpected error occurred: {e}")
+        raise
+    return None
+
+
+def find_version_by_hash(ec2_client, launch_template_id, data_hash):
+    """Look through the template's versions for one created from the same data, e.g. by a run on another host."""
+    paginator = ec2_client.get_paginator('describe_launch_template_versions')
+    for page in paginator.paginate(LaunchTemplateId=launch_template_id):
+        for version in page['LaunchTemplateVersions']:
+            if version.get('VersionDescription') == HASH_DESCRIPTION_PREFIX + data_hash:
+                return version['VersionNumber']
+    return None
+
+
+def version_exists(ec2_client, launch_template_id, version):
+    try:
+        response = ec2_client.describe_launch_template_versions(
+            LaunchTemplateId=launch_template_id,
+            Versions=[str(version)]
+        )
+        return bool(response['LaunchTemplateVersions'])
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('InvalidLaunchTemplateId.NotFound', 'InvalidLaunchTemplateId.VersionNotFound', 'InvalidLaunchTemplateName.NotFoundException'):
+            return False
+        raise
+
+
+def expire_template_versions(ec2_client, entry, max_versions):
+    """Delete the least recently used cached versions beyond max_versions. The default version is never deleted."""
+    versions = sorted(entry['versions'].items(), key=lambda item: item[1]['last_used'], reverse=True)
+    expired = [(data_hash, cached) for data_hash, cached in versions[max_versions:] if cached['version'] != entry.get('default_version', 1)]
+    if not expired:
+        return
+    try:
+        ec2_client.delete_launch_template_versions(
+            LaunchTemplateId=entry['launch_template_id'],
+            Versions=[str(cached['version']) for _, cached in expired]
+        )
+    except ClientError as e:
+        print(f"Error expiring launch template versions: {e}")
+        return
+    for data_hash, cached in expired:
+        print(f"Expired launch template version {cached['version']} of {entry['launch_template_id']}")
+        del entry['versions'][data_hash]
+
+
+def tag_launch_template(ec2_client, launch_template_id, tags):
+    """Tag a launch template this run reuses, e.g. to move its expiry on (see ec2_resource_sweeper.py)."""
+    if not tags:
+        return
+    try:
+        ec2_client.create_tags(Resources=[launch_template_id], Tags=tags)
+    except ClientError as e:
+        print(f"Error tagging launch template {launch_template_id}: {e}")
+
+
+def create_launch_template(ec2_client, template_name, ami_id, instance_type, key_name, security_group_ids, subnet_id, iam_instance_profile_arn, script_content, cache_file=DEFAULT_CACHE_FILE, max_versions=DEFAULT_MAX_VERSIONS, metadata_tags=False, tags=None):
+    """Return (launch_template_id, version) of a launch template version matching exactly these inputs.
+
+    Versions are keyed by a hash of the full LaunchTemplateData. Unchanged inputs reuse the cached version from an
+    earlier run, and changed inputs get a new version of the same template rather than a stale match on its name.
+    tags go on the template whether it is created or reused.
+    """
+    launch_template_data = build_launch_template_data(template_name, ami_id, instance_type, key_name, security_group_ids, subnet_id, iam_instance_profile_arn, script_content, metadata_tags)
+    data_hash = launch_template_data_hash(launch_template_data)
+    description = HASH_DESCRIPTION_PREFIX + data_hash
+
+    index = load_template_cache(cache_file)
+    entry = index.get(template_name)
+
+    # Cache hit - one call to make sure nobody deleted the version since
+    if entry and data_hash in entry['versions']:
+        cached = entry['versions'][data_hash]
+        if version_exists(ec2_client, entry['launch_template_id'], cached['version']):
+            cached['last_used'] = time.time()
+            save_template_cache(cache_file, index)
+            tag_launch_template(ec2_client, entry['launch_template_id'], tags)
+            print(f"Launch Template '{template_name}' version {cached['version']} matches this configuration. LaunchTemplateId: {entry['launch_template_id']}")
+            return entry['launch_template_id'], cached['version']
+        del entry['versions'][data_hash]
+
+    launch_template_id = find_launch_template_id(ec2_client, template_name)
+    if launch_template_id is None:
+        print(f"Launch Template '{template_name}' not found. Proceeding to create a new one.")
+
+        # Make the API call to create the launch template
+        response = ec2_client.create_launch_template(
+            LaunchTemplateName=template_name,
+            VersionDescription=description,
+            LaunchTemplateData=launch_template_data,
+            **({'TagSpecifications': [{'ResourceType': 'launch-template', 'Tags': tags}]} if tags else {})
+        )
+        launch_template_id = response['LaunchTemplate']['LaunchTemplateId']
+        version = response['LaunchTemplate']['LatestVersionNumber']
+        print(f"Launch Template Created: {launch_template_id}")
+        entry = {'launch_template_id': launch_template_id, 'default_version': version, 'versions': {}}
+    else:
+        if not entry or entry['launch_template_id'] != launch_template_id:
+            entry = {'launch_template_id': launch_template_id, 'default_version': 1, 'versions': {}}
+        tag_launch_template(ec2_client, launch_template_id, tags)
+        version = find_version_by_hash(ec2_client, launch_template_id, data_hash)
+        if version is None:
+            response = ec2_client.create_launch_template_version(
+                LaunchTemplateId=launch_template_id,
+                VersionDescription=description,
+                LaunchTemplateData=launch_template_data
+            )
+            version = response['LaunchTemplateVersion']['VersionNumber']
+            print(f"Launch Template '{template_name}' configuration changed, created version {version}. LaunchTemplateId: {launch_template_id}")
         else:
-            # Handle other possible exceptions
-            print(f"Unexpected error occurred: {e}")
-            raise
+            print(f"Launch Template '{template_name}' version {version} matches this configuration. LaunchTemplateId: {launch_template_id}")
 
-    # Convert the shell script to base64 format
-    user_data = base64.b64encode(script_content.encode('utf-8')).decode('utf-8')
+    entry['versions'][data_hash] = {'version': version, 'last_used': time.time()}
+    index[template_name] = entry
+    expire_template_versions(ec2_client, entry, max_versions)
+    save_template_cache(cache_file, index)
+    return launch_template_id, version
 
-    # Define the launch template configuration
-    launch_template_config = {
-        'LaunchTemplateName': template_name,
-        'VersionDescription': 'Initial version',
-        'LaunchTemplateData': {
-            'ImageId': ami_id,
-            'InstanceType': instance_type,
-            'KeyName': key_name,
-            'IamInstanceProfile': {
-                'Arn': iam_instance_profile_arn
-            },
-            "NetworkInterfaces": [{
-                "AssociatePublicIpAddress": True,
-                "DeviceIndex": 0,
-                "Ipv6AddressCount": 0,
-                "SubnetId": subnet_id,
-                'Groups': security_group_ids
-            }],
-            'BlockDeviceMappings': [
-                {
-                    'DeviceName': '/dev/sda1',
-                    'Ebs': {
-                        'VolumeSize': 8,
-                        'VolumeType': 'gp3',
-                        'DeleteOnTermination': True
-                    }
-                }
-            ],
-            'UserData': user_data,
-            'TagSpecifications': [
-                {
-                    'ResourceType': 'instance',
-                    'Tags': [{'Key': 'Name', 'Value': template_name + "_instance"}]
-                }
-            ]
-        }
-    }
 
-    # Make the API call to create the launch template
-    response = ec2_client.create_launch_template(
-        LaunchTemplateName=launch_template_config['LaunchTemplateName'],
-        VersionDescription=launch_template_config['VersionDescription'],
-        LaunchTemplateData=launch_template_config['LaunchTemplateData']
-    )
+def forget_launch_template(launch_template_id, cache_file=DEFAULT_CACHE_FILE):
+    """Drop a deleted launch template from the local index."""
+    index = load_template_cache(cache_file)
+    remaining = {name: entry for name, entry in index.items() if entry['launch_template_id'] != launch_template_id}
+    if remaining != index:
+        save_template_cache(cache_file, remaining)
 
-    # Return the Launch Template ID
-    launch_template_id = response['LaunchTemplate']['LaunchTemplateId']
-    print(f"Launch Template Created: {launch_template_id}")
-    return launch_template_id
 
-def delete_launch_template(ec2_client, launch_template_id):
-    """Delete the launch template."""
+def delete_launch_template(ec2_client, launch_template_id, cache_file=DEFAULT_CACHE_FILE):
+    """Delete the launch template, and drop it from the index in cache_file. Returns True if it was deleted."""
     try:
         ec2_client.delete_launch_template(
             LaunchTemplateId=launch_template_id
         )
+        forget_launch_template(launch_template_id, cache_file)
         print(f"Launch Template {launch_template_id} deleted successfully.")
+        return True
     except Exception as e:
-        print(f"Error deleting launch template {launch_template_id}: {e}")
\ No newline at end of file
+        print(f"Error deleting launch template {launch_template_id}: {e}")
+        return False
@@ -0,0 +1,226 @@
+# ec2_rate_limiter.py
+
+import random
+import threading
+import time
+from functools import partial
+
+"""
+Example of rate limit settings in config.yaml:
+
+rate_limits:
+  enabled: true
+  # Per API family: burst is the bucket size, rate the tokens added per second. Raise these if AWS has
+  # increased the limits of your account.
+  families:
+    ec2_mutating:
+      burst: 50
+      rate: 5
+"""
+
+# Token buckets per API family. The EC2 figures are the documented defaults of EC2 API request throttling
+# (https://docs.aws.amazon.com/ec2/latest/devguide/ec2-api-throttling.html) - accounts may have different
+# limits. EC2 Instance Connect does not publish its limits, so its bucket is a conservative guess.
+DEFAULT_FAMILIES = {
+    # Describe* and Get* calls that name resources, filter or paginate
+    'ec2_non_mutating': {'burst': 100, 'rate': 20},
+    # Describe* calls without any of those - EC2 throttles these harder
+    'ec2_unfiltered': {'burst': 50, 'rate': 10},
+    # Calls that change something, e.g. CreateTags, CreateFleet, DeleteFleets
+    'ec2_mutating': {'burst': 50, 'rate': 5},
+    # Calls that create or change instances
+    'ec2_resource_intensive': {'burst': 50, 'rate': 5},
+    'ec2_instance_connect': {'burst': 20, 'rate': 10},
+    # Collecting results - S3 allows 5,500 GET requests per second per prefix
+    's3': {'burst': 500, 'rate': 5500},
+}
+
+RESOURCE_INTENSIVE_OPERATIONS = ('RunInstances', 'StartInstances', 'StopInstances', 'TerminateInstances', 'CreateImage', 'CreateSnapshot', 'CopyImage')
+
+# Parameters that make a Describe call filtered, named or paginated
+NARROWING_PARAMETERS = ('Filters', 'MaxResults', 'NextToken')
+
+THROTTLE_ERROR_CODES = ('RequestLimitExceeded', 'Throttling', 'ThrottlingException', 'TooManyRequestsException')
+
+# After a throttle, the bucket refills at a fraction of its rate and recovers a little with every call that
+# gets through, so throughput levels off around what AWS will take instead of collapsing into retries
+THROTTLE_RATE_FACTOR = 0.5
+MIN_RATE_FRACTION = 0.1
+RECOVERY_PER_SUCCESS = 0.02
+# Full-jitter exponential pause of the whole family after consecutive throttles, in seconds
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 20.0
+
+
+def api_family(service_name, operation_name, params=None):
+    """Return the rate limit family of an API call."""
+    if service_name != 'ec2':
+        return service_name.replace('-', '_')
+    if operation_name in RESOURCE_INTENSIVE_OPERATIONS:
+        return 'ec2_resource_intensive'
+    if operation_name.startswith(('Describe', 'Get')):
+        params = params or {}
+        if any(params.get(name) for name in NARROWING_PARAMETERS) or any(name.endswith(('Ids', 'Names')) and params[name] for name in params):
+            return 'ec2_non_mutating'
+        return 'ec2_unfiltered'
+    return 'ec2_mutating'
+
+
+class TokenBucket:
+    """A thread safe token bucket that adapts its refill rate to throttling responses."""
+
+    def __init__(self, name, burst, rate):
+        self.name = name
+        self.burst = burst
+        self.base_rate = rate
+        self.rate = rate
+        self.calls = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.throttles = 0
+        self._tokens = burst
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+        self._consecutive_throttles = 0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+    def acquire(self):
+        """Take a token, sleeping until one is available. Returns the seconds spent waiting."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self._paused_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    self.calls += 1
+                    if waited:
+                        self.waits += 1
+                        self.wait_seconds += waited
+                    return waited
+                delay = max(self._paused_until - now, (1 - self._tokens) / self.rate)
+            time.sleep(delay)
+            waited += delay
+
+    def succeeded(self):
+        with self._lock:
+            self._consecutive_throttles = 0
+            if self.rate < self.base_rate:
+                self.rate = min(self.base_rate, self.rate + self.base_rate * RECOVERY_PER_SUCCESS)
+
+    def throttled(self):
+        """Slow the family down after AWS throttled one of its calls."""
+        with self._lock:
+            self.throttles += 1
+            self._consecutive_throttles += 1
+            self.rate = max(self.base_rate * MIN_RATE_FRACTION, self.rate * THROTTLE_RATE_FACTOR)
+            backoff = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (self._consecutive_throttles - 1)))
+            self._paused_until = max(self._paused_until, time.monotonic() + backoff)
+            self._tokens = min(self._tokens, 0)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'waits': self.waits,
+                'wait_seconds': round(self.wait_seconds, 3),
+                'throttles': self.throttles,
+                'rate': round(self.rate, 2),
+            }
+
+
+class RateLimiter:
+    """Process-wide rate limiting of AWS calls, with one token bucket per API family and region.
+
+    attach() hooks a boto3 client's event system, so every attempt of every call - retries included - takes a
+    token from its family's bucket first, and throttling errors slow the family down. AWS applies its limits to
+    each region separately, so clients of different regions get buckets of their own.
+    """
+
+    def __init__(self, families=None):
+        self.families = {}
+        self.buckets = {}
+        self.enabled = True
+        self._lock = threading.Lock()
+        self.configure(families)
+
+    def configure(self, families=None, enabled=True):
+        with self._lock:
+            self.enabled = enabled
+            self.families = {name: dict(limits) for name, limits in DEFAULT_FAMILIES.items()}
+            for name, limits in (families or {}).items():
+                self.families.setdefault(name, {}).update(limits)
+            self.buckets = {}
+
+    def bucket(self, family, region_name=None):
+        key = f"{region_name}/{family}" if region_name else family
+        with self._lock:
+            if key not in self.buckets:
+                limits = self.families.get(family) or self.families['ec2_mutating']
+                self.buckets[key] = TokenBucket(key, limits['burst'], limits['rate'])
+            return self.buckets[key]
+
+    def attach(self, client):
+        """Rate limit every call made through a boto3 client."""
+        service_id = client.meta.service_model.service_id.hyphenize()
+        events = client.meta.events
+        events.register(f"before-parameter-build.{service_id}", partial(self._classify, region_name=client.meta.region_name), unique_id='ec2-rate-limiter-classify')
+        events.register(f"request-created.{service_id}", self._request_created, unique_id='ec2-rate-limiter-acquire')
+        events.register(f"needs-retry.{service_id}", self._needs_retry, unique_id='ec2-rate-limiter-observe')
+        return client
+
+    def _classify(self, params, model, context, region_name=None, **kwargs):
+        context['rate_limit_family'] = api_family(model.service_model.service_id.hyphenize(), model.name, params)
+        context['rate_limit_region'] = region_name
+
+    def _request_created(self, request, operation_name, **kwargs):
+        context = request.context or {}
+        family = context.get('rate_limit_family')
+        if self.enabled and family is not None:
+            self.bucket(family, context.get('rate_limit_region')).acquire()
+
+    def _needs_retry(self, response, request_dict, caught_exception=None, **kwargs):
+        context = request_dict.get('context', {})
+        family = context.get('rate_limit_family')
+        if not self.enabled or family is None or caught_exception is not None or response is None:
+            return None
+        code = response[1].get('Error', {}).get('Code')
+        self.observe(family, code, context.get('rate_limit_region'))
+        # Leave the decision to retry, and how long to sleep first, to botocore's retry handler
+        return None
+
+    def observe(self, family, error_code=None, region_name=None):
+        """Record the outcome of a call in family: a throttle if error_code is one, otherwise a success."""
+        if error_code in THROTTLE_ERROR_CODES:
+            self.bucket(family, region_name).throttled()
+        elif error_code is None:
+            self.bucket(family, region_name).succeeded()
+
+    def stats(self):
+        with self._lock:
+            buckets = dict(self.buckets)
+        return {family: bucket.stats() for family, bucket in sorted(buckets.items())}
+
+    def print_summary(self):
+        stats = self.stats()
+        if not any(family['calls'] for family in stats.values()):
+            return
+        print("AWS API rate limiting:")
+        print(f"  {'family':<40} {'calls':>7} {'waits':>7} {'waited':>9} {'throttles':>10} {'rate':>7}")
+        for family, family_stats in stats.items():
+            print(f"  {family:<40} {family_stats['calls']:>7} {family_stats['waits']:>7} {family_stats['wait_seconds']:>9.2f} {family_stats['throttles']:>10} {family_stats['rate']:>7.2f}")
+
+
+def configure_rate_limiter(config):
+    """Apply the optional 'rate_limits' section of config.yaml to the shared rate limiter."""
+    settings = config.get('rate_limits') or {}
+    rate_limiter.configure(settings.get('families'), settings.get('enabled', True))
+    return rate_limiter
+
+
+# Shared by every client of a run, whichever thread or region it is used from
+rate_limiter = RateLimiter()
@@ -0,0 +1,73 @@
+# ec2_region_helper.py
+
+import os
+
+"""
+Example of multi-region settings in config.yaml:
+
+# Settings at the top level apply to every region unless the region sets them itself. AMIs, subnets, security
+# groups and fleet_overrides subnets are regional, so each region needs its own.
+regions:
+  - region: eu-central-1
+    ami_id: "ami-xxxxxxx"
+    subnet_id: "subnet-xxxxxx"
+    security_group_ids: ["sg-xxxxxx"]
+    total_capacity: 20
+    spot_capacity: 20
+  - region: eu-west-1
+    ami_id: "ami-yyyyyyy"
+    subnet_id: "subnet-yyyyyy"
+    security_group_ids: ["sg-yyyyyy"]
+    # Defaults to serial-console.ec2-instance-connect.<region>.aws
+    serial_console_endpoint: "serial-console.ec2-instance-connect.eu-west-1.aws"
+"""
+
+# Local index of launch template versions by the hash of their LaunchTemplateData, see ec2_launchtemplate_helper.py.
+# Defined here rather than there so that reading the regions of a config does not import botocore.
+DEFAULT_CACHE_FILE = '.launch_template_cache.json'
+
+
+def serial_console_endpoint_for(region_name):
+    """Return the EC2 serial console endpoint of a region, see
+    https://docs.aws.amazon.com/AWSEC2/latest/UserGuide/connect-to-serial-console.html#sc-endpoints-and-fingerprints"""
+    return f"serial-console.ec2-instance-connect.{region_name}.aws"
+
+
+def region_cache_file(cache_file, region_name):
+    """Launch template IDs are regional, so each region keeps its own launch template cache."""
+    base, extension = os.path.splitext(cache_file)
+    return f"{base}.{region_name}{extension}"
+
+
+def launch_template_cache_file(config, region_name=None):
+    """Return the launch template cache of a region of the config, as region_configs() sets it."""
+    for region_config in region_configs(config):
+        if region_config.get('region') == region_name:
+            return (region_config.get('launch_template_cache') or {}).get('cache_file', DEFAULT_CACHE_FILE)
+    # A region the config does not list, e.g. not any more
+    cache_file = (config.get('launch_template_cache') or {}).get('cache_file', DEFAULT_CACHE_FILE)
+    return region_cache_file(cache_file, region_name) if region_name else cache_file
+
+
+def region_configs(config):
+    """Return one config per region of the run: the top-level config with each entry of 'regions' merged over it.
+
+    Without a 'regions' section this is just [config], the single region of the AWS profile.
+    """
+    regions = config.get('regions')
+    if not regions:
+        return [config]
+
+    configs = []
+    for region in regions:
+        region_config = {key: value for key, value in config.items() if key != 'regions'}
+        region_config.update(region)
+        region_name = region_config['region']
+        if 'serial_console_endpoint' not in region:
+            region_config['serial_console_endpoint'] = serial_console_endpoint_for(region_name)
+        template_cache = dict(region_config.get('launch_template_cache') or {})
+        if 'cache_file' not in (region.get('launch_template_cache') or {}):
+            template_cache['cache_file'] = region_cache_file(template_cache.get('cache_file', DEFAULT_CACHE_FILE), region_name)
+        region_config['launch_template_cache'] = template_cache
+        configs.append(region_config)
+    return configs
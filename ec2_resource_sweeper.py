@@ -0,0 +1,162 @@
+# ec2_resource_sweeper.py
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from botocore.exceptions import ClientError
+
+"""
+Example of resource expiry settings in config.yaml:
+
+resource_expiry:
+  # Hours after a run starts before its fleets count as leaked, for 'python automate.py sweep'
+  fleet_hours: 24
+  # Hours after the last run that used a launch template before it counts as leaked - every run that reuses a
+  # cached launch template moves its expiry on
+  launch_template_hours: 720
+  # Describe and delete calls in flight at once when sweeping, across every region
+  workers: 16
+"""
+
+DEFAULT_RESOURCE_EXPIRY = {
+    'fleet_hours': 24,
+    'launch_template_hours': 720,
+    'workers': 16,
+}
+
+# Every fleet and launch template a run creates carries the run ID of its journal and the time after which
+# 'automate.py sweep' may delete it, as an ISO 8601 UTC timestamp
+RUN_ID_TAG = 'RunId'
+EXPIRES_TAG = 'RunExpiresAt'
+
+# DeleteFleets deletes at most 25 instant fleets per call - and none at all if given more
+DELETE_FLEETS_BATCH = 25
+# Results per page of the describe calls - DescribeLaunchTemplates returns at most 200
+DESCRIBE_FLEETS_PAGE_SIZE = 1000
+DESCRIBE_LAUNCH_TEMPLATES_PAGE_SIZE = 200
+# Fleets in these states may still have instances. DescribeFleets cannot filter on tags, so the sweep lists
+# these and looks at the tags of each.
+LIVE_FLEET_STATES = ['submitted', 'active', 'modifying']
+
+
+def load_resource_expiry(config):
+    """Merge the optional 'resource_expiry' section of config.yaml over the defaults."""
+    settings = dict(DEFAULT_RESOURCE_EXPIRY)
+    settings.update(config.get('resource_expiry') or {})
+    return settings
+
+
+def run_tags(run_id, hours):
+    """Tags for a resource created by run run_id, expiring hours from now. Without a run ID - no journal - the
+    resource only gets the expiry."""
+    expires_at = datetime.now(timezone.utc) + timedelta(hours=hours)
+    tags = [{'Key': EXPIRES_TAG, 'Value': expires_at.strftime('%Y-%m-%dT%H:%M:%SZ')}]
+    if run_id:
+        tags.append({'Key': RUN_ID_TAG, 'Value': run_id})
+    return tags
+
+
+def tag_value(resource, key):
+    for tag in resource.get('Tags', []):
+        if tag['Key'] == key:
+            return tag['Value']
+    return None
+
+
+def sweepable(resource, now, run_id=None):
+    """True if the resource was tagged by a run and has expired - or, given run_id, belongs to that run, expired
+    or not. Resources without the tags were not created by this tool, or before it tagged them, and are left alone."""
+    expires_at = tag_value(resource, EXPIRES_TAG)
+    if expires_at is None:
+        return False
+    if run_id is not None:
+        return tag_value(resource, RUN_ID_TAG) == run_id
+    try:
+        return datetime.strptime(expires_at, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc) <= now
+    except ValueError:
+        return False
+
+
+def find_fleets(ec2_client, now, run_id=None):
+    """Return the live fleets of the region to sweep, from paginated DescribeFleets calls."""
+    fleets = []
+    paginator = ec2_client.get_paginator('describe_fleets')
+    for page in paginator.paginate(Filters=[{'Name': 'fleet-state', 'Values': LIVE_FLEET_STATES}], PaginationConfig={'PageSize': DESCRIBE_FLEETS_PAGE_SIZE}):
+        fleets.extend(fleet for fleet in page['Fleets'] if sweepable(fleet, now, run_id))
+    return fleets
+
+
+def find_launch_templates(ec2_client, now, run_id=None):
+    """Return the launch templates of the region to sweep. Only tagged templates are listed at all."""
+    templates = []
+    paginator = ec2_client.get_paginator('describe_launch_templates')
+    for page in paginator.paginate(Filters=[{'Name': 'tag-key', 'Values': [EXPIRES_TAG]}], PaginationConfig={'PageSize': DESCRIBE_LAUNCH_TEMPLATES_PAGE_SIZE}):
+        templates.extend(template for template in page['LaunchTemplates'] if sweepable(template, now, run_id))
+    return templates
+
+
+def delete_fleet_batch(ec2_client, fleet_ids):
+    """Delete up to DELETE_FLEETS_BATCH fleets and their instances in one call. Returns the IDs deleted."""
+    try:
+        response = ec2_client.delete_fleets(FleetIds=fleet_ids, TerminateInstances=True)
+    except ClientError as e:
+        print(f"Error deleting fleets {', '.join(fleet_ids)}: {e}")
+        return []
+    for failure in response.get('UnsuccessfulFleetDeletions', []):
+        print(f"Error deleting fleet {failure['FleetId']}: {failure['Error']['Code']} {failure['Error']['Message']}")
+    return [deletion['FleetId'] for deletion in response.get('SuccessfulFleetDeletions', [])]
+
+
+def delete_template(ec2_client, launch_template_id):
+    """Delete one launch template - DeleteLaunchTemplate takes one at a time. Returns True if it was deleted."""
+    try:
+        ec2_client.delete_launch_template(LaunchTemplateId=launch_template_id)
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('InvalidLaunchTemplateId.NotFound', 'InvalidLaunchTemplateName.NotFoundException'):
+            return True
+        print(f"Error deleting launch template {launch_template_id}: {e}")
+        return False
+
+
+def sweep_resources(clients, workers=DEFAULT_RESOURCE_EXPIRY['workers'], run_id=None, dry_run=False):
+    """Find and delete the expired fleets and launch templates of every region, given as {region: ec2_client}.
+
+    Every region is listed at once, then fleets are deleted in batches of DELETE_FLEETS_BATCH and launch
+    templates one per call, all on workers threads - launch templates after fleets, so no fleet is left without
+    its template. Given run_id, the resources of that run are swept whether they have expired or not.
+    Returns {'fleets': {region: [fleet IDs]}, 'launch_templates': {region: [IDs]}} of what was (or with dry_run,
+    would be) deleted.
+    """
+    now = datetime.now(timezone.utc)
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='sweep-worker') as executor:
+        fleet_lists = {region: executor.submit(find_fleets, ec2_client, now, run_id) for region, ec2_client in clients.items()}
+        template_lists = {region: executor.submit(find_launch_templates, ec2_client, now, run_id) for region, ec2_client in clients.items()}
+        found_fleets = {region: [fleet['FleetId'] for fleet in future.result()] for region, future in fleet_lists.items()}
+        found_templates = {region: [template['LaunchTemplateId'] for template in future.result()] for region, future in template_lists.items()}
+
+        found = sum(len(fleet_ids) for fleet_ids in found_fleets.values()), sum(len(template_ids) for template_ids in found_templates.values())
+        print(f"Found {found[0]} fleets and {found[1]} launch templates to sweep in {len(clients)} regions in {time.monotonic() - started:.2f}s.")
+        for region in clients:
+            for fleet_id in found_fleets[region]:
+                print(f"  Fleet {fleet_id} ({region or 'default region'})")
+            for launch_template_id in found_templates[region]:
+                print(f"  Launch Template {launch_template_id} ({region or 'default region'})")
+        if dry_run:
+            return {'fleets': found_fleets, 'launch_templates': found_templates}
+
+        fleet_deletions = {
+            region: [executor.submit(delete_fleet_batch, clients[region], fleet_ids[start:start + DELETE_FLEETS_BATCH]) for start in range(0, len(fleet_ids), DELETE_FLEETS_BATCH)]
+            for region, fleet_ids in found_fleets.items()
+        }
+        deleted_fleets = {region: [fleet_id for future in futures for fleet_id in future.result()] for region, futures in fleet_deletions.items()}
+        template_deletions = {
+            region: [(launch_template_id, executor.submit(delete_template, clients[region], launch_template_id)) for launch_template_id in template_ids]
+            for region, template_ids in found_templates.items()
+        }
+        deleted_templates = {region: [launch_template_id for launch_template_id, future in deletions if future.result()] for region, deletions in template_deletions.items()}
+
+    print(f"Swept {sum(len(fleet_ids) for fleet_ids in deleted_fleets.values())} of {found[0]} fleets and "
+          f"{sum(len(template_ids) for template_ids in deleted_templates.values())} of {found[1]} launch templates in {time.monotonic() - started:.2f}s.")
+    return {'fleets': deleted_fleets, 'launch_templates': deleted_templates}
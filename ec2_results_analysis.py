@@ -0,0 +1,213 @@
+# ec2_results_analysis.py
+
+import json
+import numpy as np
+from ec2_results_collector import ResultStore
+
+"""
+Example of analysis settings in config.yaml:
+
+analysis:
+  # Kernel arguments every other set is compared with - defaults to the set with the fewest arguments
+  baseline: "nosmt"
+  # Metrics to report, as dotted paths into results_all.yml - defaults to every numeric field
+  metrics: ["Benchmark.runtime_seconds", "Benchmark.latency_us.p99"]
+"""
+
+# Two-sided 95% critical values of Student's t distribution by degrees of freedom, interpolated in 1/df between
+# these points - exact to the table's precision, and without pulling in scipy for one function
+T_975_DF = np.array([1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 12, 15, 20, 25, 30, 40, 60, 120, np.inf])
+T_975 = np.array([12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228, 2.179, 2.131, 2.086, 2.060, 2.042, 2.021, 2.000, 1.980, 1.960])
+
+
+def t_critical(df):
+    """Two-sided 95% critical value of Student's t for an array of degrees of freedom."""
+    df = np.maximum(np.asarray(df, dtype=float), 1.0)
+    # np.interp wants increasing x, and 1/df decreases with df
+    return np.interp(1.0 / df, (1.0 / T_975_DF)[::-1], T_975[::-1])
+
+
+def result_metrics(results, prefix=''):
+    """Yield (dotted name, value) for every number in a parsed results_all.yml, apart from the Aws section."""
+    if not isinstance(results, dict):
+        return
+    for name, value in results.items():
+        path = f"{prefix}{name}"
+        if path == 'Aws':
+            continue
+        if isinstance(value, dict):
+            yield from result_metrics(value, path + '.')
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield path, float(value)
+
+
+def arguments_applied(kernel_arguments, cmdline):
+    """False if the instance reported a kernel command line without every one of its job's kernel arguments."""
+    if not kernel_arguments or not cmdline:
+        return True
+    return set(kernel_arguments.split()) <= set(cmdline.split())
+
+
+def load_result_table(store_dir, run_id=None, instance_type=None, metrics=None):
+    """Read the collected results into arrays: one group (kernel arguments, instance type) per row, and one
+    column of values per metric, NaN where a result lacks it.
+
+    Results whose reported command line is missing kernel arguments of their job are left out, as the instance
+    did not boot with them. Results without a job are grouped by their command line, less the arguments every
+    such command line has (BOOT_IMAGE, root and so on).
+    """
+    groups = []
+    columns = {}
+    skipped = 0
+    # Rows without a job, with the arguments of their command line
+    unattributed = {}
+    for row in ResultStore(store_dir).rows(run_id=run_id, instance_type=instance_type):
+        if not arguments_applied(row['kernel_arguments'], row['cmdline']):
+            skipped += 1
+            continue
+        index = len(groups)
+        if row['kernel_arguments'] is None:
+            unattributed[index] = (row['cmdline'] or '').split()
+        groups.append((row['kernel_arguments'], row['instance_type'] or ''))
+        for name, value in result_metrics(row['results']):
+            if metrics is None or name in metrics:
+                columns.setdefault(name, {})[index] = value
+
+    if unattributed:
+        common = set.intersection(*(set(arguments) for arguments in unattributed.values()))
+        for index, arguments in unattributed.items():
+            groups[index] = (' '.join(argument for argument in arguments if argument not in common), groups[index][1])
+
+    values = {}
+    for name, column in columns.items():
+        values[name] = np.full(len(groups), np.nan)
+        values[name][np.fromiter(column.keys(), dtype=np.int64, count=len(column))] = np.fromiter(column.values(), dtype=float, count=len(column))
+    return groups, values, skipped
+
+
+def group_statistics(codes, values, group_count):
+    """Per group statistics of values, where codes gives the group of each value - all groups at once.
+
+    Returns a dict of arrays indexed by group: n, mean, std, median, p95, and ci_low and ci_high, the 95%
+    confidence interval of the mean. Groups without values have n 0 and NaN everywhere else.
+    """
+    present = ~np.isnan(values)
+    codes = codes[present]
+    values = values[present]
+    n = np.bincount(codes, minlength=group_count)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.bincount(codes, weights=values, minlength=group_count) / n
+        squares = np.bincount(codes, weights=(values - mean[codes]) ** 2, minlength=group_count)
+        std = np.sqrt(squares / (n - 1))
+        half_width = t_critical(n - 1) * std / np.sqrt(n)
+
+    # Sorting by group, then value, puts each group's values in order in one contiguous run
+    ordered = values[np.lexsort((values, codes))]
+    starts = np.concatenate(([0], np.cumsum(n)[:-1]))
+
+    def quantile(fraction):
+        # Linear interpolation between the closest ranks, like numpy.percentile's default
+        position = (np.maximum(n, 1) - 1) * fraction
+        lower = np.floor(position).astype(np.int64)
+        upper = np.ceil(position).astype(np.int64)
+        if not len(ordered):
+            return np.full(group_count, np.nan)
+        low_values = ordered[np.minimum(starts + lower, len(ordered) - 1)]
+        high_values = ordered[np.minimum(starts + upper, len(ordered) - 1)]
+        return np.where(n > 0, low_values + (high_values - low_values) * (position - lower), np.nan)
+
+    return {
+        'n': n,
+        'mean': mean,
+        'std': std,
+        'median': quantile(0.5),
+        'p95': quantile(0.95),
+        'ci_low': mean - half_width,
+        'ci_high': mean + half_width,
+    }
+
+
+def default_baseline(kernel_argument_sets):
+    """The kernel argument set with the fewest arguments, usually the sweep's base_arguments on their own."""
+    return min(kernel_argument_sets, key=lambda arguments: (len(arguments.split()), arguments))
+
+
+def analyze_results(store_dir, baseline=None, run_id=None, instance_type=None, metrics=None):
+    """Compare every kernel argument set with the baseline set, per instance type and metric.
+
+    Returns a report dict: the baseline, the rows used and skipped, and per metric a list of groups with their
+    statistics and, where the instance type also ran the baseline, the relative difference of the mean and of the
+    median from the baseline, and the 95% confidence interval of the relative difference of the means (Welch).
+    """
+    groups, values, skipped = load_result_table(store_dir, run_id, instance_type, metrics)
+    report = {'rows': len(groups), 'skipped': skipped, 'baseline': baseline, 'metrics': {}}
+    if not groups:
+        return report
+
+    keys, codes = np.unique(np.array(groups, dtype=str), axis=0, return_inverse=True)
+    codes = codes.reshape(-1)
+    if baseline is None:
+        baseline = default_baseline({str(arguments) for arguments, _ in keys})
+    report['baseline'] = baseline
+    # Index of the baseline group of each group's instance type, -1 if that instance type has no baseline
+    baseline_of = {str(group_type): index for index, (arguments, group_type) in enumerate(keys) if arguments == baseline}
+    reference = np.array([baseline_of.get(str(group_type), -1) for _, group_type in keys])
+    has_reference = reference >= 0
+
+    for name, column in sorted(values.items()):
+        stats = group_statistics(codes, column, len(keys))
+        base = {field: np.where(has_reference, stats[field][reference], np.nan) for field in ('n', 'mean', 'std', 'median')}
+        with np.errstate(invalid='ignore', divide='ignore'):
+            delta_mean = stats['mean'] / base['mean'] - 1
+            delta_median = stats['median'] / base['median'] - 1
+            # Welch's interval for the difference of the means, relative to the baseline mean
+            variance = stats['std'] ** 2 / stats['n'] + base['std'] ** 2 / base['n']
+            df = variance ** 2 / ((stats['std'] ** 2 / stats['n']) ** 2 / (stats['n'] - 1) + (base['std'] ** 2 / base['n']) ** 2 / (base['n'] - 1))
+            half_width = t_critical(np.nan_to_num(df, nan=1.0)) * np.sqrt(variance) / np.abs(base['mean'])
+
+        rows = []
+        for index, (arguments, group_type) in enumerate(keys):
+            if not stats['n'][index]:
+                continue
+            group = {
+                'kernel_arguments': str(arguments),
+                'instance_type': str(group_type),
+                'n': int(stats['n'][index]),
+            }
+            for field in ('mean', 'std', 'median', 'p95', 'ci_low', 'ci_high'):
+                group[field] = json_number(stats[field][index])
+            if has_reference[index] and str(arguments) != baseline:
+                group['delta_mean'] = json_number(delta_mean[index])
+                group['delta_median'] = json_number(delta_median[index])
+                group['delta_ci_low'] = json_number(delta_mean[index] - half_width[index])
+                group['delta_ci_high'] = json_number(delta_mean[index] + half_width[index])
+            rows.append(group)
+        report['metrics'][name] = rows
+    return report
+
+
+def json_number(value):
+    """A float for the JSON report, or None for NaN."""
+    value = float(value)
+    return None if np.isnan(value) else round(value, 6)
+
+
+def format_delta(value):
+    return '' if value is None else f"{value * 100:+.1f}%"
+
+
+def print_report(report):
+    print(f"{report['rows']} results, {report['skipped']} left out as booted without their kernel arguments. Baseline: '{report['baseline']}'")
+    for name, groups in report['metrics'].items():
+        print(f"\n{name}")
+        print(f"  {'kernel arguments':<40} {'instance type':<14} {'n':>6} {'mean':>11} {'median':>11} {'p95':>11} {'95% CI of mean':>25} {'vs baseline':>12} {'95% CI':>17}")
+        for group in groups:
+            ci = '' if group['ci_low'] is None else f"{group['ci_low']:.4g} .. {group['ci_high']:.4g}"
+            delta_ci = '' if group.get('delta_ci_low') is None else f"{format_delta(group['delta_ci_low'])} .. {format_delta(group['delta_ci_high'])}"
+            print(f"  {group['kernel_arguments'][:40]:<40} {group['instance_type']:<14} {group['n']:>6} {group['mean']:>11.4g} {group['median']:>11.4g} {group['p95']:>11.4g} "
+                  f"{ci:>25} {format_delta(group.get('delta_mean')):>12} {delta_ci:>17}")
+
+
+def write_report(report, path):
+    with open(path, 'w') as report_file:
+        json.dump(report, report_file, indent=2)
@@ -0,0 +1,263 @@
+# ec2_results_collector.py
+
+import json
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+import yaml
+from ec2_run_journal import load_journal
+
+"""
+Example of result collection settings in config.yaml:
+
+results:
+  # Where userdata-script.sh uploads results_all.yml - s3://<bucket>/<prefix>, or a local directory
+  source: "s3://my-bucket-name/results/"
+  # Local store of collected results, see below
+  store_dir: "results"
+  # Downloads in flight at the same time
+  workers: 16
+"""
+
+DEFAULT_RESULTS = {
+    'source': None,
+    'store_dir': 'results',
+    'workers': 16,
+}
+
+# The store is results.jsonl, one row per result object, and index.json with the ETag of every object
+# collected, the offset of its row, and the keys of the rows for each value of INDEXED_FIELDS
+ROWS_FILE = 'results.jsonl'
+INDEX_FILE = 'index.json'
+INDEXED_FIELDS = ('instance_type', 'cmdline', 'run_id')
+# The index is saved after this many new rows as well as at the end, so an interrupted collect keeps most of
+# what it downloaded
+INDEX_SAVE_INTERVAL = 500
+
+# <instance id>_<instance type>_<YYYYmmdd_HHMMSS>.yml, as uploaded by userdata-script.sh
+RESULT_KEY_PATTERN = re.compile(r'(?P<instance_id>i-[0-9a-f]+)_(?P<instance_type>[^_/]+)_(?P<timestamp>\d{8}_\d{6})\.ya?ml$')
+
+# libyaml parses many times faster than the pure Python loader, where PyYAML was built with it
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+def load_results_settings(config):
+    """Merge the optional 'results' section of config.yaml over the defaults."""
+    settings = dict(DEFAULT_RESULTS)
+    settings.update(config.get('results') or {})
+    return settings
+
+
+class LocalResultSource:
+    """Result files in a local directory, e.g. synced from the bucket or written by a test. The ETag of a file is
+    made from its size and modification time."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def __str__(self):
+        return self.directory
+
+    def list(self):
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                key = os.path.relpath(path, self.directory)
+                stat = os.stat(path)
+                yield {
+                    'key': key,
+                    'etag': f"{stat.st_size}-{stat.st_mtime_ns}",
+                    'last_modified': datetime.fromtimestamp(stat.st_mtime, timezone.utc).isoformat(),
+                }
+
+    def fetch(self, key):
+        with open(os.path.join(self.directory, key), 'rb') as result_file:
+            return result_file.read()
+
+
+class S3ResultSource:
+    """Result objects under a prefix of an S3 bucket - or anything with the same list_objects_v2 paginator and
+    get_object calls, such as SimulatedS3Client in ec2_simulator.py."""
+
+    def __init__(self, s3_client, bucket, prefix=''):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def __str__(self):
+        return f"s3://{self.bucket}/{self.prefix}"
+
+    def list(self):
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for item in page.get('Contents', []):
+                last_modified = item['LastModified']
+                yield {
+                    'key': item['Key'],
+                    'etag': item['ETag'].strip('"'),
+                    'last_modified': last_modified.isoformat() if hasattr(last_modified, 'isoformat') else str(last_modified),
+                }
+
+    def fetch(self, key):
+        return self.s3_client.get_object(Bucket=self.bucket, Key=key)['Body'].read()
+
+
+def result_source(location, client_pool=None):
+    """Return the result source for an s3://bucket/prefix URL or a local directory."""
+    if location.startswith('s3://'):
+        bucket, _, prefix = location[len('s3://'):].partition('/')
+        return S3ResultSource(client_pool.client('s3'), bucket, prefix)
+    return LocalResultSource(location)
+
+
+def journal_jobs(journal_file):
+    """Return the JournalState of a run journal, to attribute results to runs and jobs, or None without one."""
+    if not journal_file or not os.path.exists(journal_file):
+        return None
+    return load_journal(journal_file)
+
+
+def upload_time(timestamp):
+    try:
+        return datetime.strptime(timestamp, '%Y%m%d_%H%M%S').isoformat()
+    except ValueError:
+        return None
+
+
+def parse_result(key, body, journal_state=None):
+    """Turn one results_all.yml into a store row.
+
+    The instance ID, type and upload time come from the object key, and Aws.InstanceType, Aws.CmdLine, Aws.RunId
+    and Aws.JobId from the file itself where userdata-script.sh put them there. The kernel arguments and job stage
+    come from the journal record of that run and job. A file without a run or job takes them from the journal
+    only if its instance ran a single job - a warm pool instance runs many, and its last is not this one.
+    """
+    documents = [document for document in yaml.load_all(body, Loader=YAML_LOADER) if document is not None]
+    results = documents[0] if len(documents) == 1 else documents
+    aws = (results.get('Aws') or {}) if isinstance(results, dict) else {}
+
+    match = RESULT_KEY_PATTERN.search(key)
+    row = {
+        'key': key,
+        'instance_id': match.group('instance_id') if match else None,
+        'instance_type': aws.get('InstanceType') or (match.group('instance_type') if match else None),
+        'cmdline': aws.get('CmdLine'),
+        'uploaded_at': upload_time(match.group('timestamp')) if match else None,
+        'run_id': aws.get('RunId') or None,
+        'job_id': aws.get('JobId') or None,
+        'kernel_arguments': None,
+        'job_stage': None,
+    }
+    entry = None
+    if journal_state is not None:
+        if row['run_id'] and row['job_id']:
+            entry = journal_state.run_jobs.get((row['run_id'], row['job_id']))
+        else:
+            instance_jobs = journal_state.instance_jobs.get(row['instance_id'], [])
+            if len(instance_jobs) == 1:
+                entry = journal_state.run_jobs[instance_jobs[0]]
+                row['run_id'] = entry['run_id']
+                row['job_id'] = entry['job_id']
+    if entry is not None:
+        row['kernel_arguments'] = entry['job']['kernel_arguments']
+        # Only a 'completed' job is known to have booted with its kernel arguments
+        row['job_stage'] = entry['stage']
+    row['results'] = results
+    return row
+
+
+class ResultStore:
+    """Collected results on disk: rows in results.jsonl, appended to and never rewritten, and index.json."""
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.rows_file = os.path.join(store_dir, ROWS_FILE)
+        self.index_file = os.path.join(store_dir, INDEX_FILE)
+        self.objects = {}
+        if os.path.exists(self.index_file):
+            with open(self.index_file, 'r') as index:
+                self.objects = json.load(index)['objects']
+
+    def changed(self, item):
+        """True if the listed object has not been collected yet, or has been uploaded again since."""
+        collected = self.objects.get(item['key'])
+        return collected is None or collected['etag'] != item['etag'] or collected['last_modified'] != item['last_modified']
+
+    def append(self, rows_file, item, row):
+        offset = rows_file.tell()
+        rows_file.write((json.dumps(row, sort_keys=True, default=str) + '\n').encode('utf-8'))
+        self.objects[item['key']] = {
+            'etag': item['etag'],
+            'last_modified': item['last_modified'],
+            'offset': offset,
+            'values': {field: row.get(field) for field in INDEXED_FIELDS},
+        }
+
+    def save_index(self):
+        index = {'objects': self.objects}
+        for field in INDEXED_FIELDS:
+            values = {}
+            for key, collected in self.objects.items():
+                values.setdefault(str(collected['values'][field]), []).append(key)
+            index[field] = values
+        # Write to a temporary file and rename, like the launch template cache, so readers never see half an index
+        temporary_file = self.index_file + '.tmp'
+        with open(temporary_file, 'w') as index_file:
+            json.dump(index, index_file, sort_keys=True)
+        os.replace(temporary_file, self.index_file)
+
+    def rows(self, **filters):
+        """Yield the stored rows, optionally only those with the given instance_type, cmdline or run_id."""
+        keys = [key for key, collected in self.objects.items() if all(collected['values'].get(field) == value for field, value in filters.items() if value is not None)]
+        offsets = sorted(self.objects[key]['offset'] for key in keys)
+        if not offsets:
+            return
+        with open(self.rows_file, 'rb') as rows_file:
+            for offset in offsets:
+                rows_file.seek(offset)
+                yield json.loads(rows_file.readline())
+
+
+def collect_results(source, store_dir, workers=DEFAULT_RESULTS['workers'], journal_file=None):
+    """Download every result object of source that is new or changed since the last collect into the store.
+
+    Objects are fetched and parsed on workers threads, and each row is appended as soon as it is ready. Returns
+    (new_rows, objects_listed).
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    store = ResultStore(store_dir)
+    journal_state = journal_jobs(journal_file)
+
+    started = time.monotonic()
+    listed = list(source.list())
+    new_items = [item for item in listed if store.changed(item)]
+    print(f"Listed {len(listed)} result objects in {source} in {time.monotonic() - started:.2f}s, {len(new_items)} new or changed.")
+    if not new_items:
+        return 0, len(listed)
+
+    collected = 0
+    failed = 0
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='collect-worker') as executor, open(store.rows_file, 'ab') as rows_file:
+        futures = {executor.submit(lambda item: parse_result(item['key'], source.fetch(item['key']), journal_state), item): item for item in new_items}
+        try:
+            for future in as_completed(futures):
+                item = futures[future]
+                try:
+                    row = future.result()
+                except Exception as e:
+                    print(f"Error collecting {item['key']}: {e}")
+                    failed += 1
+                    continue
+                store.append(rows_file, item, row)
+                collected += 1
+                if collected % INDEX_SAVE_INTERVAL == 0:
+                    rows_file.flush()
+                    store.save_index()
+        finally:
+            rows_file.flush()
+            store.save_index()
+
+    print(f"Collected {collected} results into {store_dir} in {time.monotonic() - started:.2f}s" + (f", {failed} failed." if failed else "."))
+    return collected, len(listed)
@@ -0,0 +1,189 @@
+# ec2_run_journal.py
+
+import json
+import os
+import threading
+import time
+import uuid
+
+# Relative to the working directory, next to the launch template cache
+DEFAULT_JOURNAL_FILE = 'run-journal.jsonl'
+
+# Job stages recorded as each instance works through its job, in order
+JOB_STAGES = ('claimed', 'booted', 'completed', 'failed')
+
+
+def job_key(job):
+    """What makes a job from expand_jobs() the same job in a later run - job IDs alone change with the config."""
+    return [job['job_id'], job['kernel_arguments'], job['instance_type'], job['repetition']]
+
+
+class RunJournal:
+    """Append-only record of fleet runs, as JSON lines: every fleet and launch template they create or delete,
+    and every stage each job reaches on its instance. Every record carries the run_id of its run, and runs are
+    appended one after the other, so the records of earlier runs stay for collect to attribute their results.
+
+    Records are written and flushed as they happen, so the journal survives the process being killed at any
+    point. Records of created and deleted resources are also fsynced, so a host crash cannot lose track of
+    anything that is still billing. Reading the journal back (load_journal) gives what is still live and how
+    far each job got, for automate.py to resume the run or clean up after it.
+    """
+
+    def __init__(self):
+        self.path = None
+        self.run_id = None
+        self._file = None
+        self._lock = threading.Lock()
+
+    def open(self, path, resume=False, command='fleet', run_id=None):
+        """Start a run at the end of the journal at path, creating it if need be. A resumed run passes the run_id
+        of the run it resumes, so the results of both are attributed to one run."""
+        self.path = path
+        self.run_id = run_id or uuid.uuid4().hex[:12]
+        self._file = open(path, 'a')
+        if self._file.tell():
+            with open(path, 'rb') as journal_file:
+                journal_file.seek(-1, os.SEEK_END)
+                torn = journal_file.read(1) != b'\n'
+            if torn:
+                # Start on a line of our own rather than after a record cut short by a crash
+                self._file.write('\n')
+        self.record('run_started', command=command, resumed=resume, sync=True)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def record(self, event, sync=False, **fields):
+        """Append one record. Does nothing unless the journal has been opened."""
+        if self._file is None:
+            return
+        record = {'event': event, 'run_id': self.run_id, 'time': round(time.time(), 3)}
+        record.update(fields)
+        line = json.dumps(record, sort_keys=True) + '\n'
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(line)
+            self._file.flush()
+            if sync:
+                os.fsync(self._file.fileno())
+
+    def launch_template_created(self, region, launch_template_id, keep):
+        self.record('launch_template_created', region=region, launch_template_id=launch_template_id, keep=keep, sync=True)
+
+    def launch_template_deleted(self, region, launch_template_id):
+        self.record('launch_template_deleted', region=region, launch_template_id=launch_template_id, sync=True)
+
+    def fleet_created(self, region, fleet_id, instance_ids):
+        self.record('fleet_created', region=region, fleet_id=fleet_id, instance_ids=instance_ids, sync=True)
+
+    def fleet_deleted(self, region, fleet_id):
+        self.record('fleet_deleted', region=region, fleet_id=fleet_id, sync=True)
+
+    def job_stage(self, job, stage):
+        """Record that job reached stage (one of JOB_STAGES) on the instance and region set in the job."""
+        self.record('job_stage', stage=stage, job_id=job['job_id'], key=job_key(job), instance_id=job.get('instance_id'), region=job.get('region'), job=job)
+
+
+class JournalState:
+    """What a journal says is left of its runs: live fleets and launch templates, and the last stage of each job."""
+
+    def __init__(self):
+        self.runs = 0
+        # Of the last fleet run, which a resumed run carries on - jobs are those of this run
+        self.run_id = None
+        # {fleet_id: {'region': ..., 'instance_ids': [...]}} of fleets created and not deleted since
+        self.fleets = {}
+        # {launch_template_id: {'region': ..., 'keep': ...}} likewise
+        self.launch_templates = {}
+        # {job_id: the job_stage record of the last stage the job reached in the last fleet run} - job IDs are
+        # reused by every run of the same config
+        self.jobs = {}
+        # Instance ID to the fleet it was launched by, deleted or not
+        self.instance_fleets = {}
+        # {(run_id, job_id): the job_stage record of the last stage the job reached in that run}, in any run
+        self.run_jobs = {}
+        # {instance_id: [(run_id, job_id), ...]} of every job run on that instance - a warm pool instance runs many
+        self.instance_jobs = {}
+        # Lines that could not be read, e.g. one cut short when the process was killed mid write
+        self.damaged = 0
+
+    def apply(self, record):
+        event = record.get('event')
+        if event == 'run_started':
+            self.runs += 1
+            if record.get('command', 'fleet') == 'fleet':
+                if record['run_id'] != self.run_id:
+                    # A new run rather than a resumed one
+                    self.jobs = {}
+                self.run_id = record['run_id']
+        elif event == 'fleet_created':
+            self.fleets[record['fleet_id']] = {'region': record['region'], 'instance_ids': record['instance_ids']}
+            for instance_id in record['instance_ids']:
+                self.instance_fleets[instance_id] = record['fleet_id']
+        elif event == 'fleet_deleted':
+            self.fleets.pop(record['fleet_id'], None)
+        elif event == 'launch_template_created':
+            self.launch_templates[record['launch_template_id']] = {'region': record['region'], 'keep': record['keep']}
+        elif event == 'launch_template_deleted':
+            self.launch_templates.pop(record['launch_template_id'], None)
+        elif event == 'job_stage':
+            if record['run_id'] == self.run_id:
+                self.jobs[record['job_id']] = record
+            run_job = (record['run_id'], record['job_id'])
+            self.run_jobs[run_job] = record
+            if record['instance_id'] is not None:
+                instance_jobs = self.instance_jobs.setdefault(record['instance_id'], [])
+                if run_job not in instance_jobs:
+                    instance_jobs.append(run_job)
+
+    def live_resources(self):
+        """Fleets and launch templates left behind - launch templates kept for reuse do not count."""
+        return list(self.fleets) + [launch_template_id for launch_template_id, template in self.launch_templates.items() if not template['keep']]
+
+    def split_jobs(self, jobs):
+        """Sort the jobs of a resumed run into (completed, booted, remaining).
+
+        completed are the jobs an earlier run finished, as it recorded them. booted are (region, instance_id,
+        job) for jobs whose instance had already been driven through GRUB and may still be running them, if
+        the fleet of the instance is still live. Everything else - not started, failed, or stopped short of
+        GRUB, where the boot window has long passed - is run again.
+        """
+        completed = []
+        booted = []
+        remaining = []
+        for job in jobs:
+            record = self.jobs.get(job['job_id'])
+            if record is None or record['key'] != job_key(job):
+                remaining.append(job)
+            elif record['stage'] == 'completed':
+                completed.append(record['job'])
+            elif record['stage'] == 'booted' and self.instance_fleets.get(record['instance_id']) in set(self.fleets) | {None}:
+                # Deleting a fleet terminates its instances - warm pool instances belong to no fleet
+                booted.append((record['region'], record['instance_id'], record['job']))
+            else:
+                remaining.append(job)
+        return completed, booted, remaining
+
+
+def load_journal(path):
+    """Replay the journal at path into a JournalState. A missing journal is an empty one."""
+    state = JournalState()
+    if not os.path.exists(path):
+        return state
+    with open(path, 'r') as journal_file:
+        for line in journal_file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                state.damaged += 1
+                continue
+            state.apply(record)
+    return state
+
+
+# Shared by every stage of a run
+journal = RunJournal()
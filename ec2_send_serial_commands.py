@@ -1,52 +1,309 @@
 import paramiko
-import io
+import re
+import socket
 import time
+from ec2_host_keys import host_key_store, known_hosts_name, HostKeyVerificationError
 
-def connect_serial_console(serial_console_endpoint, instance_id, private_key_pem, kernel_arguments):
-    # Load the private key from memory (StringIO)
-    private_key_file = io.StringIO(private_key_pem)
-    private_key = paramiko.RSAKey.from_private_key(private_key_file)
+# Text GRUB puts on screen when the boot menu is up.  When we attach part way through the countdown only
+# the countdown line gets redrawn, so that has to count as "menu is up" too.
+GRUB_MENU_MARKERS = (
+    "to edit the commands",
+    "executed automatically in",
+    "GNU GRUB",
+)
 
-    # Initialize the SSH client
-    ssh = paramiko.SSHClient()
+# Footer GRUB draws underneath the entry editor
+GRUB_EDITOR_MARKER = "Minimum Emacs-like screen editing is supported"
 
-    # Load SSH host keys.
-    ssh.load_system_host_keys()
+# GRUB prints this when Ctrl+X boots the edited entry
+GRUB_BOOT_MARKERS = (
+    "Booting a command list",
+    "Booting `",
+)
 
-    # Auto add host key policy (dangerous in production, but useful for testing)
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+# Matches the kernel line in the GRUB entry editor, allowing for the box border GRUB draws around it
+GRUB_LINUX_LINE = re.compile(r"^[\s|│]*linux(efi)?\s+\S")
 
-    # Connect to the instance serial console using SSH
-    print(f"Connecting to {serial_console_endpoint} via SSH...")
-    ssh.connect(serial_console_endpoint, username=instance_id + '.port0', pkey=private_key, allow_agent=False, look_for_keys=False)
+# ANSI control sequences GRUB uses on the serial terminal
+CSI_SEQUENCE = re.compile(r"\x1b\[([0-9;?]*)([@-~])")
+OTHER_ESCAPE = re.compile(r"\x1b[()][0-9A-Za-z]|\x1b[78=>DEM]")
+
+KEY_DOWN = '\x1b[B'
+KEY_CTRL_E = '\x05'
+KEY_CTRL_X = '\x18'
+
+
+class SerialConsoleError(Exception):
+    """Raised when the serial console does not reach the screen we expect within the step timeout."""
+
+
+class SerialConsoleConnectError(SerialConsoleError):
+    """Raised when the serial console refuses or drops a connection before the session is up."""
+
+
+class SerialConsoleAuthError(SerialConsoleConnectError):
+    """Raised when the serial console rejects the key, e.g. because it expired before we connected."""
+
+
+class SerialConsoleHostKeyError(SerialConsoleError):
+    """Raised when the serial console endpoint presents a host key we do not trust - never worth retrying."""
+
+
+class ConsoleScreen:
+    """Minimal VT100 screen model - just enough to read back what GRUB draws on the serial console."""
+
+    def __init__(self, rows=24, cols=80, on_data=None):
+        self.rows = rows
+        self.cols = cols
+        self.cells = [[' '] * cols for _ in range(rows)]
+        self.row = 0
+        self.col = 0
+        # Bumped on every feed() so callers can tell when the screen has been redrawn
+        self.version = 0
+        # Everything received from the console, for logging once the session is over
+        self.transcript = []
+        # Optional callback given every piece of raw output, e.g. ConsoleCapture.feed
+        self.on_data = on_data
+        self._pending = ''
+
+    def feed(self, data):
+        self.transcript.append(data)
+        self.version += 1
+        if self.on_data is not None:
+            self.on_data(data)
+        data = self._pending + data
+        self._pending = ''
+        i = 0
+        while i < len(data):
+            char = data[i]
+            if char == '\x1b':
+                match = CSI_SEQUENCE.match(data, i) or OTHER_ESCAPE.match(data, i)
+                if match is None:
+                    # Escape sequence split across two reads - keep it until the rest arrives
+                    if len(data) - i < 16:
+                        self._pending = data[i:]
+                        return
+                    i += 1
+                    continue
+                if match.re is CSI_SEQUENCE:
+                    self._apply_csi(match.group(1), match.group(2))
+                i = match.end()
+                continue
+            if char == '\r':
+                self.col = 0
+            elif char == '\n':
+                self._line_feed()
+            elif char == '\b':
+                self.col = max(self.col - 1, 0)
+            elif char >= ' ' and char != '\x7f':
+                if self.col >= self.cols:
+                    self.col = 0
+                    self._line_feed()
+                self.cells[self.row][self.col] = char
+                self.col += 1
+            i += 1
+
+    def _line_feed(self):
+        if self.row == self.rows - 1:
+            self.cells.pop(0)
+            self.cells.append([' '] * self.cols)
+        else:
+            self.row += 1
+
+    def _apply_csi(self, params, command):
+        values = [int(value) if value.isdigit() else 0 for value in params.lstrip('?').split(';')]
+        count = max(values[0], 1)
+        if command in 'Hf':
+            row = values[0] if values[0] else 1
+            col = values[1] if len(values) > 1 and values[1] else 1
+            self.row = min(row, self.rows) - 1
+            self.col = min(col, self.cols) - 1
+        elif command == 'A':
+            self.row = max(self.row - count, 0)
+        elif command == 'B':
+            self.row = min(self.row + count, self.rows - 1)
+        elif command == 'C':
+            self.col = min(self.col + count, self.cols - 1)
+        elif command == 'D':
+            self.col = max(self.col - count, 0)
+        elif command == 'J':
+            if values[0] == 2:
+                self.cells = [[' '] * self.cols for _ in range(self.rows)]
+            elif values[0] == 0:
+                self.cells[self.row][self.col:] = [' '] * (self.cols - self.col)
+                for row in range(self.row + 1, self.rows):
+                    self.cells[row] = [' '] * self.cols
+        elif command == 'K':
+            if values[0] == 0:
+                self.cells[self.row][self.col:] = [' '] * (self.cols - self.col)
+            elif values[0] == 2:
+                self.cells[self.row] = [' '] * self.cols
+        # Colours, cursor visibility and anything else do not change the text on screen
+
+    def lines(self):
+        return [''.join(row).rstrip() for row in self.cells]
+
+    def text(self):
+        return '\n'.join(self.lines())
+
+    def cursor_line(self):
+        return self.lines()[self.row]
+
+    def output(self):
+        return ''.join(self.transcript)
 
-    # Start an interactive shell session
-    console = ssh.invoke_shell()
 
-    # Send some keystrokes to interact with GRUB or the instance
-    time.sleep(5)
-    console.send('e')  # Example: 'e' to edit GRUB entry
+def wait_for_screen(console, screen, condition, timeout, step, settle=0.0):
+    """Read from the console until condition(screen) holds, then until the screen has been idle for `settle` seconds."""
+    deadline = time.monotonic() + timeout
+    satisfied_at = None
+    while True:
+        now = time.monotonic()
+        if satisfied_at is None and condition(screen):
+            satisfied_at = now
+        if satisfied_at is not None and now - satisfied_at >= settle:
+            return screen
+        if now >= deadline:
+            raise SerialConsoleError(
+                f"Timed out after {timeout}s waiting for {step}. Last screen:\n{screen.text()}"
+            )
 
-    # Press the down arrow key 16 times - this works on the default Ubuntu config but will need changing for other OS and bootloaders
-    for _ in range(16):
-        # Send the down arrow key (ANSI escape sequence for down arrow is '\x1b[B')
-        time.sleep(1)  # Add a slight delay to ensure shell is ready
-        console.send('\x1b[B')  # This sends the down arrow key
+        try:
+            data = console.recv(4096)
+        except socket.timeout:
+            continue
+        if not data:
+            raise SerialConsoleError(f"Serial console closed while waiting for {step}.")
+        screen.feed(data.decode('utf-8', errors='replace'))
+        # New output restarts the settle period - GRUB may still be redrawing
+        if satisfied_at is not None:
+            satisfied_at = time.monotonic() if condition(screen) else None
 
-    # Send the Ctrl+E key combination (ASCII control sequence for Ctrl+E is '\x05') to move the cursor to the line end
-    time.sleep(1)  # Add a slight delay to ensure shell is ready
-    console.send('\x05')  # This sends Ctrl+E
 
-    time.sleep(1)
+def is_grub_menu(screen):
+    text = screen.text()
+    return any(marker in text for marker in GRUB_MENU_MARKERS)
+
+
+def is_grub_editor(screen):
+    return GRUB_EDITOR_MARKER in screen.text()
+
+
+def is_booting(screen):
+    text = screen.output()
+    return any(marker in text for marker in GRUB_BOOT_MARKERS)
+
+
+def find_linux_row(screen):
+    """Return the first screen row at or below the cursor holding the kernel line, or None if it is not visible."""
+    lines = screen.lines()
+    for row in range(screen.row, len(lines)):
+        if GRUB_LINUX_LINE.match(lines[row]):
+            return row
+    return None
+
+
+def drive_grub(console, screen, kernel_arguments, menu_timeout=180, step_timeout=10, settle=0.3, max_lines=64):
+    """Open the default GRUB entry in the editor, append kernel_arguments to the linux line and boot it."""
+
+    # Wait for the GRUB menu rather than guessing how long firmware takes
+    wait_for_screen(console, screen, is_grub_menu, menu_timeout, "the GRUB boot menu")
+    console.send('e')  # 'e' to edit the highlighted GRUB entry
+    wait_for_screen(console, screen, is_grub_editor, step_timeout, "the GRUB entry editor", settle=settle)
+
+    # Walk the cursor down to the linux line.  If it is already on screen jump straight to it, otherwise
+    # step one line at a time so the editor scrolls it into view.
+    moved = 0
+    while not GRUB_LINUX_LINE.match(screen.cursor_line()):
+        if moved >= max_lines:
+            raise SerialConsoleError(
+                f"No linux line found within {max_lines} lines of the GRUB entry. Last screen:\n{screen.text()}"
+            )
+        linux_row = find_linux_row(screen)
+        steps = linux_row - screen.row if linux_row is not None else 1
+        version = screen.version
+        console.send(KEY_DOWN * steps)
+        moved += steps
+        wait_for_screen(console, screen, lambda s: s.version > version, step_timeout,
+                        "the GRUB editor to move the cursor", settle=settle)
+
+    # Ctrl+E moves the cursor to the end of the line
+    version = screen.version
+    console.send(KEY_CTRL_E)
+    wait_for_screen(console, screen, lambda s: s.version > version, step_timeout,
+                    "the cursor to reach the end of the linux line", settle=settle)
+
+    version = screen.version
     console.send(' ' + kernel_arguments + '\n')  # Enter a space, the required kernel parameters, and enter
+    wait_for_screen(console, screen, lambda s: s.version > version, step_timeout,
+                    "GRUB to echo the kernel arguments", settle=settle)
+
+    console.send(KEY_CTRL_X)  # Boot the modified kernel - send Ctrl+X
+    wait_for_screen(console, screen, is_booting, step_timeout, "GRUB to boot the edited entry")
+    return screen
+
+
+def connect_serial_console(serial_console_endpoint, instance_id, private_key, kernel_arguments, menu_timeout=180, step_timeout=10, capture=None, on_connected=None, host_keys=None):
+    """Boot the instance with kernel_arguments appended, then either close the session or, given a
+    ConsoleCapture, hand the session over to it to record the rest of the boot. on_connected, if given, is
+    called once the serial console has accepted the session."""
+    # private_key is an already parsed paramiko key (see ec2_key_provider), so there is nothing to load here
+
+    # Initialize the SSH client
+    ssh = paramiko.SSHClient()
+
+    # Host keys are checked against the store loaded once for the run (see ec2_host_keys.py), rather than
+    # reading known_hosts for every connection
+    host_keys = host_keys or host_key_store
+    ssh.set_missing_host_key_policy(host_keys.policy())
+
+    # Connect to the instance serial console using SSH
+    # The endpoint may carry a port, e.g. for the local simulator in ec2_simulator.py
+    print(f"Connecting to {serial_console_endpoint} via SSH...")
+    hostname, _, port = serial_console_endpoint.partition(':')
+    host_key_name = known_hosts_name(serial_console_endpoint)
+    try:
+        ssh.connect(hostname, port=int(port or 22), username=instance_id + '.port0', pkey=private_key, allow_agent=False, look_for_keys=False,
+                    **host_keys.connect_options(host_key_name))
+    except HostKeyVerificationError as e:
+        ssh.close()
+        raise SerialConsoleHostKeyError(f"Refusing the serial console of {instance_id}: {e}") from e
+    except paramiko.AuthenticationException as e:
+        ssh.close()
+        raise SerialConsoleAuthError(f"The serial console of {instance_id} rejected the key: {e}") from e
+    except (paramiko.SSHException, OSError) as e:
+        ssh.close()
+        host_keys.forget_transport(host_key_name)
+        raise SerialConsoleConnectError(f"Could not connect to the serial console of {instance_id}: {e}") from e
+    host_keys.remember_transport(host_key_name, ssh.get_transport())
+    if on_connected is not None:
+        on_connected()
+
+    following = False
+    try:
+        # Start an interactive shell session.  The short channel timeout keeps reads responsive while we
+        # poll the screen - it is not a limit on how long any step may take.
+        console = ssh.invoke_shell()
+        console.settimeout(0.2)
 
-    time.sleep(1)
-    console.send('\x18')  # Boot the modified kernel - send Ctrl+X
+        screen = ConsoleScreen(on_data=capture.feed if capture is not None else None)
+        drive_grub(console, screen, kernel_arguments, menu_timeout=menu_timeout, step_timeout=step_timeout)
+        print(f"Instance {instance_id}: kernel arguments applied, booting.")
 
-    # Read the output
-    time.sleep(2)
-    output = console.recv(10240).decode()
-    print(output)
+        if capture is not None:
+            # Keep reading the rest of the boot in the background - the capture closes the session
+            capture.follow(ssh, console)
+            following = True
+            return screen.output()
 
-    # Close the connection
-    ssh.close()
\ No newline at end of file
+        output = screen.output()
+        print(output)
+        return output
+    except (paramiko.SSHException, OSError, EOFError) as e:
+        # The session dropped under us, e.g. because the instance was stopped or reclaimed. paramiko raises a
+        # bare EOFError when the channel closes under a send.
+        raise SerialConsoleError(f"Serial console session to {instance_id} failed: {e or 'session closed'}") from e
+    finally:
+        # Close the connection
+        if not following:
+            ssh.close()
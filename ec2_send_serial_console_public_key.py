@@ -1,3 +1,5 @@
+from botocore.exceptions import ClientError
+
 def send_serial_console_ssh_public_key(ec2_instance_connect, instance_id, public_key):
     # Construct the AWS CLI command to send the SSH public key to the instance serial console
     response = ec2_instance_connect.send_serial_console_ssh_public_key(
@@ -7,3 +9,18 @@ def send_serial_console_ssh_public_key(ec2_instance_connect, instance_id, public
     )
     print(response)
     return response
+
+def send_serial_console_key(ec2_instance_connect, key_provider, instance_id):
+    """Push a key from key_provider to the instance, moving to the next key type if the serial console rejects it.
+
+    Returns the key that was accepted.
+    """
+    ssh_key = key_provider.get_key()
+    while True:
+        try:
+            send_serial_console_ssh_public_key(ec2_instance_connect, instance_id, ssh_key.public_key)
+            return ssh_key
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'InvalidArgsException' or not key_provider.fall_back(ssh_key):
+                raise
+        ssh_key = key_provider.get_key()
@@ -0,0 +1,1036 @@
+# ec2_simulator.py
+#
+# A local stand-in for EC2, EC2 Instance Connect and the EC2 serial console, so orchestration changes can be
+# measured without launching (and paying for) real instances. See benchmark.py for how it is driven.
+
+import base64
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import logging
+import random
+import re
+import socket
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from xml.sax.saxutils import escape
+import boto3
+import paramiko
+from botocore import xform_name
+from botocore.awsrequest import AWSResponse
+from botocore.exceptions import ClientError
+from ec2_client_pool import AwsClientPool
+from ec2_rate_limiter import THROTTLE_ERROR_CODES
+
+# Timings of a simulated instance, in seconds. Real instances take far longer - these are scaled down so a
+# benchmark of 1000 instances finishes in minutes, while keeping the same order of events.
+DEFAULT_TIMINGS = {
+    # Launch to 'running'
+    'pending_time': 1.0,
+    # 'running' to the GRUB menu appearing on the serial console
+    'grub_delay': 1.0,
+    # GRUB menu countdown before the default entry boots unedited
+    'grub_timeout': 30.0,
+    # Kernel start to the workload finishing and the instance shutting itself down
+    'workload_time': 2.0,
+    # 'stopping' to 'stopped'
+    'stop_time': 0.5,
+    # Tagging the instance to its userdata seeing the tag, in the kexec and grub-editenv boot modes
+    'tag_delay': 0.2,
+    # kexec into the kernel with the job's arguments
+    'kexec_time': 0.3,
+    # Rebooting through firmware and GRUB after grub-editenv
+    'reboot_time': 1.5,
+    # CreateImage to the image being available
+    'image_time': 1.0,
+    # Each timing above is stretched by up to this fraction at random
+    'jitter': 0.2,
+}
+
+# Resource IDs are unique across every simulated cloud, as they are across regions
+RESOURCE_IDS = itertools.count(1)
+
+# How long a key pushed with SendSerialConsoleSSHPublicKey stays valid
+SERIAL_CONSOLE_KEY_LIFETIME = 60.0
+
+# The GRUB entry shown in the editor, as on the default Ubuntu 24.04 AMI
+GRUB_ENTRY = [
+    "setparams 'Ubuntu'",
+    "",
+    "        recordfail",
+    "        load_video",
+    "        gfxmode $linux_gfx_mode",
+    "        insmod gzio",
+    "        if [ x$grub_platform = xxen ]; then insmod xzio; insmod lzopio; fi",
+    "        insmod part_gpt",
+    "        insmod ext2",
+    "        search --no-floppy --fs-uuid --set=root 00000000-0000-0000-0000-000000000000",
+    "        if [ x$feature_platform_search_hint = xy ]; then",
+    "          search --no-floppy --fs-uuid --set=root 00000000-0000-0000-0000-000000000000",
+    "        else",
+    "          search --no-floppy --fs-uuid --set=root 00000000-0000-0000-0000-000000000000",
+    "        fi",
+    "        echo        'Loading Linux 6.8.0-sim ...'",
+    "        linux        /boot/vmlinuz-6.8.0-sim root=LABEL=cloudimg-rootfs ro console=tty1 console=ttyS0",
+    "        echo        'Loading initial ramdisk ...'",
+    "        initrd        /boot/initrd.img-6.8.0-sim",
+]
+GRUB_EDITOR_ROWS = 12
+# The kernel command line of the default entry
+DEFAULT_KERNEL_COMMAND_LINE = ' '.join(next(line for line in GRUB_ENTRY if line.split()[:1] == ['linux']).split()[2:])
+
+# Clients hanging up mid-boot is normal here, so keep the server side transports quiet about it
+logging.getLogger('ec2_simulator.serial_console').setLevel(logging.CRITICAL)
+
+
+def client_error(code, message, operation):
+    return ClientError({'Error': {'Code': code, 'Message': message}}, operation)
+
+
+def userdata_boot_mode(launch_template_data):
+    """(mode, tag timeout, tags visible) of the bootstrap from ec2_boot_mode_helper.py in the template's userdata,
+    or None. The bootstrap cannot see the instance's tags unless the template enables them in the instance metadata."""
+    userdata = base64.b64decode(launch_template_data.get('UserData', ''))
+    if userdata.startswith(b'\x1f\x8b'):
+        # Compressed as in ec2_userdata_helper.py, which cloud-init gunzips
+        userdata = gzip.decompress(userdata)
+    userdata = userdata.decode('utf-8')
+    mode = re.search(r'^BOOT_MODE=(\S+)$', userdata, re.MULTILINE)
+    if mode is None:
+        return None
+    tag_timeout = float(re.search(r'^TAG_TIMEOUT=(\d+)$', userdata, re.MULTILINE).group(1))
+    return mode.group(1), tag_timeout, (launch_template_data.get('MetadataOptions') or {}).get('InstanceMetadataTags') == 'enabled'
+
+
+def check_userdata_size(launch_template_data, operation):
+    # EC2 takes at most 16 KB of userdata, counted before base64 encoding
+    size = len(base64.b64decode(launch_template_data.get('UserData', '')))
+    if size > 16384:
+        raise client_error('InvalidUserData.Malformed', f"User data is limited to 16384 bytes, not {size}", operation)
+
+
+def result_page(items, max_results=None, next_token=None):
+    """One page of a describe call's results, and the NextToken of the next page or None."""
+    start = int(next_token or 0)
+    end = len(items) if max_results is None else start + max_results
+    return items[start:end], str(end) if end < len(items) else None
+
+
+def merge_tags(tags, new_tags):
+    """CreateTags overwrites the value of a tag key the resource already has."""
+    merged = {tag['Key']: tag['Value'] for tag in tags}
+    merged.update({tag['Key']: tag['Value'] for tag in new_tags})
+    return [{'Key': key, 'Value': value} for key, value in merged.items()]
+
+
+class SimulatedInstance:
+    """One simulated instance. Its state is worked out from timestamps, so no thread runs per instance."""
+
+    def __init__(self, instance_id, instance_type, timings, lifecycle, interruption_rate=0.0, boot_mode=None):
+        self.instance_id = instance_id
+        self.instance_type = instance_type
+        self.lifecycle = lifecycle
+        self.subnet_id = None
+        self.availability_zone = 'sim-1a'
+        self.tags = {}
+        self.timings = timings
+        # (mode, tag timeout, tags visible) if the userdata boots the instance with its kernel arguments, see ec2_boot_mode_helper.py
+        self.boot_mode = boot_mode
+        self.launched_at = time.monotonic()
+        self.terminated_at = None
+        self.state_reason = None
+        # Spot instances are reclaimed at a random point of their first boot with probability interruption_rate
+        self.interrupt_at = None
+        if lifecycle == 'spot' and random.random() < interruption_rate:
+            self.interrupt_at = self.launched_at + random.uniform(0, timings['pending_time'] + timings['grub_delay'] + timings['workload_time'] + 5.0)
+        # (JobId tag, kernel command line) of every boot, as a warm pool instance boots once per job
+        self.boots = []
+        self.lock = threading.Lock()
+        self.schedule_boot(self.launched_at)
+
+    def schedule_boot(self, started_at):
+        timings = self.timings
+
+        def stretch(name):
+            return timings[name] * (1 + random.uniform(0, timings['jitter']))
+
+        self.running_at = started_at + stretch('pending_time')
+        self.grub_shown_at = self.running_at + stretch('grub_delay')
+        self.grub_deadline = self.grub_shown_at + timings['grub_timeout']
+        if self.boot_mode is not None:
+            # A stock AMI boots straight through GRUB into the userdata, which powers off if no job turns up
+            self.grub_deadline = self.grub_shown_at + self.boot_mode[1]
+        self.workload_time = stretch('workload_time')
+        self.stop_time = stretch('stop_time')
+
+        # Set when the console boots an edited entry - otherwise GRUB boots the default at grub_deadline
+        self.booted_at = None
+        self.cmdline = None
+
+    def start(self):
+        """Start a stopped instance again, for another trip through GRUB."""
+        with self.lock:
+            self.schedule_boot(time.monotonic())
+
+    def boot(self, cmdline):
+        with self.lock:
+            if self.booted_at is None:
+                self.booted_at = time.monotonic()
+                self.cmdline = cmdline
+                self.boots.append((self.tags.get('JobId'), cmdline))
+
+    def tagged(self):
+        """The userdata of the kexec and grub-editenv boot modes sees the job's tags and boots with its arguments."""
+        with self.lock:
+            if self.boot_mode is None or not self.boot_mode[2] or self.booted_at is not None or 'BootToken' not in self.tags:
+                return
+            arguments = self.tags.get('KernelArguments', '')
+            ready = max(time.monotonic() + self.timings['tag_delay'], self.grub_shown_at)
+            if arguments:
+                ready += self.timings['kexec_time' if self.boot_mode[0] == 'kexec' else 'reboot_time']
+            # In the future, as state() works everything out from timestamps
+            self.booted_at = ready
+            self.cmdline = f"{DEFAULT_KERNEL_COMMAND_LINE} {arguments}".strip()
+            self.boots.append((self.tags.get('JobId'), self.cmdline))
+
+    def stop_grub_countdown(self):
+        # Any key pressed at the GRUB menu stops the countdown
+        with self.lock:
+            self.grub_deadline = float('inf')
+
+    def boot_time(self):
+        with self.lock:
+            return self.booted_at if self.booted_at is not None else self.grub_deadline
+
+    def shutdown_at(self):
+        return self.boot_time() + self.workload_time
+
+    def terminate(self, at, code, message):
+        with self.lock:
+            if self.terminated_at is None:
+                self.terminated_at = at + self.stop_time
+                self.state_reason = {'Code': code, 'Message': message}
+
+    def state(self, now=None):
+        now = time.monotonic() if now is None else now
+        if self.interrupt_at is not None and self.terminated_at is None and self.interrupt_at <= now and self.interrupt_at < self.shutdown_at():
+            self.terminate(self.interrupt_at, 'Server.SpotInstanceTermination', 'Server.SpotInstanceTermination: Spot instance termination')
+        if self.terminated_at is not None:
+            return 'terminated' if now >= self.terminated_at else 'shutting-down'
+        if now < self.running_at:
+            return 'pending'
+        shutdown_at = self.shutdown_at()
+        if now < shutdown_at:
+            return 'running'
+        if now < shutdown_at + self.stop_time:
+            return 'stopping'
+        return 'stopped'
+
+    def describe(self):
+        state = self.state()
+        description = {
+            'InstanceId': self.instance_id,
+            'InstanceType': self.instance_type,
+            'InstanceLifecycle': self.lifecycle,
+            'State': {'Name': state, 'Code': {'pending': 0, 'running': 16, 'shutting-down': 32, 'terminated': 48, 'stopping': 64, 'stopped': 80}[state]},
+            'Placement': {'AvailabilityZone': self.availability_zone},
+            'SubnetId': self.subnet_id,
+            'PublicIpAddress': '127.0.0.1',
+            'Tags': [{'Key': key, 'Value': value} for key, value in self.tags.items()],
+        }
+        if self.state_reason is not None:
+            description['StateReason'] = dict(self.state_reason)
+        return description
+
+
+class SimulatedCloud:
+    """Shared state behind the simulated EC2 and EC2 Instance Connect clients."""
+
+    def __init__(self, timings=None, api_latency=0.0, throttle_rate=None, throttle_burst=100, capacity=None, interruption_rate=0.0, pool_capacity=None, key_lifetime=SERIAL_CONSOLE_KEY_LIFETIME, max_console_sessions=None):
+        self.timings = dict(DEFAULT_TIMINGS)
+        self.timings.update(timings or {})
+        # Seconds added to every API call
+        self.api_latency = api_latency
+        # Calls per second allowed across both clients before RequestLimitExceeded, None for no limit
+        self.throttle_rate = throttle_rate
+        self.throttle_burst = throttle_burst
+        # Most instances that may exist at once, None for no limit - create_fleet fills what it can
+        self.capacity = capacity
+        # Most instances that may exist at once in each pool of instance type and subnet, None for no limit
+        self.pool_capacity = pool_capacity
+        self.subnets = {}
+        # Fraction of spot instances reclaimed before they finish their job
+        self.interruption_rate = interruption_rate
+        # Seconds a pushed serial console key stays valid
+        self.key_lifetime = key_lifetime
+        # Most serial console sessions open at once, None for no limit - the server hangs up on any beyond it
+        self.max_console_sessions = max_console_sessions
+
+        self.instances = {}
+        self.fleets = {}
+        self.fleet_tags = {}
+        self.launch_templates = {}
+        self.images = {}
+        self.serial_console_keys = {}
+        self.calls = {}
+        self.throttled = 0
+        self.lock = threading.Lock()
+        self._tokens = throttle_burst
+        self._refilled_at = time.monotonic()
+
+    def new_id(self, prefix):
+        return f"{prefix}-{next(RESOURCE_IDS):017x}"
+
+    def api_call(self, operation):
+        """Count the call, apply the throttle and the simulated latency."""
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+            if self.throttle_rate is not None:
+                now = time.monotonic()
+                self._tokens = min(self.throttle_burst, self._tokens + (now - self._refilled_at) * self.throttle_rate)
+                self._refilled_at = now
+                if self._tokens < 1:
+                    self.throttled += 1
+                    raise client_error('RequestLimitExceeded', 'Request limit exceeded.', operation)
+                self._tokens -= 1
+        if self.api_latency:
+            time.sleep(self.api_latency)
+
+    def live_instances(self, instance_type=None, subnet_id=None):
+        return sum(1 for instance in self.instances.values() if instance.terminated_at is None
+                   and instance_type in (None, instance.instance_type) and subnet_id in (None, instance.subnet_id))
+
+    def free_capacity(self, instance_type, subnet_id):
+        """Instances that can still be launched into one capacity pool, within the overall capacity."""
+        free = float('inf') if self.capacity is None else self.capacity - self.live_instances()
+        if self.pool_capacity is not None:
+            free = min(free, self.pool_capacity - self.live_instances(instance_type, subnet_id))
+        return free
+
+    def availability_zone(self, subnet_id):
+        # Each subnet seen is placed in the next availability zone
+        if subnet_id not in self.subnets:
+            self.subnets[subnet_id] = f"sim-1{chr(ord('a') + len(self.subnets) % 26)}"
+        return self.subnets[subnet_id]
+
+
+class SimulatedEc2Client:
+    """The subset of the EC2 API used by this project, answering the requests of a SimulatedClientPool client."""
+
+    def __init__(self, cloud):
+        self.cloud = cloud
+
+    def describe_instances(self, InstanceIds=None, Filters=None, **kwargs):
+        self.cloud.api_call('DescribeInstances')
+        if InstanceIds:
+            missing = [instance_id for instance_id in InstanceIds if instance_id not in self.cloud.instances]
+            if missing:
+                raise client_error('InvalidInstanceID.NotFound', f"The instance IDs '{', '.join(missing)}' do not exist", 'DescribeInstances')
+            instances = [self.cloud.instances[instance_id] for instance_id in InstanceIds]
+        else:
+            instances = list(self.cloud.instances.values())
+        for instance_filter in Filters or []:
+            if instance_filter['Name'] == 'instance-id':
+                instances = [instance for instance in instances if instance.instance_id in instance_filter['Values']]
+            elif instance_filter['Name'] == 'instance-state-name':
+                instances = [instance for instance in instances if instance.state() in instance_filter['Values']]
+            elif instance_filter['Name'].startswith('tag:'):
+                key = instance_filter['Name'][len('tag:'):]
+                instances = [instance for instance in instances if instance.tags.get(key) in instance_filter['Values']]
+        return {'Reservations': [{'Instances': [instance.describe() for instance in instances]}] if instances else []}
+
+    def create_tags(self, Resources, Tags):
+        self.cloud.api_call('CreateTags')
+        for resource in Resources:
+            if resource in self.cloud.launch_templates:
+                self.cloud.launch_templates[resource]['Tags'] = merge_tags(self.cloud.launch_templates[resource]['Tags'], Tags)
+            if resource in self.cloud.fleet_tags:
+                self.cloud.fleet_tags[resource] = merge_tags(self.cloud.fleet_tags[resource], Tags)
+            if resource in self.cloud.instances:
+                self.cloud.instances[resource].tags.update({tag['Key']: tag['Value'] for tag in Tags})
+                self.cloud.instances[resource].tagged()
+        return {}
+
+    def describe_launch_templates(self, LaunchTemplateNames=None, LaunchTemplateIds=None, Filters=None, MaxResults=None, NextToken=None, **kwargs):
+        self.cloud.api_call('DescribeLaunchTemplates')
+        templates = [template for template in self.cloud.launch_templates.values()
+                     if (not LaunchTemplateNames or template['LaunchTemplateName'] in LaunchTemplateNames)
+                     and (not LaunchTemplateIds or template['LaunchTemplateId'] in LaunchTemplateIds)]
+        if LaunchTemplateNames and not templates:
+            raise client_error('InvalidLaunchTemplateName.NotFoundException', 'Launch template not found', 'DescribeLaunchTemplates')
+        for template_filter in Filters or []:
+            if template_filter['Name'] == 'tag-key':
+                templates = [template for template in templates if any(tag['Key'] in template_filter['Values'] for tag in template['Tags'])]
+        page, next_token = result_page(templates, MaxResults, NextToken)
+        response = {'LaunchTemplates': [dict(template) for template in page]}
+        if next_token:
+            response['NextToken'] = next_token
+        return response
+
+    def create_launch_template(self, LaunchTemplateName, LaunchTemplateData, VersionDescription=None, **kwargs):
+        self.cloud.api_call('CreateLaunchTemplate')
+        check_userdata_size(LaunchTemplateData, 'CreateLaunchTemplate')
+        template = {
+            'LaunchTemplateId': self.cloud.new_id('lt'),
+            'LaunchTemplateName': LaunchTemplateName,
+            'LatestVersionNumber': 1,
+            'DefaultVersionNumber': 1,
+            'Versions': {1: {'VersionDescription': VersionDescription, 'LaunchTemplateData': LaunchTemplateData}},
+            'Tags': [tag for specification in kwargs.get('TagSpecifications') or [] if specification['ResourceType'] == 'launch-template' for tag in specification['Tags']],
+        }
+        self.cloud.launch_templates[template['LaunchTemplateId']] = template
+        return {'LaunchTemplate': {key: value for key, value in template.items() if key != 'Versions'}}
+
+    def create_launch_template_version(self, LaunchTemplateId, LaunchTemplateData, VersionDescription=None, **kwargs):
+        self.cloud.api_call('CreateLaunchTemplateVersion')
+        check_userdata_size(LaunchTemplateData, 'CreateLaunchTemplateVersion')
+        template = self.launch_template(LaunchTemplateId, 'CreateLaunchTemplateVersion')
+        template['LatestVersionNumber'] += 1
+        version = template['LatestVersionNumber']
+        template['Versions'][version] = {'VersionDescription': VersionDescription, 'LaunchTemplateData': LaunchTemplateData}
+        return {'LaunchTemplateVersion': {'LaunchTemplateId': LaunchTemplateId, 'VersionNumber': version, 'VersionDescription': VersionDescription}}
+
+    def describe_launch_template_versions(self, LaunchTemplateId, Versions=None, **kwargs):
+        self.cloud.api_call('DescribeLaunchTemplateVersions')
+        template = self.launch_template(LaunchTemplateId, 'DescribeLaunchTemplateVersions')
+        numbers = sorted(template['Versions']) if Versions is None else [int(version) for version in Versions]
+        missing = [number for number in numbers if number not in template['Versions']]
+        if missing:
+            raise client_error('InvalidLaunchTemplateId.VersionNotFound', f"Version {missing[0]} not found", 'DescribeLaunchTemplateVersions')
+        return {'LaunchTemplateVersions': [
+            dict(template['Versions'][number], LaunchTemplateId=LaunchTemplateId, VersionNumber=number, DefaultVersion=number == template['DefaultVersionNumber'])
+            for number in numbers
+        ]}
+
+    def delete_launch_template_versions(self, LaunchTemplateId, Versions):
+        self.cloud.api_call('DeleteLaunchTemplateVersions')
+        template = self.launch_template(LaunchTemplateId, 'DeleteLaunchTemplateVersions')
+        for version in Versions:
+            template['Versions'].pop(int(version), None)
+        return {'SuccessfullyDeletedLaunchTemplateVersions': [{'LaunchTemplateId': LaunchTemplateId, 'VersionNumber': int(version)} for version in Versions]}
+
+    def delete_launch_template(self, LaunchTemplateId):
+        self.cloud.api_call('DeleteLaunchTemplate')
+        self.cloud.launch_templates.pop(LaunchTemplateId, None)
+        return {}
+
+    def launch_template(self, launch_template_id, operation):
+        template = self.cloud.launch_templates.get(launch_template_id)
+        if template is None:
+            raise client_error('InvalidLaunchTemplateId.NotFound', f"Launch template {launch_template_id} not found", operation)
+        return template
+
+    def create_fleet(self, LaunchTemplateConfigs, TargetCapacitySpecification, Type='maintain', **kwargs):
+        self.cloud.api_call('CreateFleet')
+        specification = LaunchTemplateConfigs[0]['LaunchTemplateSpecification']
+        template = self.cloud.launch_templates.get(specification['LaunchTemplateId'])
+        if template is None:
+            raise client_error('InvalidLaunchTemplateId.NotFound', 'Launch template not found', 'CreateFleet')
+        version = self.template_version(template, specification.get('Version', '$Default'), 'CreateFleet')
+        data = template['Versions'][version]['LaunchTemplateData']
+        template_subnet = (data.get('NetworkInterfaces') or [{}])[0].get('SubnetId')
+        pools = []
+        for override in LaunchTemplateConfigs[0].get('Overrides') or [{}]:
+            pools.append({
+                'instance_type': override.get('InstanceType') or data.get('InstanceType'),
+                'subnet_id': override.get('SubnetId') or template_subnet,
+                'weight': int(override.get('WeightedCapacity', 1)),
+                'priority': override.get('Priority', 0),
+                'overrides': dict(override),
+            })
+
+        requested = TargetCapacitySpecification['TotalTargetCapacity']
+        on_demand = TargetCapacitySpecification.get('OnDemandTargetCapacity', 0)
+        with self.cloud.lock:
+            launched = []
+            units = 0
+            exhausted = []
+            while units < requested:
+                # Like capacityOptimized, take the next instance from the pool with the most room left
+                free = [(self.cloud.free_capacity(pool['instance_type'], pool['subnet_id']), -pool['priority'], index) for index, pool in enumerate(pools)]
+                room, _, index = max(free)
+                if room <= 0:
+                    exhausted = pools
+                    break
+                pool = pools[index]
+                lifecycle = 'on-demand' if units < on_demand else 'spot'
+                instance = self.new_instance(pool['instance_type'], lifecycle, template, version, pool['subnet_id'])
+                launched.append((instance, pool))
+                units += pool['weight']
+            fleet_id = f"fleet-{self.cloud.new_id('sim')}"
+            self.cloud.fleets[fleet_id] = [instance.instance_id for instance, _ in launched]
+            self.cloud.fleet_tags[fleet_id] = [tag for specification in kwargs.get('TagSpecifications') or [] if specification['ResourceType'] == 'fleet' for tag in specification['Tags']]
+
+        response = {'FleetId': fleet_id, 'Instances': [], 'Errors': []}
+        for lifecycle in ('on-demand', 'spot'):
+            for pool in pools:
+                instance_ids = [instance.instance_id for instance, launched_pool in launched if instance.lifecycle == lifecycle and launched_pool is pool]
+                if instance_ids:
+                    response['Instances'].append({
+                        'InstanceIds': instance_ids,
+                        'InstanceType': pool['instance_type'],
+                        'Lifecycle': lifecycle,
+                        'LaunchTemplateAndOverrides': {'LaunchTemplateSpecification': specification, 'Overrides': pool['overrides']},
+                    })
+        for pool in exhausted:
+            response['Errors'].append({
+                'ErrorCode': 'InsufficientInstanceCapacity',
+                'ErrorMessage': f"There is no {pool['instance_type']} capacity left in {pool['subnet_id']}. Launched {units} of {requested} units.",
+                'LaunchTemplateAndOverrides': {'LaunchTemplateSpecification': specification, 'Overrides': pool['overrides']},
+                'Lifecycle': 'spot',
+            })
+        return response
+
+    def template_version(self, template, version, operation):
+        version = {'$Latest': template['LatestVersionNumber'], '$Default': template['DefaultVersionNumber']}.get(version, version)
+        if int(version) not in template['Versions']:
+            raise client_error('InvalidLaunchTemplateId.VersionNotFound', f"Version {version} not found", operation)
+        return int(version)
+
+    def new_instance(self, instance_type, lifecycle, template, version, subnet_id=None):
+        # Called with the cloud lock held. EC2 tags instances with the launch template they came from.
+        instance = SimulatedInstance(self.cloud.new_id('i'), instance_type, self.cloud.timings, lifecycle, self.cloud.interruption_rate, userdata_boot_mode(template['Versions'][version]['LaunchTemplateData']))
+        instance.subnet_id = subnet_id or (template['Versions'][version]['LaunchTemplateData'].get('NetworkInterfaces') or [{}])[0].get('SubnetId')
+        instance.availability_zone = self.cloud.availability_zone(instance.subnet_id)
+        instance.tags['aws:ec2launchtemplate:id'] = template['LaunchTemplateId']
+        instance.tags['aws:ec2launchtemplate:version'] = str(version)
+        self.cloud.instances[instance.instance_id] = instance
+        return instance
+
+    def run_instances(self, LaunchTemplate, MinCount, MaxCount, InstanceType=None, **kwargs):
+        self.cloud.api_call('RunInstances')
+        template = self.launch_template(LaunchTemplate['LaunchTemplateId'], 'RunInstances')
+        version = self.template_version(template, LaunchTemplate.get('Version', '$Default'), 'RunInstances')
+        instance_type = InstanceType or template['Versions'][version]['LaunchTemplateData'].get('InstanceType')
+        with self.cloud.lock:
+            template_subnet = (template['Versions'][version]['LaunchTemplateData'].get('NetworkInterfaces') or [{}])[0].get('SubnetId')
+            available = max(min(MaxCount, self.cloud.free_capacity(instance_type, template_subnet)), 0)
+            if available < MinCount:
+                raise client_error('InsufficientInstanceCapacity', f"Only {available} {instance_type} instances available.", 'RunInstances')
+            launched = [self.new_instance(instance_type, 'on-demand', template, version) for _ in range(available)]
+            tags = {tag['Key']: tag['Value'] for specification in kwargs.get('TagSpecifications') or [] if specification['ResourceType'] == 'instance' for tag in specification['Tags']}
+            for instance in launched:
+                instance.tags.update(tags)
+        return {'Instances': [instance.describe() for instance in launched]}
+
+    def start_instances(self, InstanceIds):
+        self.cloud.api_call('StartInstances')
+        for instance_id in InstanceIds:
+            instance = self.cloud.instances.get(instance_id)
+            if instance is None:
+                raise client_error('InvalidInstanceID.NotFound', f"The instance ID '{instance_id}' does not exist", 'StartInstances')
+            if instance.lifecycle == 'spot':
+                raise client_error('UnsupportedOperation', f"The instance '{instance_id}' is a spot instance and cannot be started.", 'StartInstances')
+            if instance.state() != 'stopped':
+                raise client_error('IncorrectInstanceState', f"The instance '{instance_id}' is not in a state from which it can be started.", 'StartInstances')
+        for instance_id in InstanceIds:
+            self.cloud.instances[instance_id].start()
+        return {'StartingInstances': [{'InstanceId': instance_id, 'CurrentState': {'Name': 'pending'}, 'PreviousState': {'Name': 'stopped'}} for instance_id in InstanceIds]}
+
+    def terminate_instances(self, InstanceIds):
+        self.cloud.api_call('TerminateInstances')
+        self.terminate(InstanceIds)
+        return {'TerminatingInstances': [{'InstanceId': instance_id} for instance_id in InstanceIds]}
+
+    def describe_fleets(self, FleetIds=None, Filters=None, MaxResults=None, NextToken=None, **kwargs):
+        self.cloud.api_call('DescribeFleets')
+        # Deleted fleets are forgotten, so every fleet here is active
+        fleet_ids = [fleet_id for fleet_id in list(self.cloud.fleets) if not FleetIds or fleet_id in FleetIds]
+        for fleet_filter in Filters or []:
+            if fleet_filter['Name'] == 'fleet-state' and 'active' not in fleet_filter['Values']:
+                fleet_ids = []
+        page, next_token = result_page(fleet_ids, MaxResults, NextToken)
+        response = {'Fleets': [{'FleetId': fleet_id, 'FleetState': 'active', 'Type': 'instant', 'Tags': list(self.cloud.fleet_tags.get(fleet_id, []))} for fleet_id in page]}
+        if next_token:
+            response['NextToken'] = next_token
+        return response
+
+    def delete_fleets(self, FleetIds, TerminateInstances):
+        self.cloud.api_call('DeleteFleets')
+        if len(FleetIds) > 25:
+            raise client_error('InvalidParameterValue', 'You can delete up to 25 instant fleets in a single request.', 'DeleteFleets')
+        successful = []
+        for fleet_id in FleetIds:
+            instance_ids = self.cloud.fleets.pop(fleet_id, None)
+            self.cloud.fleet_tags.pop(fleet_id, None)
+            if instance_ids is None:
+                continue
+            if TerminateInstances:
+                self.terminate(instance_ids)
+            successful.append({'FleetId': fleet_id, 'CurrentFleetState': 'deleted_terminating', 'PreviousFleetState': 'active'})
+        unsuccessful = [{'FleetId': fleet_id, 'Error': {'Code': 'fleetIdDoesNotExist', 'Message': 'Fleet not found'}}
+                        for fleet_id in FleetIds if fleet_id not in {item['FleetId'] for item in successful}]
+        return {'SuccessfulFleetDeletions': successful, 'UnsuccessfulFleetDeletions': unsuccessful}
+
+    def create_image(self, InstanceId, Name, Description=None, TagSpecifications=None, **kwargs):
+        self.cloud.api_call('CreateImage')
+        if InstanceId not in self.cloud.instances:
+            raise client_error('InvalidInstanceID.NotFound', f"The instance ID '{InstanceId}' does not exist", 'CreateImage')
+        if any(image['Name'] == Name for image in self.cloud.images.values()):
+            raise client_error('InvalidAMIName.Duplicate', f"AMI name {Name} is already in use by another AMI", 'CreateImage')
+        image_id = self.cloud.new_id('ami')
+        tags = [tag for specification in TagSpecifications or [] if specification['ResourceType'] == 'image' for tag in specification['Tags']]
+        self.cloud.images[image_id] = {
+            'ImageId': image_id,
+            'Name': Name,
+            'Description': Description,
+            'Tags': tags,
+            'available_at': time.monotonic() + self.cloud.timings['image_time'],
+        }
+        return {'ImageId': image_id}
+
+    def describe_images(self, ImageIds=None, Owners=None, Filters=None, **kwargs):
+        self.cloud.api_call('DescribeImages')
+        if ImageIds:
+            missing = [image_id for image_id in ImageIds if image_id not in self.cloud.images]
+            if missing:
+                raise client_error('InvalidAMIID.NotFound', f"The image id '[{', '.join(missing)}]' does not exist", 'DescribeImages')
+        images = [image for image in self.cloud.images.values() if not ImageIds or image['ImageId'] in ImageIds]
+        for image_filter in Filters or []:
+            if image_filter['Name'].startswith('tag:'):
+                key = image_filter['Name'][len('tag:'):]
+                images = [image for image in images if any(tag['Key'] == key and tag['Value'] in image_filter['Values'] for tag in image['Tags'])]
+        now = time.monotonic()
+        return {'Images': [
+            dict({key: value for key, value in image.items() if key != 'available_at'}, State='available' if now >= image['available_at'] else 'pending')
+            for image in images
+        ]}
+
+    def terminate(self, instance_ids):
+        now = time.monotonic()
+        for instance_id in instance_ids:
+            self.cloud.instances[instance_id].terminate(now, 'Client.UserInitiatedShutdown', 'Client.UserInitiatedShutdown: User initiated shutdown')
+
+
+class SimulatedInstanceConnectClient:
+    """The subset of the boto3 EC2 Instance Connect client used by this project."""
+
+    def __init__(self, cloud):
+        self.cloud = cloud
+
+    def send_serial_console_ssh_public_key(self, InstanceId, SSHPublicKey, SerialPort=0):
+        self.cloud.api_call('SendSerialConsoleSSHPublicKey')
+        instance = self.cloud.instances.get(InstanceId)
+        if instance is None:
+            raise client_error('EC2InstanceNotFoundException', f"Instance {InstanceId} not found", 'SendSerialConsoleSSHPublicKey')
+        if instance.state() != 'running':
+            raise client_error('EC2InstanceStateInvalidException', f"Instance {InstanceId} is not running", 'SendSerialConsoleSSHPublicKey')
+        key_type, _, key_data = SSHPublicKey.partition(' ')
+        if key_type not in ('ssh-rsa', 'ssh-ed25519'):
+            raise client_error('InvalidArgsException', f"Unsupported key type {key_type}", 'SendSerialConsoleSSHPublicKey')
+        self.cloud.serial_console_keys[InstanceId] = (key_data.split(' ')[0], time.monotonic() + self.cloud.key_lifetime)
+        return {'RequestId': self.cloud.new_id('req'), 'Success': True}
+
+
+class SimulatedS3Client:
+    """The subset of the boto3 S3 client used to collect results, with the objects held in memory."""
+
+    def __init__(self, api_latency=0.0):
+        # Seconds added to every call
+        self.api_latency = api_latency
+        # {(bucket, key): {'Body': bytes, 'ETag': ..., 'LastModified': datetime}}
+        self.objects = {}
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def api_call(self, operation):
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+        if self.api_latency:
+            time.sleep(self.api_latency)
+
+    def put_object(self, Bucket, Key, Body, LastModified=None):
+        # Uploads stand in for the instances, so they are not slowed down by api_latency
+        with self.lock:
+            self.calls['PutObject'] = self.calls.get('PutObject', 0) + 1
+        body = Body.encode('utf-8') if isinstance(Body, str) else Body
+        with self.lock:
+            self.objects[(Bucket, Key)] = {
+                'Body': body,
+                'ETag': f'"{hashlib.md5(body).hexdigest()}"',
+                'LastModified': LastModified or datetime.now(timezone.utc).replace(microsecond=0),
+            }
+        return {'ETag': self.objects[(Bucket, Key)]['ETag']}
+
+    def list_objects_v2(self, Bucket, Prefix='', ContinuationToken=None, MaxKeys=1000, **kwargs):
+        self.api_call('ListObjectsV2')
+        with self.lock:
+            keys = sorted(key for bucket, key in self.objects if bucket == Bucket and key.startswith(Prefix) and (ContinuationToken is None or key > ContinuationToken))
+            page = [(key, self.objects[(Bucket, key)]) for key in keys[:MaxKeys]]
+        response = {
+            'KeyCount': len(page),
+            'IsTruncated': len(keys) > MaxKeys,
+            'Contents': [{'Key': key, 'ETag': item['ETag'], 'LastModified': item['LastModified'], 'Size': len(item['Body'])} for key, item in page],
+        }
+        if response['IsTruncated']:
+            response['NextContinuationToken'] = page[-1][0]
+        return response
+
+    def get_object(self, Bucket, Key):
+        self.api_call('GetObject')
+        with self.lock:
+            item = self.objects.get((Bucket, Key))
+        if item is None:
+            raise client_error('NoSuchKey', 'The specified key does not exist.', 'GetObject')
+        return {'Body': io.BytesIO(item['Body']), 'ETag': item['ETag'], 'LastModified': item['LastModified']}
+
+
+def simulated_result(instance, cmdline, job_id=None):
+    """A results_all.yml for one boot, with the instance_info.yml fields of userdata-script.sh and made up
+    benchmark figures that depend on the kernel command line, so that runs can be told apart."""
+    effect = (zlib.crc32(cmdline.encode('utf-8')) % 21 - 10) / 100
+    runtime = random.gauss(10.0 * (1 - effect), 0.3)
+    return (
+        "Aws:\n"
+        f"  InstanceType: {instance.instance_type}\n"
+        f"  CmdLine: BOOT_IMAGE=/boot/vmlinuz-6.8.0-sim {cmdline}\n"
+        f"  JobId: {job_id or ''}\n"
+        f"  RunId: {instance.tags.get('RunId', '')}\n"
+        "Benchmark:\n"
+        f"  runtime_seconds: {runtime:.3f}\n"
+        f"  operations_per_second: {1e6 / runtime:.1f}\n"
+        f"  latency_us: {{p50: {random.gauss(50.0 * (1 - effect), 2.0):.2f}, p99: {random.gauss(120.0 * (1 - effect), 8.0):.2f}}}\n"
+    )
+
+
+def upload_simulated_results(s3_client, bucket, clouds, prefix='results/'):
+    """Upload a result object for every boot of every simulated instance, named the way userdata-script.sh
+    names them. Returns the number uploaded."""
+    uploaded = 0
+    started = datetime.now(timezone.utc)
+    for cloud in clouds:
+        for instance in list(cloud.instances.values()):
+            for boot, (job_id, cmdline) in enumerate(instance.boots):
+                timestamp = (started + timedelta(seconds=boot)).strftime('%Y%m%d_%H%M%S')
+                s3_client.put_object(Bucket=bucket, Key=f"{prefix}{instance.instance_id}_{instance.instance_type}_{timestamp}.yml", Body=simulated_result(instance, cmdline, job_id))
+                uploaded += 1
+    return uploaded
+
+
+class SimulatedHttpBody(io.BytesIO):
+    """The raw body of a simulated HTTP response, readable the way botocore reads urllib3's."""
+
+    def stream(self, **kwargs):
+        yield self.getvalue()
+
+
+def simulated_error_body(protocol, code, message):
+    """The error document AWS sends for code in protocol, for botocore's parsers to turn back into a ClientError."""
+    if protocol == 'ec2':
+        return f"<Response><Errors><Error><Code>{escape(code)}</Code><Message>{escape(message)}</Message></Error></Errors><RequestID>simulated</RequestID></Response>"
+    if protocol == 'rest-xml':
+        return f"<Error><Code>{escape(code)}</Code><Message>{escape(message)}</Message></Error>"
+    return json.dumps({'__type': code, 'message': message})
+
+
+# An empty success document for each protocol - the parsed response is then replaced with the simulator's
+EMPTY_BODIES = {'ec2': '<Response></Response>', 'rest-xml': '', 'json': '{}', 'rest-json': '{}'}
+
+
+class SimulatedClientPool(AwsClientPool):
+    """An AwsClientPool (see ec2_client_pool.py) whose requests are answered by simulated clients instead of AWS.
+
+    The clients are real boto3 clients built the way a run builds them, with the same retry mode, parameter
+    validation and RateLimiter hooks, so the benchmark measures the code that ships. Only sending the request is
+    replaced: the simulated client of the service and region is called with the parameters as the caller passed
+    them, and its response - or ClientError, sent back as the error document of the service's protocol so
+    botocore can retry it - becomes the response of the call. simulated_clients is
+    {(service_name, region_name): simulated client}, with region_name as the pool resolves it.
+    """
+
+    def __init__(self, simulated_clients, region_name, rate_limiter=None, max_attempts=10):
+        # Requests are signed as usual, so they need credentials - any will do
+        session = boto3.Session(aws_access_key_id='simulated', aws_secret_access_key='simulated', region_name=region_name)
+        super().__init__(region_name=region_name, max_attempts=max_attempts, rate_limiter=rate_limiter, session=session)
+        self.simulated_clients = simulated_clients
+
+    def create_client(self, service_name, region_name):
+        client = super().create_client(service_name, region_name)
+        simulated_client = self.simulated_clients[(service_name, region_name)]
+        service_id = client.meta.service_model.service_id.hyphenize()
+        events = client.meta.events
+        # First, so the simulator sees the parameters before botocore fills in e.g. idempotency tokens
+        events.register_first(f"before-parameter-build.{service_id}", self._keep_params, unique_id='ec2-simulator-params')
+        events.register_last(f"before-send.{service_id}", partial(self._send, simulated_client), unique_id='ec2-simulator-send')
+        events.register_last(f"after-call.{service_id}", self._simulated_response, unique_id='ec2-simulator-response')
+        return client
+
+    @staticmethod
+    def _keep_params(params, model, context, **kwargs):
+        context['simulated_call'] = (xform_name(model.name), dict(params), model.service_model.protocol)
+
+    @staticmethod
+    def _send(simulated_client, request, **kwargs):
+        method_name, params, protocol = request.context['simulated_call']
+        try:
+            request.context['simulated_response'] = getattr(simulated_client, method_name)(**params)
+        except ClientError as e:
+            error = e.response['Error']
+            status_code = 503 if error['Code'] in THROTTLE_ERROR_CODES else 400
+            return AWSResponse(request.url, status_code, {'x-amzn-errortype': error['Code']}, SimulatedHttpBody(simulated_error_body(protocol, error['Code'], error['Message']).encode('utf-8')))
+        return AWSResponse(request.url, 200, {}, SimulatedHttpBody(EMPTY_BODIES.get(protocol, '').encode('utf-8')))
+
+    @staticmethod
+    def _simulated_response(parsed, context, **kwargs):
+        if 'simulated_response' in context:
+            parsed.update(context.pop('simulated_response'))
+
+
+class SerialConsoleServerInterface(paramiko.ServerInterface):
+    def __init__(self, cloud):
+        self.cloud = cloud
+        self.instance_id = None
+        self.shell_requested = threading.Event()
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_auth_publickey(self, username, key):
+        instance_id = username[:-len('.port0')] if username.endswith('.port0') else None
+        pushed = self.cloud.serial_console_keys.get(instance_id)
+        if pushed is None or time.monotonic() > pushed[1] or key.get_base64() != pushed[0]:
+            return paramiko.AUTH_FAILED
+        self.instance_id = instance_id
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_pty_request(self, channel, term, width, height, pixelwidth, pixelheight, modes):
+        return True
+
+    def check_channel_shell_request(self, channel):
+        self.shell_requested.set()
+        return True
+
+
+class InstanceGone(Exception):
+    """The instance behind a simulated serial console session was terminated."""
+
+
+class SimulatedGrub:
+    """Plays the serial console of one instance: firmware noise, the GRUB menu and editor, then the boot log."""
+
+    def __init__(self, channel, instance):
+        self.channel = channel
+        self.instance = instance
+        self.lines = list(GRUB_ENTRY)
+        self.cursor_line = 0
+        self.cursor_col = 0
+        self.top = 0
+
+    def run(self):
+        while time.monotonic() < self.instance.grub_shown_at:
+            self.check_instance()
+            time.sleep(0.05)
+        if time.monotonic() < self.instance.boot_time():
+            self.send("\r\nBdsDxe: loading Boot0001 \"UEFI Amazon Elastic Block Store\"\r\n")
+            self.menu()
+        self.boot_log()
+
+    def check_instance(self):
+        if self.instance.state() in ('shutting-down', 'terminated'):
+            raise InstanceGone(self.instance.instance_id)
+        # The session ends, and stops counting against the session limit, as soon as the client hangs up
+        if self.channel.closed or not self.channel.get_transport().is_active():
+            raise OSError("client closed the session")
+
+    def send(self, text):
+        self.channel.sendall(text.encode('utf-8'))
+
+    def draw_menu(self):
+        self.send("\x1b[2J\x1b[1;1H                             GNU GRUB  version 2.12\x1b[3;1H+" + "-" * 76 + "+"
+                  "\x1b[4;1H|*Ubuntu\x1b[5;1H| Advanced options for Ubuntu\x1b[16;1H+" + "-" * 76 + "+"
+                  "\x1b[18;1H     Use the ^ and v keys to select which entry is highlighted.\x1b[19;1H"
+                  "     Press enter to boot the selected OS, `e' to edit the commands\x1b[20;1H"
+                  "     before booting or `c' for a command-line.\x1b[4;2H")
+
+    def draw_countdown(self, remaining):
+        self.send(f"\x1b[22;1H   The highlighted entry will be executed automatically in {remaining}s. \x1b[4;2H")
+
+    def menu(self):
+        self.draw_menu()
+        self.channel.settimeout(0.1)
+        shown = None
+        while True:
+            self.check_instance()
+            remaining = self.instance.grub_deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            if remaining != float('inf') and int(remaining) != shown:
+                shown = int(remaining)
+                self.draw_countdown(shown)
+            try:
+                data = self.channel.recv(1024)
+            except socket.timeout:
+                continue
+            if not data:
+                return
+            self.instance.stop_grub_countdown()
+            if b'e' in data:
+                self.editor(data[data.index(b'e') + 1:])
+                return
+
+    def draw_editor(self):
+        text = "\x1b[2J\x1b[1;1H                             GNU GRUB  version 2.12\x1b[3;1H+" + "-" * 76 + "+"
+        for row in range(GRUB_EDITOR_ROWS):
+            index = self.top + row
+            line = self.lines[index] if index < len(self.lines) else ''
+            text += f"\x1b[{4 + row};1H|{line[:76]}"
+        text += ("\x1b[16;1H+" + "-" * 76 + "+"
+                 "\x1b[18;1H     Minimum Emacs-like screen editing is supported. TAB lists\x1b[19;1H"
+                 "     completions. Press Ctrl-x or F10 to boot, Ctrl-c or F2 for\x1b[20;1H"
+                 "     a command-line or ESC to discard edits and return to the GRUB menu.")
+        self.send(text + self.cursor())
+
+    def cursor(self):
+        return f"\x1b[{4 + self.cursor_line - self.top};{2 + min(self.cursor_col, 75)}H"
+
+    def editor(self, pending):
+        self.draw_editor()
+        buffer = pending
+        while True:
+            self.check_instance()
+            while buffer:
+                if buffer.startswith(b'\x1b[B'):
+                    buffer = buffer[3:]
+                    if self.cursor_line < len(self.lines) - 1:
+                        self.cursor_line += 1
+                        self.cursor_col = 0
+                        if self.cursor_line - self.top >= GRUB_EDITOR_ROWS:
+                            self.top += 1
+                            self.draw_editor()
+                            continue
+                    self.send(self.cursor())
+                    continue
+                if buffer.startswith(b'\x1b') and len(buffer) < 3:
+                    break
+                char, buffer = buffer[:1], buffer[1:]
+                if char == b'\x05':
+                    self.cursor_col = len(self.lines[self.cursor_line])
+                    self.send(self.cursor())
+                elif char == b'\x18':
+                    self.send("\x1b[2J\x1b[1;1H  Booting a command list\r\n\r\n")
+                    self.instance.boot(self.kernel_command_line())
+                    return
+                elif char in (b'\n', b'\r'):
+                    line = self.lines[self.cursor_line]
+                    self.lines[self.cursor_line:self.cursor_line + 1] = [line[:self.cursor_col], line[self.cursor_col:]]
+                    self.cursor_line += 1
+                    self.cursor_col = 0
+                    self.draw_editor()
+                elif char >= b' ':
+                    line = self.lines[self.cursor_line]
+                    self.lines[self.cursor_line] = line[:self.cursor_col] + char.decode() + line[self.cursor_col:]
+                    self.cursor_col += 1
+                    self.send(char.decode())
+            try:
+                data = self.channel.recv(1024)
+            except socket.timeout:
+                continue
+            if not data:
+                return
+            buffer += data
+
+    def kernel_command_line(self):
+        for line in self.lines:
+            words = line.split()
+            if words and words[0] == 'linux':
+                return ' '.join(words[2:])
+        return ''
+
+    def boot_log(self):
+        cmdline = self.instance.cmdline or self.kernel_command_line()
+        self.send("[    0.000000] Linux version 6.8.0-sim (buildd@sim) #1 SMP\r\n")
+        self.send(f"[    0.000000] Kernel command line: BOOT_IMAGE=/boot/vmlinuz-6.8.0-sim {cmdline}\r\n")
+        self.send("cloud-init[500]: Cloud-init v. 24.1-sim running 'init' at Thu, 01 Jan 2026 00:00:00 +0000.\r\n")
+        self.send("cloud-init[600]: Cloud-init v. 24.1-sim running 'modules:final' at Thu, 01 Jan 2026 00:00:01 +0000.\r\n")
+        while time.monotonic() < self.instance.shutdown_at():
+            self.check_instance()
+            time.sleep(0.05)
+        self.send("[   10.000000] reboot: Power down\r\n")
+
+
+class SerialConsoleServer:
+    """An SSH server on localhost that behaves like serial-console.ec2-instance-connect.<region>.aws."""
+
+    def __init__(self, cloud, host='127.0.0.1', port=0):
+        self.cloud = cloud
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.sessions = 0
+        self.active_sessions = 0
+        self.refused = 0
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((host, port))
+        self._socket.listen(1024)
+        self.host, self.port = self._socket.getsockname()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def endpoint(self):
+        return f"{self.host}:{self.port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._accept, name='serial-console-server', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._socket.close()
+
+    def _accept(self):
+        while not self._stop.is_set():
+            try:
+                connection, _ = self._socket.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._session, args=(connection,), daemon=True).start()
+
+    def _session(self, connection):
+        with self.cloud.lock:
+            refused = self.cloud.max_console_sessions is not None and self.active_sessions >= self.cloud.max_console_sessions
+            if refused:
+                self.refused += 1
+            else:
+                self.active_sessions += 1
+        if refused:
+            connection.close()
+            return
+        try:
+            self._serve(connection)
+        finally:
+            with self.cloud.lock:
+                self.active_sessions -= 1
+
+    def _serve(self, connection):
+        transport = paramiko.Transport(connection)
+        transport.set_log_channel('ec2_simulator.serial_console')
+        transport.add_server_key(self.host_key)
+        server = SerialConsoleServerInterface(self.cloud)
+        try:
+            transport.start_server(server=server)
+            channel = transport.accept(30)
+            if channel is None or not server.shell_requested.wait(30):
+                return
+            with self.cloud.lock:
+                self.sessions += 1
+            SimulatedGrub(channel, self.cloud.instances[server.instance_id]).run()
+            channel.close()
+        except (InstanceGone, OSError):
+            # The instance was reclaimed, or the client hung up once it had what it needed
+            pass
+        except Exception as e:
+            if not self._stop.is_set():
+                print(f"Simulated serial console session failed: {e}")
+        finally:
+            transport.close()
@@ -0,0 +1,112 @@
+# ec2_sweep_helper.py
+
+import itertools
+
+"""
+Example of a kernel argument sweep in config.yaml:
+
+sweep:
+  # Added to every job
+  base_arguments: "nosmt"
+  # Every combination of these values becomes a job. null leaves the argument out, true adds it as a bare flag.
+  parameters:
+    isolcpus: ["1", "1-3"]
+    nohz_full: ["1-3", null]
+    mitigations: ["off", "auto"]
+  # Extra argument strings to run as they are, alongside the combinations above
+  kernel_arguments:
+    - "isolcpus=1 rcu_nocbs=1"
+  instance_types: ["t4g.nano", "t4g.micro"]
+  repetitions: 3
+"""
+
+# EC2 tag values are limited to 256 characters
+MAX_TAG_VALUE_LENGTH = 256
+
+
+def format_kernel_arguments(base_arguments, parameters):
+    """Build a kernel command line fragment from a base string and a dict of parameter values."""
+    arguments = [base_arguments] if base_arguments else []
+    for name, value in parameters.items():
+        if value is None or value is False:
+            continue
+        if value is True:
+            arguments.append(name)
+        else:
+            arguments.append(f"{name}={value}")
+    return ' '.join(arguments)
+
+
+def expand_kernel_arguments(sweep):
+    """Return every kernel argument string described by the sweep section."""
+    base_arguments = sweep.get('base_arguments', '')
+    parameters = sweep.get('parameters') or {}
+
+    kernel_arguments = []
+    if parameters:
+        names = list(parameters)
+        values = [parameters[name] if isinstance(parameters[name], list) else [parameters[name]] for name in names]
+        for combination in itertools.product(*values):
+            kernel_arguments.append(format_kernel_arguments(base_arguments, dict(zip(names, combination))))
+    for extra in sweep.get('kernel_arguments') or []:
+        kernel_arguments.append(' '.join(part for part in (base_arguments, extra) if part))
+    if not kernel_arguments:
+        kernel_arguments.append(base_arguments)
+    return kernel_arguments
+
+
+def expand_jobs(config):
+    """Expand config.yaml into the list of jobs for this run.
+
+    Without a 'sweep' section every instance of the fleet runs the single kernel_arguments string, as before.
+    """
+    sweep = config.get('sweep')
+    if sweep is None:
+        sweep = {
+            'kernel_arguments': [config['kernel_arguments']],
+            'repetitions': config['total_capacity'],
+        }
+
+    instance_types = sweep.get('instance_types') or [config['instance_type']]
+    repetitions = sweep.get('repetitions', 1)
+
+    jobs = []
+    for kernel_arguments, instance_type, repetition in itertools.product(expand_kernel_arguments(sweep), instance_types, range(repetitions)):
+        jobs.append({
+            'job_id': f"job-{len(jobs) + 1:04d}",
+            'kernel_arguments': kernel_arguments,
+            'instance_type': instance_type,
+            'repetition': repetition,
+        })
+    return jobs
+
+
+def next_wave(pending_jobs, capacity):
+    """Take up to capacity jobs off pending_jobs, grouped by instance type so each group can share a fleet."""
+    wave = {}
+    while pending_jobs and capacity > 0:
+        job = pending_jobs.pop(0)
+        wave.setdefault(job['instance_type'], []).append(job)
+        capacity -= 1
+    return wave
+
+
+def job_tags(job):
+    tags = [
+        {'Key': 'JobId', 'Value': job['job_id']},
+        {'Key': 'KernelArguments', 'Value': job['kernel_arguments'][:MAX_TAG_VALUE_LENGTH]},
+        {'Key': 'Repetition', 'Value': str(job['repetition'])},
+        # The instance type the job asked for - the instance may be a stand-in from fleet_overrides
+        {'Key': 'JobInstanceType', 'Value': job['instance_type']},
+    ]
+    if job.get('run_id'):
+        tags.append({'Key': 'RunId', 'Value': job['run_id']})
+    if job.get('boot_token'):
+        # New for every job, so the userdata of the kexec and grub-editenv boot modes can tell it from the last one
+        tags.append({'Key': 'BootToken', 'Value': job['boot_token']})
+    return tags
+
+
+def tag_instance_with_job(ec2_client, instance_id, job):
+    """Tag the instance with the job it runs, so results uploaded under its instance ID can be attributed."""
+    ec2_client.create_tags(Resources=[instance_id], Tags=job_tags(job))
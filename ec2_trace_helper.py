@@ -0,0 +1,106 @@
+# ec2_trace_helper.py
+
+import json
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a non-empty list of numbers."""
+    ordered = sorted(values)
+    index = max(math.ceil(fraction * len(ordered)) - 1, 0)
+    return ordered[min(index, len(ordered) - 1)]
+
+
+class Tracer:
+    """Record how long each stage of a run takes, per instance, as JSON lines.
+
+    Spans can be opened from any thread or coroutine. Each finished span is written straight away, so a trace
+    file is useful even if the run is interrupted.
+    """
+
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+        self._file = None
+
+    def open(self, path):
+        self._file = open(path, 'a')
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    @contextmanager
+    def span(self, stage, instance_id=None, **attributes):
+        started_at = time.time()
+        started = time.monotonic()
+        record = {'stage': stage, 'instance_id': instance_id, 'started_at': started_at}
+        record.update(attributes)
+        try:
+            yield record
+            record['status'] = 'ok'
+        except BaseException as e:
+            record['status'] = 'error'
+            record['error'] = str(e) or type(e).__name__
+            raise
+        finally:
+            record['duration'] = round(time.monotonic() - started, 3)
+            with self._lock:
+                self.spans.append(record)
+                if self._file is not None:
+                    self._file.write(json.dumps(record) + '\n')
+                    self._file.flush()
+
+    def summary(self, slowest=5):
+        """Duration statistics per stage, the slowest instances overall and failures per stage."""
+        with self._lock:
+            spans = list(self.spans)
+
+        stages = {}
+        failures = {}
+        per_instance = {}
+        for span in spans:
+            stages.setdefault(span['stage'], []).append(span['duration'])
+            if span['status'] != 'ok':
+                failures[span['stage']] = failures.get(span['stage'], 0) + 1
+            if span['instance_id'] is not None:
+                per_instance[span['instance_id']] = per_instance.get(span['instance_id'], 0) + span['duration']
+
+        return {
+            'stages': {
+                stage: {
+                    'count': len(durations),
+                    'p50': percentile(durations, 0.50),
+                    'p95': percentile(durations, 0.95),
+                    'max': max(durations),
+                }
+                for stage, durations in stages.items()
+            },
+            'slowest_instances': sorted(per_instance.items(), key=lambda item: item[1], reverse=True)[:slowest],
+            'failures': failures,
+        }
+
+    def print_summary(self):
+        summary = self.summary()
+        if not summary['stages']:
+            return
+        print("Timing summary (seconds):")
+        print(f"  {'stage':<24} {'count':>6} {'p50':>9} {'p95':>9} {'max':>9}")
+        for stage, stats in summary['stages'].items():
+            print(f"  {stage:<24} {stats['count']:>6} {stats['p50']:>9.2f} {stats['p95']:>9.2f} {stats['max']:>9.2f}")
+        if summary['slowest_instances']:
+            print("Slowest instances:")
+            for instance_id, total in summary['slowest_instances']:
+                print(f"  {instance_id}: {total:.2f}s")
+        if summary['failures']:
+            print("Failures by stage:")
+            for stage, count in summary['failures'].items():
+                print(f"  {stage}: {count}")
+
+
+# Shared by every stage of a run
+tracer = Tracer()
@@ -0,0 +1,132 @@
+# ec2_userdata_helper.py
+
+import gzip
+import re
+from ec2_sweep_helper import MAX_TAG_VALUE_LENGTH
+from ec2_results_collector import load_results_settings
+
+"""
+Example of userdata settings in config.yaml:
+
+userdata:
+  # Values of the {{NAME}} placeholders in the userdata script. S3_BUCKET and RESULTS_PREFIX default to the bucket
+  # and prefix of results source, if that is in S3.
+  variables:
+    S3_BUCKET: "my-bucket-name"
+  # gzip the userdata - auto does so only when it would not fit in the 16 KB EC2 allows otherwise
+  compress: auto
+  # Read the job of each boot from the instance tags into JOB_ID, RUN_ID and KERNEL_ARGUMENTS before the script runs
+  job_channel: true
+  # Power off without running the script if the kernel command line lacks the job's kernel arguments
+  validate_cmdline: true
+"""
+
+DEFAULT_USERDATA = {
+    'variables': {},
+    'compress': 'auto',
+    'job_channel': True,
+    'validate_cmdline': True,
+}
+
+COMPRESS_MODES = ('auto', True, False)
+# EC2 takes at most 16 KB of userdata, before base64 encoding
+MAX_USERDATA_SIZE = 16384
+GZIP_MAGIC = b'\x1f\x8b'
+# Where userdata-script.sh uploads its results in the bucket, unless results source says otherwise
+DEFAULT_RESULTS_PREFIX = 'results/'
+
+# {{NAME}}, leaving the shell's own ${NAME} alone
+PLACEHOLDER_PATTERN = re.compile(r'\{\{\s*([A-Za-z_][A-Za-z0-9_]*)\s*\}\}')
+
+# Put in front of the userdata script, after the bootstrap of the boot mode if there is one. Every boot reads the
+# job automate.py tagged the instance with (see job_tags() in ec2_sweep_helper.py) rather than having it rendered
+# into the userdata, so the launch template and the warm pool instances launched from it serve every job and run.
+JOB_CHANNEL_SCRIPT = """#!/bin/sh
+# The job of this boot, from the instance tags - added by ec2_userdata_helper.py
+VALIDATE_CMDLINE={validate_cmdline}
+
+instance_tag() {{
+  IMDS_TOKEN=`curl -s -X PUT "http://169.254.169.254/latest/api/token" -H "X-aws-ec2-metadata-token-ttl-seconds: 300"`
+  curl -s -f -H "X-aws-ec2-metadata-token: $IMDS_TOKEN" "http://169.254.169.254/latest/meta-data/tags/instance/$1"
+}}
+
+JOB_ID=`instance_tag JobId`
+RUN_ID=`instance_tag RunId`
+KERNEL_ARGUMENTS=`instance_tag KernelArguments`
+export JOB_ID RUN_ID KERNEL_ARGUMENTS
+
+if [ -z "$JOB_ID" ]; then
+  echo "No job tags on this instance, running without checking the kernel command line."
+elif [ "$VALIDATE_CMDLINE" = "true" ]; then
+  EXPECTED="$KERNEL_ARGUMENTS"
+  # A tag holds at most {max_length} characters, so the last argument of one that long may have been cut short
+  if [ ${{#EXPECTED}} -ge {max_length} ]; then
+    EXPECTED="${{EXPECTED% *}}"
+  fi
+  CMDLINE=" `cat /proc/cmdline` "
+  set -f
+  for ARGUMENT in $EXPECTED; do
+    case "$CMDLINE" in
+      *" $ARGUMENT "*) ;;
+      *)
+        echo "Job $JOB_ID: $ARGUMENT is not on the kernel command line, powering off without running it."
+        shutdown -h now
+        exit 1
+        ;;
+    esac
+  done
+  set +f
+  echo "Job $JOB_ID: the kernel command line has its arguments."
+fi
+"""
+
+
+def load_userdata_settings(config):
+    """Merge the optional 'userdata' section of config.yaml over the defaults, with the S3 location of the results
+    as the default S3_BUCKET and RESULTS_PREFIX."""
+    settings = dict(DEFAULT_USERDATA)
+    settings.update(config.get('userdata') or {})
+    if settings['compress'] not in COMPRESS_MODES:
+        raise ValueError(f"userdata compress must be auto, true or false, not '{settings['compress']}'")
+    variables = {'RESULTS_PREFIX': DEFAULT_RESULTS_PREFIX}
+    source = load_results_settings(config)['source']
+    if isinstance(source, str) and source.startswith('s3://'):
+        bucket, _, prefix = source[len('s3://'):].partition('/')
+        variables['S3_BUCKET'] = bucket
+        variables['RESULTS_PREFIX'] = prefix if prefix.endswith('/') or not prefix else prefix + '/'
+    variables.update(settings['variables'] or {})
+    settings['variables'] = variables
+    return settings
+
+
+def render_userdata(script_content, variables):
+    """Replace every {{NAME}} in the script with its variable. Raises ValueError naming any without a value, rather
+    than launching instances with a script that cannot work."""
+    missing = sorted({name for name in PLACEHOLDER_PATTERN.findall(script_content) if name not in variables})
+    if missing:
+        raise ValueError(f"no value for {', '.join('{{' + name + '}}' for name in missing)} in the userdata script - add it under userdata variables in the config, or set an S3 results source for S3_BUCKET")
+    return PLACEHOLDER_PATTERN.sub(lambda match: str(variables[match.group(1)]), script_content)
+
+
+def userdata_with_job_channel(script_content, settings):
+    """Put the job channel in front of a userdata script, if enabled. Instances must then be able to read their
+    tags from the instance metadata service."""
+    if not settings['job_channel']:
+        return script_content
+    lines = script_content.splitlines(keepends=True)
+    if lines and lines[0].startswith('#!'):
+        # The job channel brings its own
+        lines = lines[1:]
+    return JOB_CHANNEL_SCRIPT.format(validate_cmdline='true' if settings['validate_cmdline'] else 'false', max_length=MAX_TAG_VALUE_LENGTH) + ''.join(lines)
+
+
+def compress_userdata(script_content, settings):
+    """Return the final userdata as bytes, gzipped if configured or if it is too big otherwise - cloud-init
+    gunzips it. Raises ValueError if it does not fit in MAX_USERDATA_SIZE either way."""
+    data = script_content.encode('utf-8')
+    if settings['compress'] is True or (settings['compress'] == 'auto' and len(data) > MAX_USERDATA_SIZE):
+        # Without a timestamp in the header, so the same script gives the same launch template hash every run
+        data = gzip.compress(data, compresslevel=9, mtime=0)
+    if len(data) > MAX_USERDATA_SIZE:
+        raise ValueError(f"the userdata is {len(data)} bytes{' gzipped' if data.startswith(GZIP_MAGIC) else ''}, more than the {MAX_USERDATA_SIZE} EC2 allows")
+    return data
@@ -0,0 +1,158 @@
+# ec2_warm_pool_helper.py
+
+from botocore.exceptions import ClientError
+
+"""
+Example of warm pool settings in config.yaml:
+
+warm_pool:
+  enabled: true
+  # Stopped instances kept for the next run - any beyond this are terminated at the end of a run.
+  # Defaults to total_capacity.
+  max_size: 10
+"""
+
+# Instances kept between runs carry this tag, with the launch template name as its value
+WARM_POOL_TAG = 'WarmPool'
+# EC2 tags every instance launched from a launch template with the template ID and version it came from
+LAUNCH_TEMPLATE_ID_TAG = 'aws:ec2launchtemplate:id'
+LAUNCH_TEMPLATE_VERSION_TAG = 'aws:ec2launchtemplate:version'
+
+# cloud-init runs user scripts once per instance. This part makes it run them on every boot instead, so a
+# restarted instance runs the workload again with its new kernel arguments.
+EVERY_BOOT_CLOUD_CONFIG = """#cloud-config
+cloud_final_modules:
+- [scripts-user, always]
+"""
+MIME_BOUNDARY = '==WARM-POOL-BOUNDARY=='
+
+
+def userdata_for_every_boot(script_content):
+    """Wrap a userdata script in a MIME multipart document that cloud-init runs on every boot."""
+    parts = [
+        f"Content-Type: multipart/mixed; boundary=\"{MIME_BOUNDARY}\"",
+        "MIME-Version: 1.0",
+        "",
+        f"--{MIME_BOUNDARY}",
+        "Content-Type: text/cloud-config; charset=\"us-ascii\"",
+        "MIME-Version: 1.0",
+        "Content-Transfer-Encoding: 7bit",
+        "Content-Disposition: attachment; filename=\"cloud-config.txt\"",
+        "",
+        EVERY_BOOT_CLOUD_CONFIG,
+        f"--{MIME_BOUNDARY}",
+        "Content-Type: text/x-shellscript; charset=\"us-ascii\"",
+        "MIME-Version: 1.0",
+        "Content-Transfer-Encoding: 7bit",
+        "Content-Disposition: attachment; filename=\"userdata.txt\"",
+        "",
+        script_content.rstrip('\n'),
+        f"--{MIME_BOUNDARY}--",
+        "",
+    ]
+    return '\n'.join(parts)
+
+
+def warm_pool_sizes(jobs, capacity):
+    """Share capacity between the instance types of jobs, round robin, with no type getting more instances than it has jobs."""
+    remaining = {}
+    for job in jobs:
+        remaining[job['instance_type']] = remaining.get(job['instance_type'], 0) + 1
+    sizes = {instance_type: 0 for instance_type in remaining}
+    while capacity > 0 and any(remaining.values()):
+        for instance_type in sizes:
+            if capacity > 0 and remaining[instance_type]:
+                sizes[instance_type] += 1
+                remaining[instance_type] -= 1
+                capacity -= 1
+    return {instance_type: size for instance_type, size in sizes.items() if size}
+
+
+def describe_warm_pool(ec2_client, pool_name):
+    """Return every instance of the pool that is not terminated or on its way there."""
+    instances = []
+    paginator = ec2_client.get_paginator('describe_instances')
+    for page in paginator.paginate(Filters=[
+        {'Name': f"tag:{WARM_POOL_TAG}", 'Values': [pool_name]},
+        {'Name': 'instance-state-name', 'Values': ['pending', 'running', 'stopping', 'stopped']},
+    ]):
+        for reservation in page['Reservations']:
+            instances.extend(reservation['Instances'])
+    return instances
+
+
+def instance_tag(instance, key):
+    for tag in instance.get('Tags', []):
+        if tag['Key'] == key:
+            return tag['Value']
+    return None
+
+
+def find_warm_instances(ec2_client, pool_name, launch_template_id, launch_template_version):
+    """Return {instance_type: [instance_id, ...]} of the stopped pool instances launched from this template version.
+
+    Instances from other versions have a different AMI or userdata, so they are left alone rather than reused.
+    """
+    warm = {}
+    for instance in describe_warm_pool(ec2_client, pool_name):
+        if instance['State']['Name'] != 'stopped':
+            continue
+        if instance_tag(instance, LAUNCH_TEMPLATE_ID_TAG) != launch_template_id:
+            continue
+        if instance_tag(instance, LAUNCH_TEMPLATE_VERSION_TAG) != str(launch_template_version):
+            continue
+        warm.setdefault(instance['InstanceType'], []).append(instance['InstanceId'])
+    return warm
+
+
+def launch_warm_instances(ec2_client, launch_template_id, launch_template_version, instance_type, count, pool_name, tags=None):
+    """Launch up to count on-demand instances for the pool, tagged with the pool name and tags, and return their IDs.
+
+    Pool instances come from RunInstances rather than an instant fleet - deleting an instant fleet always
+    terminates its instances, and spot instances from a one-time request cannot be started again once stopped.
+    """
+    response = ec2_client.run_instances(
+        LaunchTemplate={
+            'LaunchTemplateId': launch_template_id,
+            'Version': str(launch_template_version),
+        },
+        InstanceType=instance_type,
+        MinCount=1,
+        MaxCount=count,
+        InstanceInitiatedShutdownBehavior='stop',
+        # Tagged at launch - tags created afterwards can fail on instances EC2 does not list yet, and an untagged
+        # instance is never found again to be reused or trimmed
+        TagSpecifications=[{
+            'ResourceType': 'instance',
+            'Tags': [{'Key': WARM_POOL_TAG, 'Value': pool_name}] + list(tags or []),
+        }]
+    )
+    instance_ids = [instance['InstanceId'] for instance in response['Instances']]
+    print(f"Launched {len(instance_ids)} {instance_type} instances for warm pool '{pool_name}': {instance_ids}")
+    return instance_ids
+
+
+def start_instance(ec2_client, instance_id):
+    ec2_client.start_instances(InstanceIds=[instance_id])
+
+
+def trim_warm_pool(ec2_client, pool_name, max_size, launch_template_id, launch_template_version):
+    """Terminate pool instances beyond max_size, those from other launch template versions first."""
+    instances = describe_warm_pool(ec2_client, pool_name)
+    if len(instances) <= max_size:
+        return []
+
+    def keep_first(instance):
+        current = (instance_tag(instance, LAUNCH_TEMPLATE_ID_TAG) == launch_template_id
+                   and instance_tag(instance, LAUNCH_TEMPLATE_VERSION_TAG) == str(launch_template_version))
+        return (not current, instance['InstanceId'])
+
+    surplus = [instance['InstanceId'] for instance in sorted(instances, key=keep_first)[max_size:]]
+    try:
+        # TerminateInstances takes up to 1000 IDs per call
+        for start in range(0, len(surplus), 1000):
+            ec2_client.terminate_instances(InstanceIds=surplus[start:start + 1000])
+        print(f"Terminated {len(surplus)} instances beyond the warm pool size of {max_size}: {surplus}")
+    except ClientError as e:
+        print(f"Error trimming warm pool '{pool_name}': {e}")
+    return surplus
@@ -1,25 +1,32 @@
 #!/bin/sh
 
-S3_BUCKET=my-bucket-name
+# Filled in by automate.py, from the results source or the userdata variables in config.yaml
+S3_BUCKET={{S3_BUCKET}}
+RESULTS_PREFIX={{RESULTS_PREFIX}}
 
 # This script assumes the presence of a policy that allows access to the required S3 bucket is attached to the EC2 instance
-apt update
-apt -y install unzip
-curl "https://awscli.amazonaws.com/awscli-exe-linux-aarch64.zip" -o "/tmp/awscliv2.zip"
-unzip /tmp/awscliv2.zip -d /tmp
-/tmp/aws/install
+# Warm pool and kexec instances run it on every boot - the AWS CLI only needs installing on the first
+if ! command -v aws > /dev/null; then
+  command -v unzip > /dev/null || { apt update && apt -y install unzip; }
+  curl "https://awscli.amazonaws.com/awscli-exe-linux-`uname -m`.zip" -o "/tmp/awscliv2.zip"
+  unzip -o /tmp/awscliv2.zip -d /tmp
+  /tmp/aws/install
+fi
 
 aws s3 cp s3://${S3_BUCKET}/tools/code.zip /tmp
-unzip /tmp/code.zip -d /tmp
+unzip -o /tmp/code.zip -d /tmp
 
 TOKEN=`curl -X PUT "http://169.254.169.254/latest/api/token" -H "X-aws-ec2-metadata-token-ttl-seconds: 21600"`
 INSTANCETYPE=`curl -H "X-aws-ec2-metadata-token: $TOKEN" http://169.254.169.254/latest/meta-data/instance-type`
 INSTANCEID=`curl -H "X-aws-ec2-metadata-token: $TOKEN" http://169.254.169.254/latest/meta-data/instance-id`
 
+# JOB_ID and RUN_ID come from the instance tags, read in front of this script (see ec2_userdata_helper.py)
 echo "Aws:" >> instance_info.yml
 echo "  InstanceType: ${INSTANCETYPE}" >> instance_info.yml
 echo "  CmdLine: $(cat /proc/cmdline)" >> instance_info.yml
+echo "  JobId: ${JOB_ID}" >> instance_info.yml
+echo "  RunId: ${RUN_ID}" >> instance_info.yml
 
-aws s3 cp results_all.yml s3://${S3_BUCKET}/results/${INSTANCEID}_${INSTANCETYPE}_$(date +%Y%m%d_%H%M%S).yml
+aws s3 cp results_all.yml s3://${S3_BUCKET}/${RESULTS_PREFIX}${INSTANCEID}_${INSTANCETYPE}_$(date +%Y%m%d_%H%M%S).yml
 
-shutdown -h now
\ No newline at end of file
+shutdown -h now